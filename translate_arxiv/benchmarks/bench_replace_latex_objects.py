@@ -0,0 +1,98 @@
+'''
+Compare replace_latex_objects with the previous implementation, which searched the whole text again after every replaced object.
+
+python benchmarks/bench_replace_latex_objects.py [-sections 10 20 40 80] [-repeat 3]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import regex
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import process_latex
+from process_latex import variable_code, modify_text, modify_before
+from config import config
+
+
+def replace_latex_objects_old(text, brace=True, commandSimple=True):
+    patternsMulargCommand = [process_latex.get_pattern_command_full(name, n) for name, n, index in config.mularg_command_list]
+    latexObjRegex = [
+        r"\$\$(.*?)\$\$",
+        r"\$(.*?)\$",
+        r"\\\[(.*?)\\\]",
+        r"\\\((.*?)\\\)",
+        process_latex.patternEnv,
+        process_latex.patternSet1,
+        process_latex.patternSet2,
+    ] + patternsMulargCommand + [process_latex.patternCommandFull]
+    if brace:
+        latexObjRegex.append(process_latex.patternBrace)
+    if commandSimple:
+        latexObjRegex.append(process_latex.patternCommandSimple)
+
+    count = 0
+    replacedObjs = []
+    for regexSymbol in latexObjRegex:
+        pattern = regex.compile(regexSymbol, regex.DOTALL)
+        while pattern.search(text):
+            latex_obj = pattern.search(text).group()
+            replacedObjs.append(f' {latex_obj} ')
+            text = pattern.sub(' ' + variable_code(count) + ' ', text, 1)
+            count += 1
+
+    text = modify_text(text, modify_before)
+    return text, replacedObjs
+
+
+def make_section(rng, index):
+    sentences = []
+    for i in range(12):
+        words = ' '.join(rng.choice(['model', 'energy', 'state', 'the', 'of', 'we', 'show', 'that', 'field']) for _ in range(rng.randint(5, 15)))
+        extra = rng.choice([
+            f' where $x_{i} = \\alpha^{{{i}}}$',
+            f' as shown in Eq.~\\eqref{{eq:{index}-{i}}}',
+            f' \\cite{{ref{i},ref{i + 1}}}',
+            f' (see \\ref{{fig:{index}}} and \\textbf{{bold {{nested}} text}})',
+            f' \\item[\\emph{{case {i}}}] {{grouped {{deeply {{nested}}}} words}}',
+            f' \\textcolor{{red}}{{warning $y$}}',
+            f' \\( a_{i} \\) and \\[ b_{i} \\]',
+            '',
+        ])
+        sentences.append(words.capitalize() + extra + '.')
+    equation = f'\\begin{{equation}}\\label{{eq:{index}}} E = mc^{index} \\end{{equation}}'
+    return f'\\section{{Section {index}}}\n' + ' '.join(sentences) + f'\n\n{equation}\n\n$$ \\int f_{index} $$\n\n'
+
+
+def make_document(nSections, seed=0):
+    rng = random.Random(seed)
+    return ''.join(make_section(rng, i) for i in range(nSections))
+
+
+def timeit(function, text, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(text)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sections", type=int, nargs='+', default=[10, 20, 40, 80])
+    parser.add_argument("-repeat", type=int, default=3)
+    options = parser.parse_args(args)
+
+    print(f'{"chars":>10} {"objects":>8} {"old (s)":>10} {"new (s)":>10} {"speedup":>8}')
+    for nSections in options.sections:
+        text = make_document(nSections)
+        timeOld, resultOld = timeit(replace_latex_objects_old, text, options.repeat)
+        timeNew, resultNew = timeit(process_latex.replace_latex_objects, text, options.repeat)
+        assert resultOld == resultNew, 'replace_latex_objects differs from the previous implementation'
+        print(f'{len(text):>10} {len(resultNew[1]):>8} {timeOld:>10.4f} {timeNew:>10.4f} {timeOld / timeNew:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
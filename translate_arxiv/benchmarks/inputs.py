@@ -0,0 +1,97 @@
+'''
+Deterministic LaTeX inputs for the benchmarks, the same size and seed always give the same text.
+size is the number of repeated units, each unit is roughly 15-25k characters.
+'''
+import random
+
+
+words = ['model', 'energy', 'state', 'the', 'of', 'we', 'show', 'that', 'field', 'results', 'in', 'a', 'system', 'is']
+
+
+def sentence(rng, nWords=None):
+    if nWords is None:
+        nWords = rng.randint(6, 16)
+    return ' '.join(rng.choice(words) for _ in range(nWords)).capitalize() + '.'
+
+
+def math_heavy(size, seed=0):
+    # inline and display math, equations, references and citations
+    rng = random.Random(seed)
+    parts = []
+    for i in range(size * 16):
+        parts.append(f'\\section{{Section {i} with $\\mathcal{{O}}(n^{i})$}}\n')
+        for j in range(6):
+            parts.append(sentence(rng) + f' We have $x_{{{j}}} = \\alpha^{{{i}}} + \\beta_{j}$ and \\( y_{j} \\) as in Eq.~\\eqref{{eq:{i}-{j}}} \\cite{{ref{i},ref{j}}}. ')
+        parts.append(f'\n\n\\begin{{equation}}\\label{{eq:{i}}}\n E_{i} = \\sum_{{k=0}}^{{{i}}} \\frac{{a_k}}{{b_k}} \\pm c\n\\end{{equation}}\n\n')
+        parts.append(f'\\begin{{align}} a &= b_{i} \\\\ c &= d \\end{{align}}\n$$ \\int_0^1 f_{i}(x) dx $$\n\\[ g_{i} \\]\n\n')
+    return ''.join(parts)
+
+
+def macro_name(k):
+    # macro names can only contain letters
+    return chr(ord('a') + k // 26) + chr(ord('a') + k % 26)
+
+
+def macro_heavy(size, seed=0):
+    # a preamble with many \newcommand and \def, used all over the body
+    rng = random.Random(seed)
+    nMacros = 40
+    preamble = ['\\documentclass{article}\n']
+    for k in range(nMacros):
+        if k % 3 == 0:
+            preamble.append(f'\\newcommand{{\\beq{macro_name(k)}}}{{\\begin{{equation}}}}\n')
+        elif k % 3 == 1:
+            preamble.append(f'\\newcommand{{\\sec{macro_name(k)}}}[1]{{\\section{{#1 {k}}}}}\n')
+        else:
+            preamble.append(f'\\def\\col{macro_name(k)}{{\\textcolor{{red}}{{note {k}}}}}\n')
+        preamble.append(f'\\newcommand{{\\plain{macro_name(k)}}}{{x_{k}}}\n')
+    body = ['\\begin{document}\n']
+    for i in range(size * 60):
+        k = rng.randrange(nMacros)
+        if k % 3 == 0:
+            body.append(f'\\beq{macro_name(k)} a_{i} = \\plain{macro_name(k)} \\end{{equation}}\n')
+        elif k % 3 == 1:
+            body.append(f'\\sec{macro_name(k)}{{Title {i}}}\n')
+        else:
+            body.append(f'\\col{macro_name(k)} ')
+        body.append(sentence(rng) + ' ' + sentence(rng) + '\n\n')
+    body.append('\\end{document}\n')
+    return ''.join(preamble + body)
+
+
+def nested_braces(size, seed=0):
+    # deeply nested groups and commands, with comments
+    rng = random.Random(seed)
+    parts = []
+    for i in range(size * 40):
+        depth = rng.randint(3, 12)
+        group = sentence(rng, 4)
+        for d in range(depth):
+            command = rng.choice(['{', '\\textbf{', '\\emph{', '\\footnote{', '\\textcolor{blue}{'])
+            group = f'{command}{sentence(rng, 3)} {group} \\% {d}}}'
+        parts.append(sentence(rng) + ' ' + group + ' % a comment with {braces}\n')
+        parts.append(f'\\item[\\emph{{case {i}}}] ' + sentence(rng) + '\n\n')
+    return ''.join(parts)
+
+
+def bbl(size, seed=0):
+    # a large bibliography as produced by bibtex
+    rng = random.Random(seed)
+    parts = ['\\begin{thebibliography}{999}\n']
+    for i in range(size * 80):
+        parts.append(
+            f'\\bibitem[{{Author {i}}}({2000 + i % 25})]{{ref{i}}}\n'
+            f'\\bibinfo{{author}}{{A.~Author{i}}}, \\bibinfo{{title}}{{\\emph{{{sentence(rng)}}}}}\n'
+            f'\\newblock \\bibinfo{{journal}}{{Phys. Rev.}} \\textbf{{{i}}}, \\bibinfo{{pages}}{{{i}--{i + 9}}} ({2000 + i % 25}).\n'
+            f'\\bibinfo{{note}}{{{sentence(rng, 5)}}} % {i}\n\n'
+        )
+    parts.append('\\end{thebibliography}\n')
+    return ''.join(parts)
+
+
+generators = {
+    'math': math_heavy,
+    'macro': macro_heavy,
+    'nested': nested_braces,
+    'bbl': bbl,
+}
@@ -0,0 +1,61 @@
+'''
+Load test of the whole translation of a document with the mock engine, no network is needed.
+
+python benchmarks/pipeline.py [-size 2] [-latency 0.2] [-char-cost 0.0001] [-rate 0] [-threads 0] [-processes 0] [--nobatch]
+
+The document is built from benchmarks/inputs.py and translated in a temporary directory, so the cache
+of the current directory is not touched.
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+sys.path.insert(0, benchmarkDir)
+
+
+def make_document(size):
+    import inputs
+    body = inputs.math_heavy(size) + inputs.nested_braces(size) + inputs.bbl(size)
+    return '\\documentclass{article}\n\\begin{document}\n' + body + '\\end{document}\n'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-size", type=int, default=2, help='size of the generated document')
+    parser.add_argument("-latency", type=float, default=0.2, help='seconds for each request')
+    parser.add_argument("-char-cost", type=float, default=0.0001, help='additional seconds for each character')
+    parser.add_argument("-rate", type=float, default=0, help='requests per second, 0 means no limit')
+    parser.add_argument("-inflight", type=int, default=16, help='most requests in flight')
+    parser.add_argument("-threads", type=int, default=0, help='threads, 0 means auto')
+    parser.add_argument("-processes", type=int, default=0, help='processes of the pipeline, 0 means auto, 1 means none')
+    parser.add_argument("--nobatch", action='store_true', help='one request per text')
+    options = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        cwd = os.getcwd()
+        os.chdir(tempDir)
+        try:
+            # config and cache keep their files in the current directory when they are imported
+            from config import config
+            import translate
+            config.mock_latency = options.latency
+            config.mock_char_cost = options.char_cost
+            config.requests_per_second = options.rate
+            config.max_in_flight = options.inflight
+            with open('main.tex', 'w', encoding='utf-8') as f:
+                f.write(make_document(options.size))
+            start = time.perf_counter()
+            translate.translate_single_tex_file('main.tex', 'main_translated.tex', 'mock', 'en', 'zh-CN', False, True, options.threads, not options.nobatch, options.processes)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    print(f'translated in {elapsed:.2f}s')
+    return elapsed
+
+
+if __name__ == '__main__':
+    main()
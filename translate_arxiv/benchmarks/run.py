@@ -0,0 +1,176 @@
+'''
+Micro-benchmarks of the hot functions of process_latex and process_text, no network is needed.
+
+python benchmarks/run.py [-sizes 1 2 4 8] [-repeat 3] [-o results.json] [-compare old.json]
+
+Every function runs on every input of benchmarks/inputs.py at each size. The results,
+with the scaling exponent of each curve (time ~ chars^k), are saved as JSON.
+With -compare, the results are checked against a previous JSON file and slower cases are reported.
+'''
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import platform
+import argparse
+import subprocess
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+sys.path.insert(0, benchmarkDir)
+import inputs
+import process_latex
+import process_text
+from translate import TextTranslator, LatexTranslator
+
+
+resultVersion = 1
+
+
+def prepare_recover(text):
+    return process_latex.replace_latex_objects(text)
+
+
+def run_recover(prepared):
+    text, objs = prepared
+    return process_latex.recover_latex_objects(text, objs)
+
+
+def run_remove_tex_comments(text):
+    # the results are remembered by remove_tex_comments, they are cleared so that the scan is timed
+    process_latex.strippedTexts.clear()
+    return process_latex.remove_tex_comments(text)
+
+
+latexTranslator = LatexTranslator(TextTranslator('google', 'zh-CN', 'en'))
+
+# name: (prepare the input once, function to time)
+functions = {
+    'replace_latex_objects': (None, process_latex.replace_latex_objects),
+    'recover_latex_objects': (prepare_recover, run_recover),
+    'remove_tex_comments': (None, run_remove_tex_comments),
+    'process_newcommands': (None, process_latex.process_newcommands),
+    'split_too_long_paragraphs': (None, process_text.split_too_long_paragraphs),
+    'split_latex_to_paragraphs': (None, latexTranslator.split_latex_to_paragraphs),
+}
+
+
+def time_function(function, argument, repeat):
+    # the first run compiles the patterns and fills the caches, it is not timed
+    function(argument)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def scaling_exponent(points):
+    # least squares slope of log(seconds) against log(chars)
+    points = [(math.log(chars), math.log(seconds)) for chars, seconds in points if seconds > 0]
+    if len(points) < 2:
+        return None
+    meanX = sum(x for x, y in points) / len(points)
+    meanY = sum(y for x, y in points) / len(points)
+    varX = sum((x - meanX) ** 2 for x, y in points)
+    if varX == 0:
+        return None
+    return sum((x - meanX) * (y - meanY) for x, y in points) / varX
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=benchmarkDir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(sizes, repeat, selected=None):
+    results = {}
+    for name, (prepare, function) in functions.items():
+        if selected and name not in selected:
+            continue
+        results[name] = {}
+        for inputName, generator in inputs.generators.items():
+            curve = []
+            for size in sizes:
+                text = generator(size)
+                argument = prepare(text) if prepare is not None else text
+                best, median = time_function(function, argument, repeat)
+                curve.append({
+                    'size': size,
+                    'chars': len(text),
+                    'input_hash': hashlib.sha256(text.encode()).hexdigest()[0:16],
+                    'best': best,
+                    'median': median,
+                })
+                print(f'{name:<28} {inputName:<8} {len(text):>9} chars {best * 1000:>10.2f} ms')
+            exponent = scaling_exponent([(point['chars'], point['best']) for point in curve])
+            results[name][inputName] = {'points': curve, 'exponent': exponent}
+    return results
+
+
+def compare(results, old, threshold):
+    # report the cases that are slower than in the old results by more than threshold
+    regressions = []
+    for name, byInput in results.items():
+        for inputName, result in byInput.items():
+            oldResult = old.get('results', {}).get(name, {}).get(inputName)
+            if oldResult is None:
+                continue
+            oldPoints = {(point['size'], point['input_hash']): point for point in oldResult['points']}
+            for point in result['points']:
+                oldPoint = oldPoints.get((point['size'], point['input_hash']))
+                if oldPoint is None:
+                    continue
+                ratio = point['best'] / oldPoint['best']
+                if ratio > 1 + threshold:
+                    regressions.append({'function': name, 'input': inputName, 'size': point['size'], 'ratio': ratio})
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sizes", type=int, nargs='+', default=[1, 2, 4, 8], help='sizes of the generated inputs')
+    parser.add_argument("-repeat", type=int, default=3, help='runs of each case, the best one is kept')
+    parser.add_argument("-functions", nargs='+', help=f'only run these functions: {", ".join(functions)}')
+    parser.add_argument("-o", type=str, default='benchmark_results.json', help='output JSON file')
+    parser.add_argument("-compare", type=str, help='previous JSON file to compare with')
+    parser.add_argument("-threshold", type=float, default=0.2, help='slowdown reported as a regression, default 0.2 (20%%)')
+    options = parser.parse_args(args)
+
+    results = run(options.sizes, options.repeat, options.functions)
+    print()
+    for name, byInput in results.items():
+        exponents = ', '.join(f'{inputName} {result["exponent"]:.2f}' for inputName, result in byInput.items() if result['exponent'] is not None)
+        print(f'{name:<28} scaling exponent: {exponents}')
+
+    output = {
+        'version': resultVersion,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': options.sizes,
+        'repeat': options.repeat,
+        'results': results,
+    }
+    if options.compare:
+        old = json.load(open(options.compare, encoding='utf-8'))
+        output['regressions'] = compare(results, old, options.threshold)
+        for regression in output['regressions']:
+            print(f'regression: {regression["function"]} on {regression["input"]} size {regression["size"]} is {regression["ratio"]:.2f}x slower')
+        if not output['regressions']:
+            print('no regression against', options.compare)
+    with open(options.o, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2)
+    print('saved to', options.o)
+    return output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''
+A local HTTP server with the interface of the google engine, for tests without network.
+It "translates" by upper-casing the words, waits `-latency` seconds for each request, and answers 429
+for a fraction `-error-rate` of the requests and for the requests beyond `-limit` per second.
+With -capacity, at most that many requests are served at the same time and the others wait in line,
+so the latency rises with the concurrency of the client.
+
+python benchmarks/stub_translator.py -port 8765 -latency 0.2 -error-rate 0.05 -limit 20
+python translate_arxiv.py xxx --from_dir -engine-url http://127.0.0.1:8765/m
+
+With -check N, the server is started in the background and N texts are translated through engines.GoogleEngine.
+'''
+import os
+import sys
+import html
+import time
+import random
+import argparse
+import threading
+import concurrent.futures
+import http.server
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import engines
+from engines import mock_translate
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.1, errorRate=0, limit=0, capacity=0, seed=0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.serving = threading.Semaphore(capacity) if capacity > 0 else None
+        self.errorRate = errorRate
+        self.limit = limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = []  # times of the requests accepted in the last second
+        self.requests = 0
+        self.rejected = 0
+        self.connections = 0
+
+    def accept(self):
+        # False if the request gets a 429
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.recent = [t for t in self.recent if now - t < 1]
+            if self.random.random() < self.errorRate or (self.limit > 0 and len(self.recent) >= self.limit):
+                self.rejected += 1
+                return False
+            self.recent.append(now)
+            return True
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, one handler for each connection
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != '/m' or 'q' not in query:
+            self.send_error(404)
+            return
+        if not self.server.accept():
+            self.send_response(429)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.server.serving is None:
+            time.sleep(self.server.latency)
+        else:
+            with self.server.serving:
+                time.sleep(self.server.latency)
+        body = f'<div class="result-container">{html.escape(mock_translate(query["q"][0]))}</div>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, **kwargs):
+    server = StubServer(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/m'
+
+
+def check(server, url, n, threads, rate):
+    engine = engines.GoogleEngine(url, requestsPerSecond=rate)
+    texts = [f'text number {i} with XMATHX_{i} inside' for i in range(n)]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda text: engine.translate(text, 'zh-CN', 'en'), texts))
+    elapsed = time.perf_counter() - start
+    engine.close()
+    wrong = sum(result != mock_translate(text) for text, result in zip(texts, results))
+    print(f'{n} texts in {elapsed:.2f}s ({n / elapsed:.1f}/s), {wrong} wrong')
+    print('engine:', engine.report())
+    print(f'server: {server.requests} requests on {server.connections} connections, {server.rejected} answered 429')
+    return wrong == 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-port", type=int, default=8765)
+    parser.add_argument("-latency", type=float, default=0.1, help='seconds before each answer')
+    parser.add_argument("-error-rate", type=float, default=0, help='fraction of the requests answered 429')
+    parser.add_argument("-limit", type=float, default=0, help='requests per second beyond which the answer is 429, 0 means no limit')
+    parser.add_argument("-capacity", type=int, default=0, help='requests served at the same time, the others wait, 0 means no limit')
+    parser.add_argument("-check", type=int, help='translate this number of texts through the engine and exit')
+    parser.add_argument("-threads", type=int, default=32, help='threads calling the engine with -check')
+    parser.add_argument("-rate", type=float, default=0, help='requests per second of the engine with -check, 0 means no limit')
+    options = parser.parse_args(args)
+
+    server, url = start_server(0 if options.check else options.port, latency=options.latency, errorRate=options.error_rate, limit=options.limit, capacity=options.capacity)
+    if options.check:
+        return check(server, url, options.check, options.threads, options.rate)
+    print('stub translator at', url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
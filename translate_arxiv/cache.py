@@ -1,19 +1,89 @@
 import os
 import time
+import heapq
 import hashlib
 import shutil
+import sqlite3
+import threading
+import contextlib
+import collections
+from metrics import metrics
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no advisory lock, sqlite still locks the database
+
+
+# fixed when the module is imported, the working directory of a run changes, e.g. to the sources of the paper
+cachePath = os.path.join(os.getcwd(), 'arxiv_cache')
 
 
 def cache_dir():
-    cachePath = os.path.join(os.getcwd(), 'arxiv_cache')
-    if not os.path.exists(cachePath):
-        os.mkdir(cachePath)
+    # only the path, the directories are created when they are written, so importing the modules creates nothing
     return cachePath
 
+# one sqlite file in WAL mode: the documents, their paragraphs, and the global paragraphs of all documents
+databasePath = os.path.join(cache_dir(), 'cache.sqlite3')
+# the old layout, one file per paragraph, which is moved into the database
 cacheDir = os.path.join(cache_dir(), 'cache')
-os.makedirs(cacheDir, exist_ok=True)
+globalDir = os.path.join(cache_dir(), 'paragraphs')
+# held by the process which creates, migrates or evicts, the other processes of the same cache wait
+lockPath = os.path.join(cache_dir(), 'cache.lock')
 timeFilename = 'update_time'
-maxCache = 5
+maxBytes = 256 * 2 ** 20  # the least recently used documents and global paragraphs are removed beyond it
+batchSize = 64  # paragraphs written in one transaction
+memoryBytes = 32 * 2 ** 20  # the recently used paragraphs kept in memory in front of the database
+
+# update_time is the last access, size the bytes of the translations
+schema = '''
+CREATE TABLE IF NOT EXISTS documents (hash TEXT PRIMARY KEY, update_time REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS paragraphs (document TEXT NOT NULL, hash TEXT NOT NULL, translation TEXT NOT NULL, PRIMARY KEY (document, hash)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS global_paragraphs (key TEXT PRIMARY KEY, translation TEXT NOT NULL, update_time REAL NOT NULL DEFAULT 0, size INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS documents_time ON documents (update_time);
+'''
+globalIndex = 'CREATE INDEX IF NOT EXISTS global_paragraphs_time ON global_paragraphs (update_time)'
+
+local = threading.local()  # a connection for each thread
+lock = threading.Lock()  # the memory tier and the pending writes, never held while waiting for the database
+writeLock = threading.Lock()  # held by the thread which writes to the database, so the batches are written in order
+pendingParagraphs = {}  # (document, hash): translation, not written yet
+pendingGlobal = {}  # key: translation, not written yet
+writingParagraphs = {}  # the pending paragraphs of the batch being written
+writingGlobal = {}
+pendingAccess = {}  # key: time of the last access of a global paragraph, not written yet
+pendingStats = {}  # name: number to add to the stats
+memory = collections.OrderedDict()  # (document, hash) or key: translation, the least recently used first
+memorySize = 0
+inUse = set()  # the documents being translated by this process, e.g. into several languages
+knownBytes = None  # the size of the cache after the last eviction plus the bytes written since, None before the first one
+initialized = False
+# sets the size of the documents from their paragraphs
+documentSize = 'UPDATE documents SET size = (SELECT COALESCE(SUM(LENGTH(CAST(translation AS BLOB))), 0) FROM paragraphs WHERE document = documents.hash)'
+
+
+def set_cache_dir(path):
+    '''
+    Uses the cache in path, e.g. in the spawned processes of the pipeline, whose working directory is the one
+    of the paper, or in tests. The connection of the thread is closed, the next one opens the database in path,
+    and what is in memory or pending for the previous path is dropped.
+    '''
+    global cachePath, databasePath, cacheDir, globalDir, lockPath, initialized, knownBytes, memorySize
+    connection = getattr(local, 'connection', None)
+    if connection is not None:
+        connection.close()
+        local.connection = None
+    cachePath = path
+    databasePath = os.path.join(path, 'cache.sqlite3')
+    cacheDir = os.path.join(path, 'cache')
+    globalDir = os.path.join(path, 'paragraphs')
+    lockPath = os.path.join(path, 'cache.lock')
+    initialized = False
+    knownBytes = None
+    with lock:
+        for state in (pendingParagraphs, pendingGlobal, pendingAccess, pendingStats, memory):
+            state.clear()
+        memorySize = 0
 
 
 def deterministic_hash(obj):
@@ -22,68 +92,308 @@ def deterministic_hash(obj):
     return hashObject.hexdigest()[0:20]
 
 
-def get_dirs():
-    dirs = [os.path.join(cacheDir, dir) for dir in os.listdir(cacheDir) if os.path.isdir(os.path.join(cacheDir, dir))]
-    return dirs
+@contextlib.contextmanager
+def locked():
+    with open(lockPath, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
 
+def connect():
+    '''
+    The connection of the thread. Several processes share the database: a writer waits up to 30s for the others,
+    every write transaction takes the write lock when it begins, and a reader sees the last committed transaction,
+    never a part of one.
+    '''
+    global initialized
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        os.makedirs(cachePath, exist_ok=True)  # by the first of the processes which start together
+        connection = sqlite3.connect(databasePath, timeout=30, isolation_level=None)
+        with writeLock:
+            if not initialized:
+                with locked():
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.executescript(schema)
+                    upgrade(connection)
+                    connection.execute(globalIndex)
+                    migrate(connection)
+                initialized = True
+        connection.execute('PRAGMA synchronous=NORMAL')
+        local.connection = connection
+    return connection
 
-def get_time(dir):
-    try:
-        timeFile = os.path.join(dir, timeFilename)
-        t = float(open(timeFile, encoding='utf-8').read())
-        return t
-    except FileNotFoundError:
-        # handle the error as needed, for now we'll just return a default value
-        return float('inf')  # This ensures that this directory will be the first to be removed if required
 
+def upgrade(connection):
+    # the database of the previous version has no sizes nor access times
+    if 'size' in [row[1] for row in connection.execute('PRAGMA table_info(documents)')]:
+        return
+    connection.execute('BEGIN IMMEDIATE')
+    connection.execute('ALTER TABLE documents ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+    connection.execute('ALTER TABLE global_paragraphs ADD COLUMN update_time REAL NOT NULL DEFAULT 0')
+    connection.execute('ALTER TABLE global_paragraphs ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+    connection.execute('UPDATE global_paragraphs SET size = LENGTH(CAST(translation AS BLOB))')
+    connection.execute(documentSize)
+    connection.execute('COMMIT')
 
-def write_time(dir):
-    timeFile = os.path.join(dir, timeFilename)
-    t = time.time()
-    print(t, file=open(timeFile, "w", encoding='utf-8'), end='')
 
+def migrate(connection):
+    # the directories of the old layout are moved into the database, then removed
+    if os.path.isdir(cacheDir):
+        connection.execute('BEGIN IMMEDIATE')
+        for name in os.listdir(cacheDir):
+            dir = os.path.join(cacheDir, name)
+            if not os.path.isdir(dir):
+                continue
+            try:
+                t = float(open(os.path.join(dir, timeFilename), encoding='utf-8').read())
+            except (OSError, ValueError):
+                t = 0
+            connection.execute('INSERT OR IGNORE INTO documents (hash, update_time) VALUES (?, ?)', (name, t))
+            for filename in os.listdir(dir):
+                if filename != timeFilename:
+                    connection.execute('INSERT OR IGNORE INTO paragraphs VALUES (?, ?, ?)', (name, filename, open(os.path.join(dir, filename), encoding='utf-8').read()))
+        connection.execute(documentSize)
+        connection.execute('COMMIT')
+        shutil.rmtree(cacheDir)
+    if os.path.isdir(globalDir):
+        connection.execute('BEGIN IMMEDIATE')
+        for root, dirs, files in os.walk(globalDir):
+            for filename in files:
+                paragraph = open(os.path.join(root, filename), encoding='utf-8').read()
+                connection.execute('INSERT OR IGNORE INTO global_paragraphs VALUES (?, ?, ?, ?)', (filename, paragraph, 0, len(paragraph.encode())))
+        connection.execute('COMMIT')
+        shutil.rmtree(globalDir)
 
-def argmin(iterable):
-    return min(enumerate(iterable), key=lambda x: x[1])[0]
 
+def flush(durable=False):
+    '''
+    The pending paragraphs, accesses and stats are written in one transaction. With durable, at the end of a run,
+    the log is checkpointed into the database, which is synced, so that the translations survive a crash of the machine.
+    The cache is evicted as soon as the writes may have taken it beyond maxBytes, not only when a document starts.
+    '''
+    global knownBytes
+    written = write_pending(durable)
+    with lock:
+        if knownBytes is not None:
+            knownBytes += written
+        full = (written > 0 or durable) and (knownBytes is None or knownBytes > maxBytes)
+    if full:
+        remove_extra()
 
-def remove_extra():
-    dirs = get_dirs()
-    for dir in dirs:
-        if not os.path.isdir(dir):  # This line might be redundant now, as get_dirs() ensures only directories are returned
-            os.remove(dir)
+
+def write_pending(durable=False):
+    '''
+    Returns the bytes of the paragraphs written. The batch is taken from the pending writes under the lock and
+    written outside it, so the readers do not wait while the transaction waits for the write lock of another process.
+    If the transaction fails, the batch is pending again, behind the writes made meanwhile.
+    '''
+    global writingParagraphs, writingGlobal
+    connection = connect()
+    with writeLock:
+        with lock:
+            writingParagraphs, writingGlobal = dict(pendingParagraphs), dict(pendingGlobal)
+            accesses = [(t, key) for key, t in pendingAccess.items()]
+            stats = list(pendingStats.items())
+            pendingParagraphs.clear()
+            pendingGlobal.clear()
+            pendingAccess.clear()
+            pendingStats.clear()
+        paragraphs = [(document, hash, translation) for (document, hash), translation in writingParagraphs.items()]
+        now = time.time()
+        documents = [(document, ) for document in {document for document, hash in writingParagraphs}]
+        globalParagraphs = [(key, translation, now, len(translation.encode())) for key, translation in writingGlobal.items()]
         try:
-            get_time(dir)
+            if paragraphs or globalParagraphs or accesses or stats:
+                write(connection, now, documents, paragraphs, globalParagraphs, accesses, stats)
         except BaseException:
-            shutil.rmtree(dir)
-    while True:
-        dirs = get_dirs()
-        if len(dirs) <= maxCache:
-            break
-        times = [get_time(dir) for dir in dirs]
-        arg = argmin(times)
-        shutil.rmtree(dirs[arg])
+            with lock:
+                for key, translation in writingParagraphs.items():
+                    pendingParagraphs.setdefault(key, translation)
+                for key, translation in writingGlobal.items():
+                    pendingGlobal.setdefault(key, translation)
+                for t, key in accesses:
+                    pendingAccess[key] = max(t, pendingAccess.get(key, 0))
+                for name, n in stats:
+                    pendingStats[name] = pendingStats.get(name, 0) + n
+            raise
+        finally:
+            with lock:
+                writingParagraphs, writingGlobal = {}, {}
+        if durable:
+            connection.execute('PRAGMA wal_checkpoint(FULL)')
+    return sum(len(translation.encode()) for document, hash, translation in paragraphs) + sum(size for key, translation, t, size in globalParagraphs)
+
+
+def write(connection, now, documents, paragraphs, globalParagraphs, accesses, stats):
+    # one transaction
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        # the document is used, and added again if another process has evicted it meanwhile
+        connection.executemany('INSERT INTO documents (hash, update_time) VALUES (?, ?) ON CONFLICT (hash) DO UPDATE SET update_time = excluded.update_time',
+                               [(document, now) for document, in documents])
+        connection.executemany('INSERT OR REPLACE INTO paragraphs VALUES (?, ?, ?)', paragraphs)
+        connection.executemany(documentSize + ' WHERE hash = ?', documents)
+        connection.executemany('INSERT OR REPLACE INTO global_paragraphs VALUES (?, ?, ?, ?)', globalParagraphs)
+        connection.executemany('UPDATE global_paragraphs SET update_time = MAX(update_time, ?) WHERE key = ?', accesses)
+        connection.executemany('INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', stats)
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def count(name, n=1):
+    # stats kept across the runs, written with the next flush
+    with lock:
+        pendingStats[name] = pendingStats.get(name, 0) + n
+
+
+def remove_extra(keep=()):
+    '''
+    The least recently used documents, with their paragraphs, and global paragraphs are removed until the cache
+    fits in maxBytes, in one transaction. The victims are read in the order of the update_time indexes,
+    which are merged, so each one costs O(log n). The documents of keep and of inUse are never removed.
+    Like write_pending, it does not hold the lock of the readers while it waits for the database.
+    '''
+    global memorySize, knownBytes
+    write_pending()
+    connection = connect()
+    with lock:
+        protected = set(keep) | inUse
+    with writeLock, locked():
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            total = total_size(connection)
+            documents, globalKeys, removed = [], [], 0
+            if total > maxBytes:
+                oldDocuments = ((t, 0, hash, size) for hash, t, size in connection.execute('SELECT hash, update_time, size FROM documents ORDER BY update_time'))
+                oldGlobal = ((t, 1, key, size) for key, t, size in connection.execute('SELECT key, update_time, size FROM global_paragraphs ORDER BY update_time'))
+                for t, isGlobal, key, size in heapq.merge(oldDocuments, oldGlobal):
+                    if total - removed <= maxBytes:
+                        break
+                    if not isGlobal and key in protected:
+                        continue
+                    (globalKeys if isGlobal else documents).append((key, ))
+                    removed += size
+            connection.executemany('DELETE FROM paragraphs WHERE document = ?', documents)
+            connection.executemany('DELETE FROM documents WHERE hash = ?', documents)
+            connection.executemany('DELETE FROM global_paragraphs WHERE key = ?', globalKeys)
+            connection.executemany('INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                                   [('evicted documents', len(documents)), ('evicted paragraphs', len(globalKeys)), ('evicted bytes', removed)])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    with lock:
+        knownBytes = total - removed
+        if documents or globalKeys:
+            memory.clear()
+            memorySize = 0
+
+
+def total_size(connection):
+    return connection.execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM documents) + (SELECT COALESCE(SUM(size), 0) FROM global_paragraphs)').fetchone()[0]
+
+
+def stats():
+    # what --cache-stats prints
+    flush()
+    connection = connect()
+    counters = dict(connection.execute('SELECT name, value FROM stats'))
+    hits = counters.get('paragraph cache hits', 0)
+    lookups = hits + counters.get('paragraph cache misses', 0)
+    return {
+        'path': databasePath,
+        'documents': connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0],
+        'global paragraphs': connection.execute('SELECT COUNT(*) FROM global_paragraphs').fetchone()[0],
+        'bytes': total_size(connection),
+        'budget': maxBytes,
+        'hit ratio': hits / lookups if lookups else None,
+        'global hit ratio': counters.get('global cache hits', 0) / lookups if lookups else None,
+        **{name: int(value) for name, value in counters.items()},
+    }
+
+
+def remember(key, paragraph):
+    # called with the lock, the least recently used paragraphs are dropped beyond memoryBytes
+    global memorySize
+    if key in memory:
+        memorySize -= len(memory[key])
+    memory[key] = paragraph
+    memory.move_to_end(key)
+    memorySize += len(paragraph)
+    while memorySize > memoryBytes and memory:
+        memorySize -= len(memory.popitem(last=False)[1])
+
+
+def recall(key, access):
+    # the paragraph in memory, in the pending writes or in the batch being written, None if in none
+    with lock:
+        paragraph = memory.get(key)
+        if paragraph is None:
+            paragraph = pendingGlobal.get(key, writingGlobal.get(key)) if access else pendingParagraphs.get(key, writingParagraphs.get(key))
+        else:
+            memory.move_to_end(key)
+        if paragraph is not None:
+            metrics.count('cache memory hits')
+            if access:
+                pendingAccess[key] = time.time()
+        return paragraph
+
+
+def load(key, query, parameters, access=False):
+    # the memory tier, then the database, whose paragraph is kept in memory
+    paragraph = recall(key, access)
+    if paragraph is not None:
+        return paragraph
+    row = connect().execute(query, parameters).fetchone()
+    metrics.count('cache disk misses' if row is None else 'cache disk hits')
+    if row is None:
+        return None
+    with lock:
+        remember(key, row[0])
+        if access:
+            pendingAccess[key] = time.time()
+    return row[0]
 
 
 def is_cached(hashKey):
-    dir = os.path.join(cacheDir, hashKey)
-    return os.path.exists(dir)
+    return connect().execute('SELECT 1 FROM documents WHERE hash = ?', (hashKey, )).fetchone() is not None
 
 
 def create_cache(hashKey):
-    dir = os.path.join(cacheDir, hashKey)
-    os.makedirs(dir, exist_ok=True)
-    write_time(dir)
+    # the document is accessed now, its paragraphs and size are kept
+    connect().execute('INSERT INTO documents (hash, update_time) VALUES (?, ?) ON CONFLICT (hash) DO UPDATE SET update_time = excluded.update_time', (hashKey, time.time()))
 
 
 def load_paragraph(hashKey, hashKeyParagraph):
-    filename = os.path.join(cacheDir, hashKey, hashKeyParagraph)
-    if os.path.exists(filename):
-        return open(filename, encoding='utf-8').read()
-    else:
-        return None
+    return load((hashKey, hashKeyParagraph), 'SELECT translation FROM paragraphs WHERE document = ? AND hash = ?', (hashKey, hashKeyParagraph))
 
 
 def write_paragraph(hashKey, hashKeyParagraph, paragraph):
-    filename = os.path.join(cacheDir, hashKey, hashKeyParagraph)
-    print(paragraph, file=open(filename, "w", encoding='utf-8'), end='')
\ No newline at end of file
+    # written behind, in a batch with the next ones
+    with lock:
+        pendingParagraphs[(hashKey, hashKeyParagraph)] = paragraph
+        remember((hashKey, hashKeyParagraph), paragraph)
+        full = len(pendingParagraphs) + len(pendingGlobal) >= batchSize
+    if full:
+        flush()
+
+
+def load_global_paragraph(key):
+    return load(key, 'SELECT translation FROM global_paragraphs WHERE key = ?', (key, ), access=True)
+
+
+def write_global_paragraph(key, paragraph):
+    with lock:
+        pendingGlobal[key] = paragraph
+        remember(key, paragraph)
+        full = len(pendingParagraphs) + len(pendingGlobal) >= batchSize
+    if full:
+        flush()
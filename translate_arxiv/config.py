@@ -2,8 +2,7 @@ import os
 from cache import cache_dir
 
 
-defaultDir = os.path.join(cache_dir(), 'default')
-os.makedirs(defaultDir, exist_ok=True)
+defaultDir = os.path.join(cache_dir(), 'default')  # created by set_variable
 
 
 class Config:
@@ -27,8 +26,27 @@ class Config:
 
     math_code = 'XMATHX'
     log_file = f'{cache_dir()}/translate_log'
+    report_file = f'{cache_dir()}/translate_report.json'  # timings and counters of the last run, empty means no report
     raw_mularg_command_list = [('textcolor', 2, (1, ))]
     mularg_command_list = [('textcolor', 2, (1, ))]
+    google_url = 'http://translate.google.com/m'
+    requests_per_second = 0  # 0 means no limit, as before the rate limits, e.g. -rate 10 to opt in
+    chars_per_second = 0  # 0 means no limit
+    max_in_flight = 16  # upper bound of the adaptive concurrency
+    min_in_flight = 1
+    initial_in_flight = 4
+    adaptive_concurrency = True  # False keeps max_in_flight requests in flight
+    max_retries = 8  # retries of a request which is rate limited
+    request_timeout = 60
+    mock_latency = 0.2  # seconds for each request of the mock engine
+    mock_char_cost = 0.0001  # additional seconds for each character of the mock engine
+    processes = 0  # processes for parsing and recovery, 0 means one per core, 1 means no process pool
+    stream = False  # write the paragraphs to the output as they are translated, with checkpoints to resume
+    checkpoint_interval = 2  # seconds between two checkpoints of the streamed output
+    stream_dir = f'{cache_dir()}/stream'  # the streamed outputs and their checkpoints until they are complete
+    reorder_window = 64  # paragraphs translated ahead of the next one to write
+    pipeline_queue_size = 64  # paragraphs waiting between two stages of the pipeline
+    regex_timeout = 5  # seconds for each regex search in process_latex, a linear fallback is used beyond, 0 means no limit
 
     def __init__(self):
         self.load()
@@ -49,10 +67,12 @@ class Config:
     def set_variable(path, default):
         var = input().replace(' ', '').replace('\n', '')
         if var != '':
+            os.makedirs(defaultDir, exist_ok=True)
             print(var, file=open(f'{defaultDir}/{path}', 'w'))
 
     @staticmethod
     def set_variable_4ui(path, var):
+        os.makedirs(defaultDir, exist_ok=True)
         print(var, file=open(f'{defaultDir}/{path}', 'w'))
 
     def load(self):
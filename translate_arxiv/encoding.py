@@ -1,25 +1,66 @@
+import os
+import codecs
 import charset_normalizer
 
 
 force_utf8 = False
+chunkSize = 1 << 16  # bytes of each sample of a large file for charset detection
+nChunks = 8  # files larger than chunkSize * nChunks are sampled
+encodingCache = {}  # (path, size, mtime): encoding
+
+
+def is_utf8(filename):
+    # strict utf-8 decoding, which also covers ascii, read by chunks so memory is bounded
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            try:
+                decoder.decode(chunk, final=(len(chunk) == 0))
+            except UnicodeDecodeError:
+                return False
+            if len(chunk) == 0:
+                return True
+
+
+def read_samples(filename, size):
+    # the whole file if it is small, otherwise nChunks chunks spread over the file
+    with open(filename, "rb") as f:
+        if size <= chunkSize * nChunks:
+            return f.read()
+        samples = []
+        for i in range(nChunks):
+            f.seek((size - chunkSize) * i // (nChunks - 1))
+            samples.append(f.read(chunkSize))
+        return b''.join(samples)
+
+
+def detect_encoding(filename, size):
+    if is_utf8(filename):
+        # the BOM is not part of the text
+        with open(filename, "rb") as f:
+            return 'utf-8-sig' if f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 'utf-8'
+    result = charset_normalizer.detect(read_samples(filename, size))
+    currentEncoding = result["encoding"]
+    if result['confidence'] is None or result['confidence'] < 0.9:
+        print(f'file {filename} may have wrong encoding')
+    return currentEncoding
 
 
 def get_file_encoding(filename):
     """
     This function takes a filename as input and returns the encoding of the file.
-    The function reads the file in binary mode, detects the encoding using charset_normalizer library,
-    and returns the detected encoding as a string.
+    A file that decodes as strict utf-8 (or ascii) is utf-8, otherwise the encoding is detected
+    using charset_normalizer library on samples of the file.
+    The result is cached by (path, size, mtime), so each file is detected once.
 
     :param filename: A string representing the path of the file to be read
     :return: A string representing the encoding of the file
     """
     if force_utf8:
         return 'utf-8'
-    else:
-        with open(filename, "rb") as f:
-            data = f.read()
-            result = charset_normalizer.detect(data)
-            currentEncoding = result["encoding"]
-            if result['confidence'] < 0.9:
-                print(f'file {filename} may have wrong encoding')
-        return currentEncoding
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in encodingCache:
+        encodingCache[key] = detect_encoding(filename, stat.st_size)
+    return encodingCache[key]
@@ -0,0 +1,451 @@
+'''
+Translation engines. All the requests of a run go through one asyncio event loop, so the paragraphs translated
+by different threads share one view of the rate limit of the provider:
+a token bucket for requests per second, another one for characters per second, a bound on the requests in flight,
+and an exponential backoff with jitter which makes every request wait after the provider answers 429.
+'''
+import re
+import abc
+import html
+import time
+import random
+import collections
+import asyncio
+import threading
+import concurrent.futures
+import http.client
+import urllib.error
+import urllib.parse
+from config import config
+from metrics import metrics
+import process_text
+from process_text import charLimit
+
+
+agent = {'User-Agent': 'Mozilla/4.0 (compatible;MSIE 6.0;Windows NT 5.1;SV1;.NET CLR 1.1.4322;.NET CLR 2.0.50727;.NET CLR 3.0.04506.30)'}
+patternResult = re.compile(r'class="(?:t0|result-container)">(.*?)<', re.DOTALL)
+rateLimitCodes = (429, 503)
+redirectCodes = (301, 302, 303, 307, 308)
+maxRedirects = 3
+
+
+class RateLimitError(Exception):
+    # the provider asks to slow down, retryAfter is the delay it asks for in seconds, if any
+    def __init__(self, message, retryAfter=None):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class TokenBucket:
+    '''
+    rate tokens are added every second, up to capacity, which is the largest burst. acquire waits until there are
+    enough tokens, the waiting requests are served in order. A rate <= 0 means no limit.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.time = time.monotonic()
+        self.lock = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    async def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # a request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            if self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= amount
+
+
+class Backoff:
+    '''
+    Exponential backoff with jitter shared by all requests. After a rate limit error, every request waits
+    until the end of the backoff. The delay doubles with each error, errors of the requests that were
+    already in flight during a backoff do not count again, and a success resets it.
+    '''
+    def __init__(self, base=0.5, maximum=30):
+        self.base = base
+        self.maximum = maximum
+        self.errors = 0
+        self.until = 0
+
+    async def wait(self):
+        while True:
+            remaining = self.until - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def fail(self, retryAfter=None):
+        now = time.monotonic()
+        if now < self.until:
+            return
+        self.errors += 1
+        delay = min(self.maximum, self.base * 2 ** (self.errors - 1))
+        delay = random.uniform(delay / 2, delay)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        self.until = now + delay
+
+    def succeed(self):
+        self.errors = 0
+
+
+class AdaptiveLimit:
+    '''
+    The bound on the requests in flight, adapted like the window of TCP (AIMD): it grows by one for each
+    window of successful requests while the latency stays healthy, it is halved after a rate limit error
+    and cut by a quarter when the p90 latency of the last window is above latencyFactor times the lowest one
+    of the recent windows, i.e. when the provider queues the requests instead of serving them.
+    The requests which were in flight when it decreased saw the same conditions, so their errors do not
+    decrease it again. With adaptive=False it stays at maximum, as a plain semaphore.
+    '''
+    def __init__(self, initial, minimum=1, maximum=16, adaptive=True, latencyFactor=2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.latencyFactor = latencyFactor
+        self.level = float(min(max(initial, minimum), maximum) if adaptive else maximum)
+        self.lowest = self.highest = int(self.level)
+        self.inFlight = 0
+        self.condition = None
+        self.latencies = []  # of the current window
+        self.windowLatencies = collections.deque(maxlen=20)  # p90 latency of the recent windows
+        self.decreasedAt = 0
+        self.decreases = 0
+        self.increases = 0
+
+    def current(self):
+        return int(self.level)
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.inFlight < self.current())
+            self.inFlight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.inFlight -= 1
+            self.condition.notify_all()
+
+    def set_level(self, level):
+        self.level = min(max(level, self.minimum), self.maximum)
+        self.lowest = min(self.lowest, self.current())
+        self.highest = max(self.highest, self.current())
+
+    def decrease(self, factor, sent):
+        if sent < self.decreasedAt:
+            return
+        self.decreasedAt = time.monotonic()
+        self.decreases += 1
+        self.latencies = []
+        self.set_level(self.level * factor)
+
+    def succeed(self, latency, sent):
+        if not self.adaptive:
+            return
+        self.latencies.append(latency)
+        if len(self.latencies) >= max(8, self.current()):
+            latencies = sorted(self.latencies)
+            tail = latencies[int(0.9 * len(latencies))]
+            self.latencies = []
+            baseLatency = min(self.windowLatencies, default=tail)
+            self.windowLatencies.append(tail)
+            if tail > self.latencyFactor * baseLatency:
+                self.decrease(0.75, sent)
+                return
+        if self.current() < self.maximum:
+            level = self.level
+            self.set_level(self.level + 1 / self.level)
+            if self.current() > int(level):
+                self.increases += 1
+
+    def fail(self, sent):
+        # the provider asked to slow down
+        if self.adaptive:
+            self.decrease(0.5, sent)
+
+    def report(self):
+        return f'concurrency {self.current()} (from {self.lowest} to {self.highest}, {self.increases} increases, {self.decreases} decreases)'
+
+
+class AsyncEngine(abc.ABC):
+    '''
+    Base class of the engines. Subclasses implement `async request(text, languageTo, languageFrom)`,
+    which raises RateLimitError when the provider asks to slow down. An engine that can translate several texts
+    in one request natively also overrides `request_batch`.
+    translate and translate_batch can be called from any thread, the requests run in the event loop
+    of the engine, which is started by the first call and stopped by close().
+    '''
+    def __init__(self, requestsPerSecond=None, charsPerSecond=None, maxInFlight=None, maxRetries=None, adaptive=None):
+        self.requestsPerSecond = config.requests_per_second if requestsPerSecond is None else requestsPerSecond
+        self.charsPerSecond = config.chars_per_second if charsPerSecond is None else charsPerSecond
+        self.maxInFlight = config.max_in_flight if maxInFlight is None else maxInFlight
+        self.maxRetries = config.max_retries if maxRetries is None else maxRetries
+        self.limit = AdaptiveLimit(config.initial_in_flight, config.min_in_flight, self.maxInFlight,
+                                   config.adaptive_concurrency if adaptive is None else adaptive)
+        self.requestBucket = TokenBucket(self.requestsPerSecond)
+        # one request of the longest text can always go
+        self.charBucket = TokenBucket(self.charsPerSecond, charLimit)
+        self.backoff = Backoff()
+        self.loop = None
+        self.thread = None
+        self.startLock = threading.Lock()
+        self.requests = 0
+        self.rateLimited = 0
+        self.waitTime = 0
+
+    def start(self):
+        with self.startLock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                # the blocking requests run in these threads
+                self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=self.maxInFlight))
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def close(self):
+        with self.startLock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.cancel(), self.loop).result()
+            asyncio.run_coroutine_threadsafe(self.loop.shutdown_default_executor(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            # the asyncio objects belong to the loop, they are created again in the next one
+            self.limit.condition = None
+            self.requestBucket.lock = None
+            self.charBucket.lock = None
+
+    @staticmethod
+    async def cancel():
+        # the requests still waiting, e.g. after Ctrl-C, so that the threads waiting for them are released
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @abc.abstractmethod
+    async def request(self, text, languageTo, languageFrom):
+        # the translation of text
+        pass
+
+    async def request_batch(self, texts, languageTo, languageFrom):
+        # the texts in one request, separated by delimiter lines; None if the delimiters are lost in the translation
+        translated = await self.request(process_text.join_batch(texts), languageTo, languageFrom)
+        return process_text.split_batch(translated, texts)
+
+    async def send(self, request, chars):
+        # runs request() within the rate limits and the adaptive bound on the requests in flight, it is retried after a rate limit error
+        for attempt in range(self.maxRetries + 1):
+            start = time.monotonic()
+            await self.backoff.wait()
+            await self.requestBucket.acquire()
+            await self.charBucket.acquire(chars)
+            await self.limit.acquire()
+            try:
+                await self.backoff.wait()
+                sent = time.monotonic()
+                self.waitTime += sent - start
+                metrics.observe('rate limit wait', sent - start)
+                self.requests += 1
+                try:
+                    result = await request()
+                except RateLimitError as e:
+                    self.rateLimited += 1
+                    metrics.count('rate limited')
+                    self.backoff.fail(e.retryAfter)
+                    self.limit.fail(sent)
+                    if attempt == self.maxRetries:
+                        raise
+                    metrics.count('retries')
+                    continue
+                finally:
+                    metrics.observe('request latency', time.monotonic() - sent)
+            finally:
+                await self.limit.release()
+            self.limit.succeed(time.monotonic() - sent, sent)
+            self.backoff.succeed()
+            return result
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start()).result()
+
+    def translate(self, text, languageTo, languageFrom):
+        return self.run(self.send(lambda: self.request(text, languageTo, languageFrom), len(text)))
+
+    def translate_batch(self, texts, languageTo, languageFrom):
+        # the translations of texts, or None if they cannot be separated
+        return self.run(self.send(lambda: self.request_batch(texts, languageTo, languageFrom), sum(len(text) for text in texts)))
+
+    def report(self):
+        return f'{self.requests} requests, {self.rateLimited} rate limited, {self.waitTime:.1f}s waited in total for the rate limit, {self.limit.report()}'
+
+
+class ConnectionPool:
+    '''
+    Keep-alive HTTP connections to one server, so that the requests do not pay a TCP and TLS handshake each.
+    At most size idle connections are kept, the engine sets it to its largest concurrency. A reused connection
+    may have been closed by the server while it was idle, the request is then sent again on a new one.
+    '''
+    def __init__(self, url, size, timeout=None):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = config.request_timeout if timeout is None else timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.requests = 0
+
+    def acquire(self):
+        # a connection, and whether it was used before
+        with self.lock:
+            self.requests += 1
+            if self.idle:
+                self.reused += 1
+                metrics.count('connections reused')
+                return self.idle.pop(), True
+            self.created += 1
+        metrics.count('connections opened')
+        connectionClass = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connectionClass(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, target, headers):
+        # status, headers and body of GET target, e.g. /m?q=xxx
+        while True:
+            connection, reused = self.acquire()
+            try:
+                connection.request('GET', target, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(connection)
+            return response.status, response.headers, body
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def report(self):
+        return f'{self.requests} requests on {self.created} connections ({self.reused} reused)'
+
+
+class GoogleEngine(AsyncEngine):
+    '''
+    The mobile page of google translate, as in mtranslate, through a pool of keep-alive connections.
+    url can point to another server with the same interface, e.g. benchmarks/stub_translator.py.
+    '''
+    def __init__(self, url=None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = config.google_url if url is None else url
+        self.pool = ConnectionPool(self.url, self.maxInFlight)
+
+    def fetch(self, text, languageTo, languageFrom):
+        query = urllib.parse.urlencode({'tl': languageTo, 'sl': languageFrom, 'q': text})
+        pool = self.pool
+        for redirect in range(maxRedirects + 1):
+            url = urllib.parse.urlsplit(pool.url)
+            status, headers, body = pool.get(f'{url.path or "/"}?{query}', agent)
+            location = headers.get('Location')
+            if status not in redirectCodes or location is None:
+                break
+            # e.g. http to https, the next requests go directly to the new location
+            location = urllib.parse.urljoin(pool.url, location).split('?')[0]
+            pool = self.move(pool, location)
+        if status in rateLimitCodes:
+            retryAfter = headers.get('Retry-After')
+            raise RateLimitError(f'HTTP {status}', float(retryAfter) if retryAfter and retryAfter.isdigit() else None)
+        if status != 200:
+            raise urllib.error.HTTPError(pool.url, status, f'HTTP {status}', headers, None)
+        results = patternResult.findall(body.decode('utf-8'))
+        if len(results) == 0:
+            return ''
+        return html.unescape(results[0])
+
+    def move(self, pool, url):
+        # the pool of url, which replaces pool
+        with self.startLock:
+            if self.pool is pool:
+                self.url = url
+                self.pool = ConnectionPool(url, self.maxInFlight)
+                pool.close()
+            return self.pool
+
+    async def request(self, text, languageTo, languageFrom):
+        return await asyncio.get_running_loop().run_in_executor(None, self.fetch, text, languageTo, languageFrom)
+
+    def close(self):
+        super().close()
+        self.pool.close()
+
+    def report(self):
+        return f'{super().report()}, {self.pool.report()}'
+
+
+def mock_translate(text):
+    return re.sub(r'\b([a-z]+)\b', lambda match: match.group(1).upper(), text)
+
+
+class MockEngine(AsyncEngine):
+    '''
+    A deterministic engine without network: the words are upper-cased, after latency + charCost * len(text) seconds.
+    For benchmarks and load tests of the whole pipeline, e.g. -engine mock -rate 0.
+    '''
+    def __init__(self, latency=None, charCost=None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = config.mock_latency if latency is None else latency
+        self.charCost = config.mock_char_cost if charCost is None else charCost
+
+    async def request(self, text, languageTo, languageFrom):
+        await asyncio.sleep(self.latency + self.charCost * len(text))
+        return mock_translate(text)
+
+
+# name: engine class, the names are the values of -engine
+engineClasses = {
+    'google': GoogleEngine,
+    'mock': MockEngine,
+}
+
+
+def create_engine(name, **kwargs):
+    if name not in engineClasses:
+        raise ValueError(f'unknown engine {name}, the engines are {", ".join(engineClasses)}')
+    return engineClasses[name](**kwargs)
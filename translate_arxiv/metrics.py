@@ -0,0 +1,189 @@
+'''
+Timings and counters of the translation of a document, summarized at the end of the run and saved as a JSON report.
+A stage records wall and CPU time of the current thread, excluding the stages nested in it, so the stages add up
+and tell whether the time goes to the regexes or to the translation requests. The times of a stage are summed over
+the threads and the processes which run it.
+'''
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+
+# upper bounds of the buckets of the histograms, in seconds
+latencyBounds = [0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+
+class Histogram:
+    def __init__(self, bounds=latencyBounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.values = []
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.values.append(value)
+
+    def merge(self, values):
+        for value in values:
+            self.add(value)
+
+    def percentile(self, q):
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def to_dict(self):
+        if not self.values:
+            return {'count': 0}
+        buckets = {f'<={bound:g}s': count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f'>{self.bounds[-1]:g}s'] = self.counts[-1]
+        return {
+            'count': len(self.values),
+            'mean': sum(self.values) / len(self.values),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': max(self.values),
+            'buckets': buckets,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reports = []  # the reports of the documents translated before
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.stages = {}  # name: [wall, cpu, calls]
+            self.histograms = {}  # name: Histogram
+            self.counters = {}  # name: number
+            self.values = {}  # name: value, e.g. the elapsed time of a phase
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # the nested stages of the same thread add their times to children, which are not counted here
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        children = [0, 0]
+        stack.append(children)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self.add_stage(name, wall - children[0], cpu - children[1])
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += calls
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def take(self):
+        # the records of a process of the pipeline since the last call, they are merged in the main process
+        with self.lock:
+            records = (self.stages, {name: histogram.values for name, histogram in self.histograms.items()}, self.counters)
+        self.reset()
+        return records
+
+    def merge(self, records):
+        stages, histograms, counters = records
+        for name, (wall, cpu, calls) in stages.items():
+            self.add_stage(name, wall, cpu, calls)
+        with self.lock:
+            for name, values in histograms.items():
+                self.histograms.setdefault(name, Histogram()).merge(values)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def ratio(self, hits, misses):
+        total = self.counters.get(hits, 0) + self.counters.get(misses, 0)
+        return self.counters.get(hits, 0) / total if total else None
+
+    def report(self, **info):
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            chars = self.counters.get('chars translated', 0)
+            translationTime = self.values.get('paragraphs elapsed') or elapsed
+            report = dict(info)
+            report.update({
+                'elapsed': elapsed,
+                'stages': {name: {'wall': wall, 'cpu': cpu, 'calls': calls} for name, (wall, cpu, calls) in self.stages.items()},
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'values': dict(self.values),
+                'chars_per_second': chars / translationTime if translationTime > 0 else None,
+            })
+        report['paragraph_cache_hit_ratio'] = self.ratio('paragraph cache hits', 'paragraph cache misses')
+        report['global_cache_hit_ratio'] = self.ratio('global cache hits', 'paragraph cache misses')
+        report['memo_hit_ratio'] = self.ratio('memo hits', 'memo misses')
+        lookups = sum(self.counters.get(name, 0) for name in ('cache memory hits', 'cache disk hits', 'cache disk misses'))
+        report['cache_tiers'] = {'memory': self.counters.get('cache memory hits', 0) / lookups, 'disk': self.counters.get('cache disk hits', 0) / lookups} if lookups else None
+        return report
+
+    def summary(self, report):
+        # a few lines for the end of the run
+        stages = sorted(report['stages'].items(), key=lambda item: -item[1]['wall'])
+        lines = [f'Elapsed {report["elapsed"]:.2f}s, stages (wall/cpu): ' + ', '.join(f'{name} {stage["wall"]:.2f}/{stage["cpu"]:.2f}s' for name, stage in stages)]
+        latency = report['histograms'].get('request latency', {'count': 0})
+        if latency['count']:
+            lines.append(f'Requests: {latency["count"]}, latency p50 {latency["p50"]:.3f}s p90 {latency["p90"]:.3f}s p99 {latency["p99"]:.3f}s, '
+                         f'{report["counters"].get("retries", 0)} retries')
+        concurrency = report['values'].get('concurrency')
+        if concurrency is not None:
+            lines.append(f'Concurrency: {concurrency["final"]} at the end, from {concurrency["lowest"]} to {concurrency["highest"]}, {concurrency["decreases"]} decreases')
+        opened = report['counters'].get('connections opened')
+        if opened:
+            lines.append(f'Connections: {opened} opened, {report["counters"].get("connections reused", 0)} reused')
+        if report['chars_per_second'] is not None:
+            lines.append(f'Throughput: {report["chars_per_second"]:.0f} chars/s')
+        for name in ('queue wait', 'rate limit wait'):
+            wait = report['histograms'].get(name, {'count': 0})
+            if wait['count']:
+                lines.append(f'{name.capitalize()}: mean {wait["mean"]:.3f}s p99 {wait["p99"]:.3f}s')
+        ratios = [f'{name} {report[key]:.0%}' for name, key in (('paragraph cache', 'paragraph_cache_hit_ratio'), ('global cache', 'global_cache_hit_ratio'), ('memo', 'memo_hit_ratio')) if report[key] is not None]
+        if ratios:
+            lines.append('Hit ratio: ' + ', '.join(ratios))
+        if report['cache_tiers'] is not None:
+            lines.append(f'Cache tiers: memory {report["cache_tiers"]["memory"]:.0%}, disk {report["cache_tiers"]["disk"]:.0%} of {sum(report["counters"].get(name, 0) for name in ("cache memory hits", "cache disk hits", "cache disk misses"))} lookups')
+        return '\n'.join(lines)
+
+    def save(self, report, path):
+        # the reports of all the documents of the run are kept in the file, which is replaced at once
+        self.reports.append(report)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporaryPath = f'{path}.{os.getpid()}.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as f:
+            json.dump(self.reports, f, indent=2)
+        os.replace(temporaryPath, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,253 @@
+import re
+from process_latex import asciiLetters
+
+
+patternSpecial = re.compile(r'[\\{}$]')
+patternEnvName = re.compile(r'[ \t]*\{([^{}]*)\}')
+patternSpaces = re.compile(r'[ \t]*')
+
+
+class Node:
+    '''
+    A piece of a LaTeX document, `latex[start:end]`.
+    kind:
+        'text': normal text
+        'math': $ $, $$ $$, \\( \\) and \\[ \\], the content is not parsed
+        'command': \\name[options]{arg1}{arg2}..., children are the arguments (brace nodes), options is the span of [options]
+        'env': \\begin{name}[options] content \\end{name}, children are the content
+        'brace': { content }, children are the content
+        'root': the whole document
+    For env, brace and root, the content is latex[contentStart:contentEnd].
+    '''
+    def __init__(self, kind, start, end=None, name=None, parent=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.options = None
+        self.contentStart = None
+        self.contentEnd = None
+        self.nargs = 0  # number of arguments expected by a command
+
+    def __repr__(self):
+        return f'Node({self.kind}, {self.start}, {self.end}, {self.name}, {self.children})'
+
+
+def skip_spaces(latex, pos):
+    return patternSpaces.match(latex, pos).end()
+
+
+def find_options(latex, pos):
+    # [xxx] without nested brackets, returns the end of the options or None
+    if pos >= len(latex) or latex[pos] != '[':
+        return None
+    end = latex.find(']', pos + 1)
+    if end == -1 or '[' in latex[pos + 1:end]:
+        return None
+    return end + 1
+
+
+def stitch(latex, node, renderedChildren):
+    # the source of node with each child replaced by its rendered text
+    pieces = []
+    pos = node.start
+    for child, rendered in zip(node.children, renderedChildren):
+        pieces.append(latex[pos:child.start])
+        pieces.append(rendered)
+        pos = child.end
+    pieces.append(latex[pos:node.end])
+    return ''.join(pieces)
+
+
+class Parser:
+    def __init__(self, latex, commandArgs):
+        self.latex = latex
+        self.commandArgs = commandArgs
+        self.root = Node('root', 0, len(latex))
+        self.root.contentStart = 0
+        self.root.contentEnd = len(latex)
+        self.stack = [self.root]
+        self.textStart = 0
+
+    def add(self, node):
+        container = self.stack[-1]
+        node.parent = container
+        container.children.append(node)
+        return node
+
+    def flush(self, end):
+        # text since the last node
+        if end > self.textStart:
+            self.add(Node('text', self.textStart, end))
+        self.textStart = end
+
+    def open_argument(self, command, pos):
+        arg = Node('brace', pos, parent=command)
+        arg.contentStart = pos + 1
+        command.children.append(arg)
+        self.stack.append(arg)
+        return pos + 1
+
+    def continue_command(self, command, pos):
+        # after an argument, look for the next one
+        if len(command.children) < command.nargs:
+            nextPos = skip_spaces(self.latex, pos)
+            if self.latex.startswith('{', nextPos):
+                return self.open_argument(command, nextPos)
+        command.end = pos
+        return pos
+
+    def unwind(self):
+        # the last frame is not closed: its opening becomes text and its content goes to the outer level
+        node = self.stack.pop()
+        if node.kind == 'brace' and node.parent.kind == 'command':
+            command = node.parent
+            command.children.pop()
+            if command.children:
+                command.end = command.children[-1].end
+            else:
+                command.end = command.nameEnd
+                command.options = None
+            container = command.parent
+            headEnd = command.end
+        else:
+            container = node.parent
+            container.children.pop()
+            if node.kind == 'env':
+                # \begin{xxx} alone is a command with one argument
+                head = Node('command', node.start, node.nameEnd, 'begin', container)
+                container.children.append(head)
+                headEnd = node.nameEnd
+            else:
+                headEnd = node.start
+        if node.contentStart > headEnd:
+            container.children.append(Node('text', headEnd, node.contentStart, parent=container))
+        for child in node.children:
+            child.parent = container
+        container.children.extend(node.children)
+
+    def parse_command(self, pos):
+        # pos is the backslash
+        latex = self.latex
+        nameEnd = pos + 1
+        while nameEnd < len(latex) and latex[nameEnd] in asciiLetters:
+            nameEnd += 1
+        if nameEnd == pos + 1:
+            # \\, \%, \[ ... or a backslash at the end
+            symbol = latex[pos + 1:pos + 2]
+            closing = {'[': '\\]', '(': '\\)'}.get(symbol)
+            if closing is not None:
+                end = latex.find(closing, pos + 2)
+                if end != -1:
+                    self.add(Node('math', pos, end + 2))
+                    return end + 2
+            self.add(Node('command', pos, pos + 1 + len(symbol), symbol))
+            return pos + 1 + len(symbol)
+        if nameEnd < len(latex) and latex[nameEnd] == '*':
+            nameEnd += 1
+        name = latex[pos + 1:nameEnd]
+
+        if name == 'begin':
+            match = patternEnvName.match(latex, nameEnd)
+            if match is not None:
+                env = self.add(Node('env', pos, name=match.group(1)))
+                env.nameEnd = match.end()
+                optionsStart = skip_spaces(latex, match.end())
+                optionsEnd = find_options(latex, optionsStart)
+                if optionsEnd is not None:
+                    env.options = (optionsStart, optionsEnd)
+                env.contentStart = optionsEnd if optionsEnd is not None else match.end()
+                self.stack.append(env)
+                return env.contentStart
+        if name == 'end':
+            match = patternEnvName.match(latex, nameEnd)
+            if match is not None:
+                envName = match.group(1)
+                for depth in range(len(self.stack) - 1, 0, -1):
+                    frame = self.stack[depth]
+                    if frame.kind == 'env' and frame.name == envName:
+                        while len(self.stack) - 1 > depth:
+                            self.unwind()
+                        self.stack.pop()
+                        frame.contentEnd = pos
+                        frame.end = match.end()
+                        return frame.end
+
+        command = self.add(Node('command', pos, nameEnd, name))
+        command.nameEnd = nameEnd
+        if name in self.commandArgs:
+            command.nargs = self.commandArgs[name]
+            argStart = skip_spaces(latex, nameEnd)
+        else:
+            command.nargs = 1
+            argStart = skip_spaces(latex, nameEnd)
+            optionsEnd = find_options(latex, argStart)
+            if optionsEnd is not None:
+                afterOptions = skip_spaces(latex, optionsEnd)
+                if latex.startswith('{', afterOptions):
+                    command.options = (argStart, optionsEnd)
+                    argStart = afterOptions
+        if command.nargs > 0 and latex.startswith('{', argStart):
+            return self.open_argument(command, argStart)
+        return nameEnd
+
+    def parse(self):
+        latex = self.latex
+        pos = 0
+        while True:
+            match = patternSpecial.search(latex, pos)
+            if match is None:
+                break
+            pos = match.start()
+            char = latex[pos]
+            if char == '}':
+                if self.stack[-1].kind != 'brace':
+                    # an unmatched } is kept as text
+                    pos += 1
+                    continue
+                self.flush(pos)
+                node = self.stack.pop()
+                node.contentEnd = pos
+                node.end = pos + 1
+                pos = pos + 1
+                if node.parent.kind == 'command':
+                    pos = self.continue_command(node.parent, pos)
+                self.textStart = pos
+                continue
+            if char == '$':
+                if latex.startswith('$$', pos) and latex.find('$$', pos + 2) != -1:
+                    end = latex.find('$$', pos + 2) + 2
+                else:
+                    end = latex.find('$', pos + 1) + 1
+                if end == 0:
+                    pos += 1
+                    continue
+                self.flush(pos)
+                self.add(Node('math', pos, end))
+            elif char == '{':
+                self.flush(pos)
+                node = self.add(Node('brace', pos))
+                node.contentStart = pos + 1
+                self.stack.append(node)
+                end = pos + 1
+            else:
+                self.flush(pos)
+                end = self.parse_command(pos)
+            pos = self.textStart = end
+        self.flush(len(latex))
+        while len(self.stack) > 1:
+            self.unwind()
+        return self.root
+
+
+def parse_latex(latex, commandArgs=None):
+    '''
+    Parses latex into a tree in one left-to-right scan and returns the root node.
+    Commands take an optional [options] and one {argument}, except the ones in commandArgs,
+    {name: number of arguments}, which take that number of arguments and no options.
+    Unclosed braces and environments are kept as text, so the tree always covers the whole input.
+    '''
+    return Parser(latex, commandArgs or {}).parse()
+
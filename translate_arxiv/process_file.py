@@ -4,32 +4,88 @@ from process_latex import remove_tex_comments
 from encoding import get_file_encoding
 
 
+patternInclude = re.compile(r'\\(input|include|subfile)(?![a-zA-Z@])[ \t]*(?:\{([^{}]*)\}|([^\s{}\\%]+))')  # group 1: command, group 2/3: file name with/without braces
+fileContents = {}  # path: content without comments, so every file is read and decoded once
+
+
+def read_tex(path):
+    if path not in fileContents:
+        encoding = get_file_encoding(path)
+        fileContents[path] = remove_tex_comments(open(path, encoding=encoding).read())
+    return fileContents[path]
+
+
+def get_body(content):
+    # a \subfile is a full document, only its body is included
+    beginCode = r'\begin{document}'
+    beginIndex = content.find(beginCode)
+    endIndex = content.rfind(r'\end{document}')
+    if beginIndex == -1 or endIndex <= beginIndex:
+        return content
+    return content[beginIndex + len(beginCode):endIndex]
+
+
+def resolve_includes(path):
+    '''
+    Replaces \input{xxx}, \input xxx, \include{xxx} and \subfile{xxx} by the content of the files, recursively.
+    Every file is read once and the merged document is assembled in one pass; an include cycle is dropped with a warning.
+    Returns the merged content and the include graph {file: [included files]}.
+    '''
+    dirname = os.path.dirname(path)
+    graph = {}
+    pieces = []
+
+    def visit(filename, chain, body=False):
+        content = read_tex(filename)
+        if body:
+            content = get_body(content)
+        firstVisit = filename not in graph
+        included = graph.setdefault(filename, [])
+        pos = 0
+        for match in patternInclude.finditer(content):
+            command = match.group(1)
+            name = match.group(2)
+            if name is None:
+                if command != 'input':
+                    continue
+                name = match.group(3)
+            includedFile = os.path.join(dirname, name.strip())
+            if os.path.exists(f'{includedFile}.tex'):
+                includedFile = f'{includedFile}.tex'
+            pieces.append(content[pos:match.start()])
+            pos = match.end()
+            if not os.path.isfile(includedFile):
+                # e.g. a file which is not in the source, the command is kept
+                print(f'warning: {includedFile} is not found, {command} is skipped')
+                pieces.append(match.group(0))
+                continue
+            if firstVisit:
+                included.append(includedFile)
+            if includedFile in chain:
+                print('include cycle found:', ' -> '.join(chain + [includedFile]))
+                continue
+            print('merging', includedFile)
+            if command == 'include':
+                pieces.append('\\clearpage\n')
+            visit(includedFile, chain + [includedFile], command == 'subfile')
+            if command == 'include':
+                pieces.append('\n\\clearpage')
+        pieces.append(content[pos:])
+
+    visit(path, [path])
+    return ''.join(pieces), graph
+
+
 def merge_complete(tex):
     '''
-    for replace all \input commands by the file content
+    for replace all \input, \include and \subfile commands by the file content
+    returns the include graph {file: [included files]}
     '''
     path = f'{tex}.tex'
-    dirname = os.path.dirname(path)
-    encoding = get_file_encoding(path)
-    content = open(path, encoding=encoding).read()
-    content = remove_tex_comments(content)
-    patternInput = re.compile(r'\\input{(.*?)}')
-    while True:
-        result = patternInput.search(content)
-        if result is None:
-            break
-        begin, end = result.span()
-        match = result.group(1)
-        filename = os.path.join(dirname, match)
-        if os.path.exists(f'{filename}.tex'):
-            filename = f'{filename}.tex'
-        print('merging', filename)
-        assert os.path.exists(filename)
-        encoding = get_file_encoding(filename)
-        newContent = open(filename, encoding=encoding).read()
-        newContent = remove_tex_comments(newContent)
-        content = content[:begin] + newContent + content[end:]
+    content, graph = resolve_includes(path)
     print(content, file=open(path, "w", encoding='utf-8'))
+    fileContents.pop(path, None)
+    return graph
 
 
 def add_bbl(tex):
@@ -1,5 +1,10 @@
 import re
+import time
 import regex
+import bisect
+import functools
+import string
+import threading
 from config import config
 
 
@@ -8,6 +13,7 @@ testEnvironment = config.test_environment
 
 matchCode = r"(" + mathCode + r"_\d+(?:_\d+)*)"
 matchCodeReplace = mathCode + r"_(\d+(?:_\d+)*)*"
+patternCode = re.compile(matchCode)
 
 #options = r"\[[a-zA-Z\s,\\\*\.\+\-=_{}\(\)\!]*?\]"  # ,\*.+-=_{}!
 options = r"\[[^\[\]]*?\]"
@@ -34,12 +40,26 @@ def get_pattern_command_full(name, n=None):
 
 
 matchCommandName = r'[a-zA-Z]+\*?'
+asciiLetters = frozenset(string.ascii_letters)
+patternCommandName = re.compile(r'\\([a-zA-Z]+)')  # \xxx without *, group 1: name
+patternSpaces = re.compile(spaces)
+patternBraceCharacter = re.compile(r'[{}]')
+patternArgument = re.compile(r'#(\d)')  # #1 in the content of a macro
+maxMacroDepth = 10
+maxMacroOutput = 1 << 22  # characters the macro expansions of a document may add, the uses beyond are left as they are
+patternCommentToken = re.compile(r'%|\\begin[ \t]*\{(verbatim\*?|Verbatim\*?|lstlisting|minted)\}|\\verb\*?([^a-zA-Z*\s])|\\.?', re.DOTALL)  # group 1: verbatim environment, group 2: delimiter of \verb
+strippedTexts = {}  # recently processed texts: text without comments
+maxStrippedTexts = 16
+patternOptions = re.compile(options)
+patternBeginEnv = re.compile(r'\\begin[ \t]*\{([^{}]*)\}[ \t]*')  # group 1: name
+patternCommandStart = re.compile(r'\\([a-zA-Z]+)(\*?)')  # group 1: name, group 2: *
 
 patternEnv = getPatternEnv(r'.*?')  # \begin{xxx} \end{xxx}, group 1: name, group 2: option, group 3: content
 patternCommandFull = get_pattern_command_full(matchCommandName)   # \xxx[xxx]{xxx} and \xxx{xxx}, group 1: name, group 2: option, group 4: content
 patternCommandSimple = rf'\\({matchCommandName})'  # \xxx, group 1: name
 patternBrace = getPatternBrace(0)  # {xxx}, group 1: content
 patternNewcommand = rf'\\(?:newcommand|def){spaces}(?:\{{\\([a-zA-Z]+)\}}|\\([a-zA-Z]+)){spaces}(?:\[(\d)\])?{spaces}({getPatternBrace(4)})'  # \newcommand{name}[n_arguments]{content}, group 1/2: name, group 3: n_arguments, group 5: content
+patternNewcommandHead = re.compile(rf'\\(?:newcommand|def){spaces}(?:\{{\\([a-zA-Z]+)\}}|\\([a-zA-Z]+)){spaces}(?:\[(\d)\])?{spaces}')  # patternNewcommand without the content
 
 patternSet1 = rf'\\set[a-zA-Z]*{spaces}\\[a-zA-Z]+{spaces}\{{.*?\}}'
 patternSet2 = rf'\\set[a-zA-Z]*{spaces}\{{\\[a-zA-Z]+\}}{spaces}\{{.*?\}}'
@@ -76,6 +96,165 @@ formatList = ['textbf', 'textit', 'emph']
 replaceNewcommandList = ['equation', 'array', 'displaymath', 'align', 'multiple', 'gather', 'theorem', 'textcolor'] + environmentList + commandList
 
 
+# patterns of the LaTeX objects in replace_latex_objects, in the order they are replaced
+objectPatterns = {
+    'displayMath': r"\$\$(.*?)\$\$",  # $$ $$
+    'inlineMath': r"\$(.*?)\$",  # $ $
+    'bracketMath': r"\\\[(.*?)\\\]",  # \[ xxx \]
+    'parenthesisMath': r"\\\((.*?)\\\)",  # \( xxx \)
+    'env': patternEnv,  # \begin{xxx} \end{xxx}
+    'set1': patternSet1,
+    'set2': patternSet2,
+    'commandFull': patternCommandFull,  # \xxx[xxx]{xxx}
+    'brace': patternBrace,
+    'commandSimple': patternCommandSimple,  # \xxx
+    'newcommand': patternNewcommand,
+}
+
+
+class PatternRegistry:
+    '''
+    Compiled patterns keyed by (kind, name, nargs), compiled once per run:
+    ('env', name, None) for \\begin{name} \\end{name}, ('command', name, nargs) for \\name{xxx},
+    and ('object', name, None) for the patterns in objectPatterns.
+    It also counts how often each pattern is used, compiled and matched.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.patterns = {}
+        self.objectPatternLists = {}
+        self.uses = {}
+        self.matches = {}
+        self.compiles = {}
+        self.compileTime = {}
+        self.fallbackSearchers = {}
+        self.start_document()
+
+    @staticmethod
+    def build(kind, name, nargs):
+        if kind == 'env':
+            return getPatternEnv(name)
+        if kind == 'command':
+            return get_pattern_command_full(name, nargs)
+        if kind == 'object':
+            return objectPatterns[name]
+        raise ValueError(f'unknown pattern kind {kind}')
+
+    @staticmethod
+    def build_fallback(kind, name, nargs):
+        # a linear matcher with the same groups as the pattern, function(text, pos) -> match or None
+        if kind == 'env':
+            return functools.partial(search_env, regex.compile(name, regex.DOTALL))
+        if kind == 'command':
+            return functools.partial(search_command, regex.compile(name), nargs)
+        if kind == 'object':
+            return objectFallbacks[name]
+        raise ValueError(f'unknown pattern kind {kind}')
+
+    def start_document(self):
+        # the timeouts and fallbacks are counted for each document
+        with self.lock:
+            self.timedOut = set()  # keys that exceeded the time budget, they use the fallback for the rest of the document
+            self.timeouts = {}
+            self.fallbacks = {}
+
+    def get(self, kind, name, nargs=None):
+        key = (kind, name, nargs)
+        with self.lock:
+            pattern = self.patterns.get(key)
+            if pattern is None:
+                start = time.perf_counter()
+                pattern = regex.compile(self.build(kind, name, nargs), regex.DOTALL)
+                self.compileTime[key] = self.compileTime.get(key, 0) + time.perf_counter() - start
+                self.compiles[key] = self.compiles.get(key, 0) + 1
+                self.patterns[key] = pattern
+            self.uses[key] = self.uses.get(key, 0) + 1
+        return pattern
+
+    def get_object_patterns(self, brace=True, commandSimple=True):
+        # config.mularg_command_list may be changed by the options at startup, so it is part of the key
+        mulargCommands = tuple((name, n) for name, n, index in config.mularg_command_list)
+        listKey = (brace, commandSimple, mulargCommands)
+        keys = self.objectPatternLists.get(listKey)
+        if keys is None:
+            keys = [('object', name, None) for name in ['displayMath', 'inlineMath', 'bracketMath', 'parenthesisMath', 'env', 'set1', 'set2']]
+            keys += [('command', name, n) for name, n in mulargCommands]
+            keys.append(('object', 'commandFull', None))
+            if brace:
+                keys.append(('object', 'brace', None))
+            if commandSimple:
+                keys.append(('object', 'commandSimple', None))
+            self.objectPatternLists[listKey] = keys
+        for key in keys:
+            self.get(*key)
+        return keys
+
+    def search(self, key, text, pos=0):
+        '''
+        pattern.search(text, pos) for a pattern already compiled by get, with a time budget of config.regex_timeout seconds.
+        If the budget is exceeded, the linear fallback matcher is used, and for the rest of the document as well.
+        '''
+        if key not in self.timedOut:
+            try:
+                return self.patterns[key].search(text, pos, timeout=config.regex_timeout or None)
+            except TimeoutError:
+                with self.lock:
+                    self.timedOut.add(key)
+                    self.timeouts[key] = self.timeouts.get(key, 0) + 1
+        with self.lock:
+            self.fallbacks[key] = self.fallbacks.get(key, 0) + 1
+            searcher = self.fallbackSearchers.get(key)
+            if searcher is None:
+                searcher = self.fallbackSearchers[key] = self.build_fallback(*key)
+        return searcher(text, pos)
+
+    def finditer(self, text, kind, name, nargs=None):
+        key = (kind, name, nargs)
+        self.get(kind, name, nargs)
+        pos = 0
+        while True:
+            match = self.search(key, text, pos)
+            if match is None:
+                return
+            yield match
+            pos = match.end()
+
+    def sub(self, repl, text, kind, name, nargs=None):
+        # like pattern.sub with a function, every match is searched with the time budget
+        pieces = []
+        pos = 0
+        n = 0
+        for match in self.finditer(text, kind, name, nargs):
+            pieces.append(text[pos:match.start()])
+            pieces.append(repl(match))
+            pos = match.end()
+            n += 1
+        pieces.append(text[pos:])
+        self.add_matches((kind, name, nargs), n)
+        return ''.join(pieces)
+
+    def add_matches(self, key, n):
+        with self.lock:
+            self.matches[key] = self.matches.get(key, 0) + n
+
+    def report(self):
+        lines = [f'{"pattern":<40} {"uses":>8} {"matches":>8} {"compiles":>8} {"compile ms":>10}']
+        for key in sorted(self.uses, key=lambda key: self.uses[key], reverse=True):
+            kind, name, nargs = key
+            label = f'{kind} {name}' + ('' if nargs is None else f' {nargs}')
+            lines.append(f'{label:<40} {self.uses[key]:>8} {self.matches.get(key, 0):>8} {self.compiles.get(key, 0):>8} {self.compileTime.get(key, 0) * 1000:>10.2f}')
+        return '\n'.join(lines)
+
+    def fallback_report(self):
+        # the patterns that used the fallback in the current document, or '' if none did
+        with self.lock:
+            items = sorted(self.fallbacks.items(), key=lambda item: item[1], reverse=True)
+            return ', '.join(f'{" ".join(str(part) for part in key if part is not None)} x{n} ({self.timeouts.get(key, 0)} timeouts)' for key, n in items)
+
+
+patternRegistry = PatternRegistry()
+
+
 def variable_code(count):
     # If count is 123, the code is {math_code}_1_2_3
     digits = list(str(count))
@@ -119,63 +298,366 @@ def replace_latex_objects(text, brace=True, commandSimple=True):
     """
 
     # You need to make sure that the input does not contain {math_code}
-    # define regular expressions for each LaTeX object
-    patternsMulargCommand = [get_pattern_command_full(name, n) for name, n, index in config.mularg_command_list]
-    latexObjRegex = [
-        r"\$\$(.*?)\$\$",  # $$ $$
-        r"\$(.*?)\$",  # $ $
-        r"\\\[(.*?)\\\]",  # \[ xxx \]
-        r"\\\((.*?)\\\)",  # \( xxx \)
-        patternEnv,  # \begin{xxx} \end{xxx}
-        patternSet1,
-        patternSet2,
-    ] + patternsMulargCommand + [patternCommandFull]  # \xxx[xxx]{xxx}
-    if brace:
-        latexObjRegex.append(patternBrace)
-    if commandSimple:
-        latexObjRegex.append(patternCommandSimple)  # \xxx
-
     # iterate through each LaTeX object and replace with "{math_code}_{digit1}_{digit2}_..._{digit_last}"
     count = 0
     replacedObjs = []
-    for regexSymbol in latexObjRegex:
-        pattern = regex.compile(regexSymbol, regex.DOTALL)
-        while pattern.search(text):
-            latex_obj = pattern.search(text).group()
-            replacedObjs.append(f' {latex_obj} ')
-            text = pattern.sub(' ' + variable_code(count) + ' ', text, 1)
-            count += 1
+    for key in patternRegistry.get_object_patterns(brace, commandSimple):
+        countBefore = count
+        text, count = scan_latex_objects(key, text, replacedObjs, count, key == ('object', 'commandFull', None))
+        patternRegistry.add_matches(key, count - countBefore)
 
     text = modify_text(text, modify_before)
     return text, replacedObjs
 
 
-def recover_latex_objects(text, replacedObjs, tolerateError=False):
-    # recover the latex objects from "replace_latex_objects"
-    nobjs = len(replacedObjs)
-    matchedIndices = []
+def scan_latex_objects(key, text, replacedObjs, count, checkOptions=False):
+    '''
+    Replaces every match of the pattern `key` of patternRegistry by a variable code in a single left-to-right scan.
+    The numbering and objects are the same as replacing the first match and searching again from the start.
+    A replacement can only create a new match before itself inside the options of a command, i.e. \\xxx[ ... ],
+    or when it has unbalanced braces, so `checkOptions` restarts the search there for \\xxx[xxx]{xxx}.
+    Returns the processed text and the next count.
+    '''
+    pieces = []
+    outputLength = 0
+    pos = 0  # text[:pos] is already in pieces
+    searchPos = 0
+    optionStart = None  # position in the output of a command whose options are not closed yet
+    while True:
+        match = patternRegistry.search(key, text, searchPos)
+        if match is None:
+            break
+        begin, end = match.span()
+        latexObj = match.group()
+        replacedObjs.append(f' {latexObj} ')
+        before = text[pos:begin]
+        code = ' ' + variable_code(count) + ' '
+        if checkOptions:
+            bracket = max(before.rfind('['), before.rfind(']'))
+            if bracket != -1:
+                optionStart = None
+                if before[bracket] == '[':
+                    commandStart = find_command_before(before, bracket)
+                    if commandStart is not None:
+                        optionStart = outputLength + commandStart
+        pieces.append(before)
+        pieces.append(code)
+        outputLength += len(before) + len(code)
+        count += 1
+        pos = searchPos = end
+        if checkOptions:
+            unbalanced = latexObj.count('{') != latexObj.count('}')
+            if unbalanced or optionStart is not None:
+                text = ''.join(pieces) + text[pos:]
+                searchPos = 0 if unbalanced else optionStart
+                pieces = []
+                outputLength = 0
+                pos = 0
+    pieces.append(text[pos:])
+    return ''.join(pieces), count
+
+
+def find_matching_brace(text, pos):
+    # if text[pos] is '{', return the position of the matching '}' in linear time, otherwise None
+    if not text.startswith('{', pos):
+        return None
+    depth = 0
+    for match in patternBraceCharacter.finditer(text, pos):
+        if match.group() == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.start()
+    return None
+
+
+def find_command_before(text, index):
+    # if text[:index] ends with \xxx followed by spaces, return the position of the backslash
+    end = len(text[:index].rstrip(' \t'))
+    if end > 0 and text[end - 1] == '*':
+        end -= 1
+    begin = end
+    while begin > 0 and text[begin - 1] in asciiLetters:
+        begin -= 1
+    if begin == end or begin == 0 or text[begin - 1] != '\\':
+        return None
+    return begin - 1
+
+
+class FallbackMatch:
+    """
+    A match found by a fallback matcher, with the part of the interface of regex.Match used in this module.
+    spans: the span of group 0, 1, 2..., None for a group that does not participate in the match
+    """
+    def __init__(self, string, spans):
+        self.string = string
+        self.spans = [span if span is not None and span[0] != -1 else None for span in spans]
+
+    def span(self, index=0):
+        return self.spans[index] or (-1, -1)
+
+    def start(self, index=0):
+        return self.span(index)[0]
+
+    def end(self, index=0):
+        return self.span(index)[1]
 
-    def get_obj(digitStr):
-        index = int(''.join(digitStr.split('_')))
-        matchedIndices.append(index)
-        if index < nobjs:
-            return replacedObjs[index]
+    def group(self, *indices):
+        groups = [None if self.spans[i] is None else self.string[self.spans[i][0]:self.spans[i][1]] for i in indices or [0]]
+        return groups[0] if len(groups) == 1 else tuple(groups)
+
+    def groups(self):
+        return tuple(self.group(i) for i in range(1, len(self.spans)))
+
+    def __getitem__(self, index):
+        return self.group(index)
+
+
+class TextIndex:
+    """
+    Positions in a text for the fallback matchers, each computed once in linear time:
+    the matching } of every {, and the \\end{name} of every environment name.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.partners = None
+        self.ends = {}
+
+    def matching_brace(self, pos):
+        # the position of the } matching the { at pos, or None
+        if self.partners is None:
+            partners = {}
+            stack = []
+            for match in patternBraceCharacter.finditer(self.text):
+                if match.group() == '{':
+                    stack.append(match.start())
+                elif stack:
+                    partners[stack.pop()] = match.start()
+            self.partners = partners
+        return self.partners.get(pos)
+
+    def find_end(self, name, pos):
+        # the span of the first \end{name} after pos, or None
+        ends = self.ends.get(name)
+        if ends is None:
+            pattern = re.compile(r'\\end[ \t]*\{' + re.escape(name) + r'\}')
+            ends = self.ends[name] = [match.span() for match in pattern.finditer(self.text)]
+        i = bisect.bisect_left(ends, (pos, ))
+        return ends[i] if i < len(ends) else None
+
+
+lastTextIndex = TextIndex('')
+
+
+def get_text_index(text):
+    # the fallback matchers are called again and again on the same text by scan_latex_objects and sub
+    global lastTextIndex
+    index = lastTextIndex
+    if index.text is not text:
+        index = lastTextIndex = TextIndex(text)
+    return index
+
+
+def search_delimited(opening, closing, text, pos):
+    # opening(.*?)closing, group 1: content
+    begin = text.find(opening, pos)
+    if begin == -1:
+        return None
+    end = text.find(closing, begin + len(opening))
+    if end == -1:
+        return None
+    return FallbackMatch(text, [(begin, end + len(closing)), (begin + len(opening), end)])
+
+
+def search_set(patternHead, text, pos):
+    # patternSet1 and patternSet2, the head is everything before {.*?}
+    match = patternHead.search(text, pos)
+    if match is None:
+        return None
+    end = text.find('}', match.end())
+    if end == -1:
+        return None
+    return FallbackMatch(text, [(match.start(), end + 1)])
+
+
+def search_env(namePattern, text, pos):
+    # \begin{name}[options] content \end{name} as getPatternEnv, group 1: name, group 2: options, group 3: content
+    index = get_text_index(text)
+    for match in patternBeginEnv.finditer(text, pos):
+        name = match.group(1)
+        if namePattern.fullmatch(name) is None:
+            continue
+        optionsMatch = patternOptions.match(text, match.end())
+        end = None
+        if optionsMatch is not None:
+            end = index.find_end(name, optionsMatch.end())
+        if end is not None:
+            optionsSpan = optionsMatch.span()
         else:
-            if testEnvironment:
-                assert tolerateError
-            return '???'
+            # as in the pattern, the [options] can also be a part of the content
+            optionsSpan = None
+            end = index.find_end(name, match.end())
+            if end is None:
+                continue
+        contentStart = match.end() if optionsSpan is None else optionsSpan[1]
+        return FallbackMatch(text, [(match.start(), end[1]), match.span(1), optionsSpan, (contentStart, end[0])])
+    return None
+
+
+def match_command_arguments(text, pos, nargs):
+    # the [options] and {arguments} after the name of a command as get_pattern_command_full, returns (end, spans) or None
+    index = get_text_index(text)
+    spans = []
+    if nargs == 0:
+        if pos < len(text) and text[pos] not in asciiLetters:
+            return pos, spans
+        return None
+    if nargs is None:
+        pos = patternSpaces.match(text, pos).end()
+        optionsMatch = patternOptions.match(text, pos)
+        if optionsMatch is None:
+            spans.append(None)
+        else:
+            spans.append(optionsMatch.span())
+            pos = optionsMatch.end()
+        nargs = 1
+    for i in range(nargs):
+        argumentStart = patternSpaces.match(text, pos).end()
+        argumentEnd = index.matching_brace(argumentStart)
+        if argumentEnd is None:
+            return None
+        spans += [(argumentStart, argumentEnd + 1), (argumentStart + 1, argumentEnd)]
+        pos = argumentEnd + 1
+    return pos, spans
+
+
+def search_command(namePattern, nargs, text, pos):
+    # \name[options]{xxx} or \name{xxx}{xxx}... with the groups of get_pattern_command_full
+    for match in patternCommandStart.finditer(text, pos):
+        nameStart = match.start(1)
+        # as in the pattern, the name with the * is tried first
+        for nameEnd in ([match.end()] if match.group(2) else []) + [match.end(1)]:
+            if namePattern.fullmatch(text, nameStart, nameEnd) is None:
+                continue
+            result = match_command_arguments(text, nameEnd, nargs)
+            if result is not None:
+                end, spans = result
+                return FallbackMatch(text, [(match.start(), end), (nameStart, nameEnd)] + spans)
+    return None
+
+
+def search_brace(text, pos):
+    # the first { which has a matching }, group 1: content
+    index = get_text_index(text)
+    begin = text.find('{', pos)
+    while begin != -1:
+        end = index.matching_brace(begin)
+        if end is not None:
+            return FallbackMatch(text, [(begin, end + 1), (begin + 1, end)])
+        begin = text.find('{', begin + 1)
+    return None
+
+
+def search_newcommand(text, pos):
+    # patternNewcommand
+    index = get_text_index(text)
+    while True:
+        match = patternNewcommandHead.search(text, pos)
+        if match is None:
+            return None
+        end = index.matching_brace(match.end())
+        if end is not None:
+            return FallbackMatch(text, [(match.start(), end + 1), match.span(1), match.span(2), match.span(3), (match.end(), end + 1), (match.end() + 1, end)])
+        pos = match.start() + 1
+
+
+# linear matchers with the same results as the patterns in objectPatterns, used when a search exceeds config.regex_timeout
+objectFallbacks = {
+    'displayMath': functools.partial(search_delimited, '$$', '$$'),
+    'inlineMath': functools.partial(search_delimited, '$', '$'),
+    'bracketMath': functools.partial(search_delimited, '\\[', '\\]'),
+    'parenthesisMath': functools.partial(search_delimited, '\\(', '\\)'),
+    'env': functools.partial(search_env, regex.compile(r'.*?', regex.DOTALL)),
+    'set1': functools.partial(search_set, re.compile(rf'\\set[a-zA-Z]*{spaces}\\[a-zA-Z]+{spaces}\{{')),
+    'set2': functools.partial(search_set, re.compile(rf'\\set[a-zA-Z]*{spaces}\{{\\[a-zA-Z]+\}}{spaces}\{{')),
+    'commandFull': functools.partial(search_command, regex.compile(matchCommandName), None),
+    'brace': search_brace,
+    'commandSimple': re.compile(patternCommandSimple).search,
+    'newcommand': search_newcommand,
+}
 
-    text = modify_text(text, modify_after)
-    pattern = re.compile(matchCodeReplace)
+
+def recover_latex_objects(text, replacedObjs, tolerateError=False):
+    # recover the latex objects from "replace_latex_objects"
+    # every object is expanded once, with an explicit stack for the variable codes nested inside it
+    nobjs = len(replacedObjs)
+    expandedObjs = {}  # index: (expanded object, number of nested codes, nested valid indices)
+    matchedIndices = set()
+    nMatched = 0
+
+    def get_index(code):
+        index = int(code[len(mathCode) + 1:].replace('_', ''))
+        if index >= nobjs and testEnvironment:
+            assert tolerateError
+        return index
+
+    def expand_object(index):
+        # frame: [index, parts of the object, current part, expanded pieces, number of nested codes, nested valid indices]
+        stack = [[index, patternCode.split(replacedObjs[index]), 0, [], 0, set()]]
+        expanding = {index}
+        while stack:
+            frame = stack[-1]
+            current, parts, i, pieces = frame[0:4]
+            nestedToExpand = None
+            while i < len(parts):
+                if i % 2 == 0:
+                    pieces.append(parts[i])
+                    i += 1
+                    continue
+                nested = get_index(parts[i])
+                if nested < nobjs and nested not in expanding and nested not in expandedObjs:
+                    nestedToExpand = nested
+                    break
+                frame[4] += 1
+                if nested >= nobjs or nested in expanding:
+                    pieces.append('???')
+                else:
+                    expandedObj, nNested, nestedIndices = expandedObjs[nested]
+                    pieces.append(expandedObj)
+                    frame[4] += nNested
+                    frame[5].add(nested)
+                    frame[5].update(nestedIndices)
+                i += 1
+            frame[2] = i
+            if nestedToExpand is not None:
+                # expand the nested object first, then come back to this part
+                stack.append([nestedToExpand, patternCode.split(replacedObjs[nestedToExpand]), 0, [], 0, set()])
+                expanding.add(nestedToExpand)
+                continue
+            expandedObjs[current] = (''.join(pieces), frame[4], frame[5])
+            expanding.discard(current)
+            stack.pop()
+
+    parts = patternCode.split(text)
+    for i in range(0, len(parts), 2):
+        parts[i] = modify_after(parts[i])
+    for i in range(1, len(parts), 2):
+        index = get_index(parts[i])
+        nMatched += 1
+        if index >= nobjs:
+            parts[i] = '???'
+            continue
+        if index not in expandedObjs:
+            expand_object(index)
+        parts[i], nNested, nestedIndices = expandedObjs[index]
+        nMatched += nNested
+        matchedIndices.add(index)
+        matchedIndices.update(nestedIndices)
+    text = ''.join(parts)
     # count number of mismatch
-    total_num = 0
-    while True:
-        text, numModify = pattern.subn(lambda match: get_obj(match.group(1)), text)
-        total_num += numModify
-        if numModify == 0:
-            break
-    nGood = len(set(matchedIndices).intersection(set(range(nobjs))))
-    nBad1 = len(matchedIndices) - nGood
+    nGood = len(matchedIndices)
+    nBad1 = nMatched - nGood
     nBad2 = nobjs - nGood
     nBad = max(nBad1, nBad2)
     return text, nBad, nobjs
@@ -183,19 +665,65 @@ def recover_latex_objects(text, replacedObjs, tolerateError=False):
 
 def remove_tex_comments(text):
     """
-    Removes all TeX comments in a given string with the format "% comment text".
-    Does not match "\%".
-    If "%" is at the beginning of a line then delete this line.
+    Removes all TeX comments in a given string with the format "% comment text", in one scan.
+    Does not match "\%", but "\\%" is a line break followed by a comment.
+    The content of verbatim-like environments and \verb|xxx| are kept as they are.
+    If "%" is at the beginning of a line (after spaces) then delete this line.
+    The last line does not need to end with a newline.
+    Texts that were already processed are remembered, so they are not scanned again.
     Returns the processed string.
     """
-    text = text.replace(r'\\', f'{mathCode}_BLACKSLASH')
-    text = text.replace(r'\%', f'{mathCode}_PERCENT')
-    text = re.sub(r"\n\s*%.*?(?=\n)", "", text)
-    text = re.sub(r"%.*?(?=\n)", "", text)
-    text = text.replace(f'{mathCode}_PERCENT', r'\%')
-    text = text.replace(f'{mathCode}_BLACKSLASH', r'\\')
+    if text in strippedTexts:
+        return strippedTexts[text]
+    pieces = []
+    pos = 0  # text[:pos] is already in pieces
+    searchPos = 0
+    while True:
+        match = patternCommentToken.search(text, searchPos)
+        if match is None:
+            break
+        token = match.group()
+        if token == '%':
+            percent = match.start()
+            lineEnd = text.find('\n', percent)
+            if lineEnd == -1:
+                lineEnd = len(text)
+            lineStart = text.rfind('\n', pos, percent)
+            if lineStart != -1 and text[lineStart + 1:percent].strip(' \t') == '':
+                # the whole line is a comment, remove it together with the newline before it
+                pieces.append(text[pos:lineStart])
+            else:
+                pieces.append(text[pos:percent])
+            pos = searchPos = lineEnd
+        elif match.group(1) is not None:
+            # verbatim environment, skip to its end
+            end = text.find(f'\\end{{{match.group(1)}}}', match.end())
+            searchPos = len(text) if end == -1 else end
+        elif match.group(2) is not None:
+            # \verb|xxx|, skip to the closing delimiter on the same line
+            delimiter = match.group(2)
+            end = text.find(delimiter, match.end())
+            lineEnd = text.find('\n', match.end())
+            if end == -1 or (lineEnd != -1 and lineEnd < end):
+                searchPos = match.end() - 1
+            else:
+                searchPos = end + 1
+        else:
+            searchPos = match.end()
+    pieces.append(text[pos:])
+    result = ''.join(pieces)
+    mark_comments_removed(text, result)
+    return result
 
-    return text
+
+def mark_comments_removed(text, result=None):
+    # remember that `result` is `text` without comments, and that `result` has no comment
+    if result is None:
+        result = text
+    for key in [text, result]:
+        strippedTexts[key] = result
+    while len(strippedTexts) > maxStrippedTexts:
+        del strippedTexts[next(iter(strippedTexts))]
 
 
 def split_latex_document(text, beginCode, endCode):
@@ -213,27 +741,9 @@ def split_latex_document(text, beginCode, endCode):
     return body, pre, post
 
 
-def process_specific_env(latex, function, envName):
-    # find all patterns of \begin{env_name}[options] content \end{env_name}
-    # then replace `content` by `function(content)`
-    pattern = regex.compile(getPatternEnv(envName), regex.DOTALL)
-
-    def process_function(match):
-        name = match.group(1)
-        assert re.match(envName, name)
-        options = match.group(2)
-        if options is None:
-            options = ''
-        content = match.group(3)
-        processedContent = function(content)
-        return rf'\begin{{{envName}}}{options}{processedContent}\end{{{envName}}}'
-    return pattern.sub(process_function, latex)
-
-
 def process_specific_command(latex, function, commandName):
     # find all patterns of # \{command_name}[options]{content}
     # then replace `content` by `function(content)`
-    pattern = regex.compile(get_pattern_command_full(commandName), regex.DOTALL)
 
     def process_function(match):
         name = match.group(1)
@@ -244,74 +754,7 @@ def process_specific_command(latex, function, commandName):
         content = match.group(4)
         processedContent = function(content)
         return rf'\{commandName}{options}{{{processedContent}}}'
-    return pattern.sub(process_function, latex)
-
-
-def process_mularg_command(latex, function, commandTuple):
-    # find all patterns of # \{command_name}[options]{content}
-    # then replace `content` by `function(content)`
-    commandName, nargs, argsToTranslate = commandTuple
-    pattern = regex.compile(get_pattern_command_full(commandName, n=nargs), regex.DOTALL)
-
-    def process_function(match):
-        name = match.group(1)
-        assert re.match(commandName, name)
-        group_index = 2
-        contents = []
-        for i in range(nargs):
-            content = match.group(group_index + 1)
-            if i in argsToTranslate:
-                content = function(content)
-            contents.append(content)
-            group_index += 2
-        return rf'\{commandName}' + ''.join([rf'{{{content}}}' for content in contents])
-    return pattern.sub(process_function, latex)
-
-
-def process_leading_level_brace(latex, function):
-    # leading level means that the {xxx} is not inside other objects, i.e. \command{} or \begin{xxx} \end{xxx}
-    # replace `{ content }` by `{ function(content) }`
-    text, envs = replace_latex_objects(latex, brace=False)
-    bracesContent = []
-    count = 0
-
-    def process_function(match):
-        nonlocal bracesContent, count
-        content = match.group(1)
-        # function here is translate_paragraph_latex, which cannot contain replaced environments
-        processedContent = function(recover_latex_objects(content, envs)[0])
-        result = rf'{{ {processedContent} }}'
-        bracesContent.append(result)
-        placeholder = f'BRACE{count}BRACE'
-        count += 1
-        return placeholder
-
-    text = regex.compile(patternBrace, regex.DOTALL).sub(process_function, text)
-    latex = recover_latex_objects(text, envs)[0]
-    for i in range(count):
-        latex = latex.replace(f'BRACE{i}BRACE', bracesContent[i])
-    return latex
-
-
-def split_by_command(latex):
-    # split by things like \item
-    text, envs = replace_latex_objects(latex, commandSimple=False)
-
-    texts = [(text, '')]
-
-    for pattern, command in [(r'\\item\s+', '\item')]:
-        newTexts = []
-        for t, sep in texts:
-            splitedT = re.split(pattern, t)
-            seps = [command for _ in splitedT]
-            seps[-1] = sep
-            newTexts += list(zip(splitedT, seps))
-        texts = newTexts
-
-    seps = [t[1] for t in texts]
-    texts = [t[0] for t in texts]
-    latexs = [recover_latex_objects(t, envs)[0] for t in texts]
-    return latexs, seps
+    return patternRegistry.sub(process_function, latex, 'command', commandName)
 
 
 def remove_blank_lines(text):
@@ -429,60 +872,107 @@ def combine_split_to_sentences(text):
     return pattern.sub(process_function, text)
 
 
-def delete_specific_format(latex, formatName):
-    pattern = regex.compile(get_pattern_command_full(formatName), regex.DOTALL)
-    return pattern.sub(lambda m: ' ' + m.group(4) + ' ', latex)
-
-
-def replace_newcommand(newcommand, latex):
-    commandName, nArguments, content = newcommand
-    pattern = regex.compile(get_pattern_command_full(commandName, nArguments), regex.DOTALL)
-
-    def replace_function(match):
-        thisContent = content
-        name = match.group(1)
-        assert re.match(commandName, name)
-        for i in range(nArguments):
-            text = match.group(3 + i * 2)
-            thisContent = thisContent.replace(f'#{i+1}', f' {text} ')
-        return thisContent
-
-    return pattern.sub(replace_function, latex)
-
-
-def process_newcommands(latex):
-    pattern = regex.compile(patternNewcommand, regex.DOTALL)
-    count = 0
-    fullNewcommands = []
-    matchesAll = list(regex.finditer(pattern, latex))
-    for match in matchesAll:
-        needReplace = False
+def get_macros(latex):
+    # the table of macros to expand, {name: (number of arguments, content)}, and the spans of their definitions
+    macros = {}
+    definitions = []
+    for match in patternRegistry.finditer(latex, 'object', 'newcommand'):
         contentAll = match.group(0)
-        for special in replaceNewcommandList:
-            if special in contentAll:
-                needReplace = True
-        if not needReplace:
+        if not any(special in contentAll for special in replaceNewcommandList):
             continue
-        name1 = match.group(1)
-        name2 = match.group(2)
-        name = get_nonNone(name1, name2)
+        name = get_nonNone(match.group(1), match.group(2))
         nArguments = match.group(3)
         if nArguments is None:
             nArguments = 0
         else:
             nArguments = int(nArguments)
-        content = match.group(5)
-        latex = latex.replace(match.group(), f'{mathCode}_REPLACE{count}_NEWCOMMAND')
-        fullNewcommands.append(match.group(0))
-        latex = replace_newcommand((name, nArguments, content), latex)
-        count += 1
-    for i in range(count):
-        latex = latex.replace(f'{mathCode}_REPLACE{i}_NEWCOMMAND', fullNewcommands[i])
-    return latex
+        # the first definition wins, as in latex a second \newcommand is an error
+        if name not in macros:
+            macros[name] = (nArguments, match.group(5))
+        definitions.append(match.span())
+    patternRegistry.add_matches(('object', 'newcommand', None), len(definitions))
+    return macros, definitions
+
+
+class ExpansionBudget:
+    # the characters the expansions of a document may still add
+    def __init__(self, size):
+        self.left = size
+        self.exceeded = False
+
+
+def expand_macros(text, macros, expansions, budget, active=frozenset(), depth=0):
+    '''
+    Expands the uses of macros in one pass, the expanded content is expanded again up to maxMacroDepth levels.
+    A macro is not expanded again inside its own expansion (active), e.g. \\newcommand{\\x}{\\begin{equation}\\x},
+    and a use which would take the expansions beyond the budget is left as it is.
+    '''
+    pieces = []
+    pos = 0
+    for match in patternCommandName.finditer(text):
+        name = match.group(1)
+        if match.start() < pos or name not in macros or name in active:
+            continue
+        nArguments, content = macros[name]
+        end = match.end()
+        arguments = []
+        for i in range(nArguments):
+            argumentStart = patternSpaces.match(text, end).end()
+            argumentEnd = find_matching_brace(text, argumentStart)
+            if argumentEnd is None:
+                break
+            arguments.append(text[argumentStart + 1:argumentEnd])
+            end = argumentEnd + 1
+        if len(arguments) < nArguments:
+            continue
+
+        def replace_argument(match):
+            i = int(match.group(1))
+            if 1 <= i <= nArguments:
+                return f' {arguments[i - 1]} '
+            return match.group(0)
+
+        expanded = patternArgument.sub(replace_argument, content)
+        if len(expanded) > budget.left:
+            budget.exceeded = True
+            continue
+        budget.left -= len(expanded)
+        if depth < maxMacroDepth:
+            expanded = expand_macros(expanded, macros, expansions, budget, active | {name}, depth + 1)
+        expansions[name] = expansions.get(name, 0) + 1
+        pieces.append(text[pos:match.start()])
+        pieces.append(expanded)
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+def process_newcommands(latex, expansions=None):
+    '''
+    Expands the macros defined by \\newcommand or \\def that contain environments or commands we need to see,
+    e.g. \\newcommand{\\be}{\\begin{equation}}.
+    The macro table is built in one scan and the document is expanded in one pass, the definitions are kept.
+    expansions: if given, a dict counting the expansions of each macro
+    '''
+    if expansions is None:
+        expansions = {}
+    macros, definitions = get_macros(latex)
+    if len(macros) == 0:
+        return latex
+    budget = ExpansionBudget(maxMacroOutput)
+    pieces = []
+    pos = 0
+    for begin, end in definitions:
+        pieces.append(expand_macros(latex[pos:begin], macros, expansions, budget))
+        pieces.append(latex[begin:end])
+        pos = end
+    pieces.append(expand_macros(latex[pos:], macros, expansions, budget))
+    if budget.exceeded:
+        print(f'warning: the macro expansions exceed {maxMacroOutput} characters, the remaining uses are not expanded')
+    return ''.join(pieces)
 
 
 def remove_bibnote(latex):
-    pattern = regex.compile(get_pattern_command_full('bibinfo', 2), regex.DOTALL)
 
     def replace_function(match):
         assert match.group(1) == 'bibinfo'
@@ -490,4 +980,4 @@ def remove_bibnote(latex):
             return ''
         else:
             return match.group(0)
-    return pattern.sub(replace_function, latex)
\ No newline at end of file
+    return patternRegistry.sub(replace_function, latex, 'command', 'bibinfo', 2)
\ No newline at end of file
@@ -1,4 +1,10 @@
+import re
+
+
 charLimit = 2000
+batchCode = 'XSEGX'  # delimiter between the texts of a batch, in the same form as the variable codes of process_latex
+patternBatchCode = re.compile(rf'\s*{batchCode}((?:\s*_\s*\d)+)\s*')  # group 1: digits
+patternSpacesAround = re.compile(r'^(\s*).*?(\s*)$', re.DOTALL)  # group 1/2: spaces before/after
 
 
 def is_connected(lineAbove, lineBelow):
@@ -67,4 +73,37 @@ def split_titles(text):
         if is_title(line_above, line_below):
             textSplit[i] = '\n\n' + textSplit[i] + '\n\n'
         i += 1
-    return '\n'.join(textSplit)
\ No newline at end of file
+    return '\n'.join(textSplit)
+
+
+def batch_code(index):
+    # If index is 12, the code is {batch_code}_1_2
+    return batchCode + ''.join(f'_{digit}' for digit in str(index))
+
+
+def join_batch(texts):
+    # one text with a delimiter line between the texts
+    pieces = [texts[0]]
+    for i in range(1, len(texts)):
+        pieces.append(f'\n{batch_code(i)}\n')
+        pieces.append(texts[i])
+    return ''.join(pieces)
+
+
+def split_batch(translated, texts):
+    '''
+    Splits the translation of join_batch(texts) back to the translations of texts.
+    The spaces around each text are kept as in the original text.
+    Returns None if the delimiters are not found in order.
+    '''
+    pieces = patternBatchCode.split(translated)
+    if len(pieces) != 2 * len(texts) - 1:
+        return None
+    indices = [int(re.sub(r'\D', '', code)) for code in pieces[1::2]]
+    if indices != list(range(1, len(texts))):
+        return None
+    results = []
+    for text, piece in zip(texts, pieces[0::2]):
+        before, after = patternSpacesAround.match(text).groups()
+        results.append(before + piece.strip() + after)
+    return results
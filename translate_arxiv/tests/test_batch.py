@@ -0,0 +1,88 @@
+'''
+The texts of a batch go in one request, separated by delimiter lines, and come back in order;
+a delimiter changed by the engine makes the batch fall back to one request per text.
+
+python -m pytest tests
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import engines
+import process_text
+import stub_translator
+from engines import mock_translate
+from translate import TextTranslator
+
+texts = ['the first text', ' a second one with XMATHX_1 ', 'and\nthe last one\n']
+
+
+class ManglingEngine(engines.MockEngine):
+    # breaks the delimiters, e.g. a translation which moves them or changes their letters
+    async def request(self, text, languageTo, languageFrom):
+        return (await super().request(text, languageTo, languageFrom)).replace(process_text.batchCode, 'XSEG X')
+
+
+def mock_engine(engineClass=engines.MockEngine):
+    return engineClass(latency=0, charCost=0, requestsPerSecond=0, charsPerSecond=0)
+
+
+class TestBatchFormat(unittest.TestCase):
+    def test_batch_code(self):
+        self.assertEqual(process_text.batch_code(12), 'XSEGX_1_2')
+
+    def test_round_trip(self):
+        translated = mock_translate(process_text.join_batch(texts))
+        self.assertEqual(process_text.split_batch(translated, texts), [mock_translate(text) for text in texts])
+
+    def test_spaces_in_codes(self):
+        # the engines add spaces inside and around the codes
+        translated = 'A\n XSEGX _ 1 \nB\nXSEGX_2C'
+        self.assertEqual(process_text.split_batch(translated, texts), ['A', ' B ', 'C\n'])
+
+    def test_mangled(self):
+        translated = mock_translate(process_text.join_batch(texts))
+        self.assertIsNone(process_text.split_batch(translated.replace('XSEGX_2', 'XSEG X_2'), texts))
+        self.assertIsNone(process_text.split_batch(translated.replace('XSEGX_2', 'XSEGX_3'), texts))
+        self.assertIsNone(process_text.split_batch(translated.replace('XSEGX_1', ''), texts))
+
+
+class TestTranslateBatch(unittest.TestCase):
+    def test_batch(self):
+        translator = TextTranslator('mock', 'zh-CN', 'en', translator=mock_engine())
+        translator.translate_batch(texts)
+        self.assertEqual((translator.numberOfCalls, translator.numberOfBatches, translator.batchFallbacks), (1, 1, 0))
+        for text in texts:
+            self.assertEqual(translator.memo.get(text, translator.languages), mock_translate(text))
+        translator.close()
+
+    def test_fallback(self):
+        engine = mock_engine(ManglingEngine)
+        translator = TextTranslator('mock', 'zh-CN', 'en', translator=engine)
+        translator.translate_batch(texts)
+        self.assertEqual((translator.numberOfBatches, translator.batchFallbacks), (1, 1))
+        # the batch, then each text
+        self.assertEqual(engine.requests, 1 + len(texts))
+        for text in texts:
+            self.assertEqual(translator.memo.get(text, translator.languages), mock_translate(text))
+        translator.close()
+
+    def test_stub_server(self):
+        server, url = stub_translator.start_server(latency=0)
+        engine = engines.GoogleEngine(url, requestsPerSecond=0, charsPerSecond=0)
+        try:
+            self.assertEqual(engine.translate_batch(texts, 'zh-CN', 'en'), [mock_translate(text) for text in texts])
+            self.assertEqual(server.requests, 1)
+        finally:
+            engine.close()
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
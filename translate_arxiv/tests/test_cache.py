@@ -0,0 +1,216 @@
+'''
+The translation cache, in a temporary directory for each test.
+
+python -m pytest tests
+'''
+import io
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import contextlib
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import cache
+import utils
+import translate
+from config import config
+
+
+maxBytes = cache.maxBytes
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.001)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.TemporaryDirectory()
+        cache.set_cache_dir(self.cacheDir.name)
+        cache.connect()
+
+    def tearDown(self):
+        cache.set_cache_dir(tempfile.mkdtemp())
+        self.cacheDir.cleanup()
+
+    def database(self):
+        # another connection, as another process would open
+        return sqlite3.connect(cache.databasePath, isolation_level=None)
+
+
+class TestStorage(CacheTest):
+    def test_round_trip(self):
+        cache.create_cache('document')
+        cache.write_paragraph('document', 'p1', 'T1')
+        cache.write_global_paragraph('key', 'G1')
+        # found in the pending writes, then in the database
+        self.assertEqual(cache.load_paragraph('document', 'p1'), 'T1')
+        cache.flush()
+        cache.set_cache_dir(self.cacheDir.name)
+        self.assertTrue(cache.is_cached('document'))
+        self.assertEqual(cache.load_paragraph('document', 'p1'), 'T1')
+        self.assertEqual(cache.load_global_paragraph('key'), 'G1')
+        self.assertIsNone(cache.load_paragraph('document', 'p2'))
+        self.assertIsNone(cache.load_paragraph('other', 'p1'))
+        self.assertIsNone(cache.load_global_paragraph('other'))
+        self.assertEqual(cache.total_size(cache.connect()), 4)
+
+    def test_batches(self):
+        for i in range(cache.batchSize):
+            cache.write_paragraph('document', str(i), 'T')
+        # a full batch is written at once
+        self.assertEqual(cache.pendingParagraphs, {})
+        self.assertEqual(self.database().execute('SELECT COUNT(*) FROM paragraphs').fetchone()[0], cache.batchSize)
+
+    def test_migration(self):
+        path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(path, 'cache', 'old'))
+        open(os.path.join(path, 'cache', 'old', cache.timeFilename), 'w').write('123')
+        open(os.path.join(path, 'cache', 'old', 'p1'), 'w', encoding='utf-8').write('Tränslation')
+        os.makedirs(os.path.join(path, 'paragraphs', 'ab'))
+        open(os.path.join(path, 'paragraphs', 'ab', 'abcd'), 'w', encoding='utf-8').write('G1')
+        cache.set_cache_dir(path)
+        self.assertEqual(cache.load_paragraph('old', 'p1'), 'Tränslation')
+        self.assertEqual(cache.load_global_paragraph('abcd'), 'G1')
+        # the old directories are removed
+        self.assertFalse(os.path.exists(os.path.join(path, 'cache')))
+        self.assertFalse(os.path.exists(os.path.join(path, 'paragraphs')))
+        database = sqlite3.connect(cache.databasePath)
+        self.assertEqual(list(database.execute('SELECT update_time, size FROM documents')), [(123, len('Tränslation'.encode()))])
+
+    def test_nocache(self):
+        config.mock_latency = 0
+        config.report_file = ''
+        path = os.path.join(tempfile.mkdtemp(), 'arxiv_cache')
+        cache.set_cache_dir(path)
+        with tempfile.TemporaryDirectory() as paperDir, contextlib.redirect_stdout(io.StringIO()):
+            inputPath = os.path.join(paperDir, 'main.tex')
+            open(inputPath, 'w').write('A paragraph with $x$ inside.\n\nAnother one.\n')
+            translate.translate_tex_file_to_languages(inputPath, {'zh-CN': os.path.join(paperDir, 'out.tex')}, 'mock', 'en', False, True, 0, True, 1, False)
+            self.assertIn('PARAGRAPH', open(os.path.join(paperDir, 'out.tex')).read())
+        self.assertFalse(os.path.exists(path))
+
+
+class TestEviction(CacheTest):
+    def add_document(self, name, t, size):
+        cache.write_paragraph(name, 'p', 'x' * size)
+        cache.flush()
+        self.database().execute('UPDATE documents SET update_time = ? WHERE hash = ?', (t, name))
+
+    def add_global(self, key, t, size):
+        cache.write_global_paragraph(key, 'x' * size)
+        cache.flush()
+        self.database().execute('UPDATE global_paragraphs SET update_time = ? WHERE key = ?', (t, key))
+
+    def test_lru_order(self):
+        self.add_document('inUse', 1, 100)
+        self.add_document('old', 2, 100)
+        self.add_global('oldGlobal', 3, 100)
+        self.add_document('recent', 4, 100)
+        self.add_global('recentGlobal', 5, 100)
+        cache.maxBytes = 200
+        cache.inUse.add('inUse')
+        try:
+            cache.remove_extra()
+        finally:
+            cache.inUse.discard('inUse')
+            cache.maxBytes = maxBytes
+        # the oldest ones go first, except the document in use
+        database = self.database()
+        self.assertEqual(list(database.execute('SELECT hash FROM documents')), [('inUse', )])
+        self.assertEqual(list(database.execute('SELECT key FROM global_paragraphs')), [('recentGlobal', )])
+        self.assertEqual(list(database.execute('SELECT DISTINCT document FROM paragraphs')), [('inUse', )])
+        self.assertEqual(cache.total_size(database), 200)
+        self.assertEqual(cache.knownBytes, 200)
+
+    def test_budget_during_writes(self):
+        cache.maxBytes = 1000
+        try:
+            cache.create_cache('document')
+            cache.inUse.add('document')
+            for i in range(20):
+                cache.write_global_paragraph(str(i), 'x' * 100)
+                cache.flush()
+                self.assertLessEqual(cache.total_size(cache.connect()), 1000)
+        finally:
+            cache.inUse.discard('document')
+            cache.maxBytes = maxBytes
+        # the least recently written ones are gone
+        self.assertEqual(sorted(int(key) for key, in self.database().execute('SELECT key FROM global_paragraphs')), list(range(10, 20)))
+
+    def test_stats(self):
+        self.add_document('old', 1, 100)
+        self.add_document('recent', 2, 100)
+        cache.count('paragraph cache hits', 3)
+        cache.count('paragraph cache misses', 1)
+        cache.maxBytes = 150
+        try:
+            cache.remove_extra()
+        finally:
+            cache.maxBytes = maxBytes
+        parser = argparse.ArgumentParser()
+        utils.add_arguments(parser)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertRaises(SystemExit, utils.process_options, parser.parse_args(['--cache-stats']))
+        lines = output.getvalue().splitlines()
+        for line in ('documents: 1', 'bytes: 100', 'hit ratio: 75.0%', 'evicted documents: 1', 'evicted bytes: 100'):
+            self.assertIn(line, lines)
+
+
+class TestLocking(CacheTest):
+    def test_readers_do_not_wait_for_the_database(self):
+        cache.write_paragraph('document', 'p1', 'T1')
+        other = self.database()
+        other.execute('BEGIN IMMEDIATE')
+        writer = threading.Thread(target=cache.flush)
+        writer.start()
+        try:
+            wait_for(lambda: cache.writingParagraphs)
+            time.sleep(0.1)
+            # the writer waits for the write lock of the other connection, the memory tier and the pending writes do not
+            start = time.monotonic()
+            cache.memory.clear()
+            self.assertEqual(cache.load_paragraph('document', 'p1'), 'T1')
+            cache.write_paragraph('document', 'p2', 'T2')
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertTrue(writer.is_alive())
+        finally:
+            other.execute('COMMIT')
+            writer.join()
+        cache.flush()
+        self.assertEqual(sorted(other.execute('SELECT hash, translation FROM paragraphs')), [('p1', 'T1'), ('p2', 'T2')])
+
+    def test_failed_write_is_pending_again(self):
+        cache.write_paragraph('document', 'p1', 'T1')
+        write = cache.write
+
+        def failing_write(*args):
+            # a newer translation of the same paragraph while the batch is written
+            cache.write_paragraph('document', 'p1', 'T1 new')
+            raise sqlite3.OperationalError('database is locked')
+
+        cache.write = failing_write
+        try:
+            self.assertRaises(sqlite3.OperationalError, cache.flush)
+        finally:
+            cache.write = write
+        self.assertEqual(cache.pendingParagraphs, {('document', 'p1'): 'T1 new'})
+        cache.flush()
+        self.assertEqual(list(self.database().execute('SELECT translation FROM paragraphs')), [('T1 new', )])
+
+
+if __name__ == '__main__':
+    unittest.main()
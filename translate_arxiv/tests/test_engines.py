@@ -0,0 +1,31 @@
+'''
+The engines: no rate limit unless one is asked for, and an engine without request fails when it is created.
+
+python -m pytest tests
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import engines
+
+
+class TestEngines(unittest.TestCase):
+    def test_no_rate_limit_by_default(self):
+        engine = engines.create_engine('mock')
+        self.assertEqual((engine.requestsPerSecond, engine.charsPerSecond), (0, 0))
+
+    def test_request_is_abstract(self):
+        class IncompleteEngine(engines.AsyncEngine):
+            pass
+
+        self.assertRaises(TypeError, IncompleteEngine)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+'''
+Importing the modules creates nothing in the working directory, which is the paper in the processes of the pipeline.
+
+python -m pytest tests
+'''
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+
+sourceDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestImports(unittest.TestCase):
+    def test_no_directories(self):
+        with tempfile.TemporaryDirectory() as paperDir:
+            subprocess.run([sys.executable, '-c', 'import translate, utils'], cwd=paperDir, check=True,
+                           env={**os.environ, 'PYTHONPATH': sourceDir})
+            self.assertEqual(os.listdir(paperDir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+'''
+A document translated into several languages is parsed once: the texts of each paragraph are collected once,
+and the requests of all the languages go through one engine.
+
+python -m pytest tests
+'''
+import io
+import os
+import sys
+import time
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import engines
+import translate
+from config import config
+
+
+paragraphs = 12
+document = '\\documentclass{article}\n\\begin{document}\n' + ''.join(f'Paragraph {i} of the model with $x_{i}$ in it.\n\n' for i in range(paragraphs)) + '\\end{document}\n'
+languages = ('zh-CN', 'ja', 'ko')
+
+
+class TestLanguages(unittest.TestCase):
+    def setUp(self):
+        self.saved = (config.mock_latency, config.mock_char_cost, config.max_in_flight)
+        config.mock_latency = 0
+        config.mock_char_cost = 0
+        with open('main.tex', 'w', encoding='utf-8') as f:
+            f.write(document)
+
+    def tearDown(self):
+        config.mock_latency, config.mock_char_cost, config.max_in_flight = self.saved
+
+    def translate(self, outputPaths, stream=False, batch=True):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            translate.translate_tex_file_to_languages('main.tex', outputPaths, 'mock', 'en', False, True, 0, batch, 1, stream)
+        return {language: open(path, encoding='utf-8').read() for language, path in outputPaths.items()}
+
+    def test_collected_once(self):
+        collect_texts = translate.LatexTranslator.collect_texts
+        create_engine = engines.create_engine
+        calls = []
+        created = []
+
+        def counted_collect_texts(latexTranslator, latexOriginalParagraph):
+            calls.append(latexOriginalParagraph)
+            return collect_texts(latexTranslator, latexOriginalParagraph)
+
+        def counted_create_engine(*args, **kwargs):
+            created.append(args)
+            return create_engine(*args, **kwargs)
+
+        translate.LatexTranslator.collect_texts = counted_collect_texts
+        engines.create_engine = counted_create_engine
+        try:
+            for stream in (False, True):
+                calls.clear()
+                created.clear()
+                translated = self.translate({language: f'{language}.tex' for language in languages}, stream)
+                self.assertEqual(len(calls), len(set(calls)))
+                self.assertGreaterEqual(len(calls), paragraphs)
+                self.assertEqual(len(created), 1)
+        finally:
+            translate.LatexTranslator.collect_texts = collect_texts
+            engines.create_engine = create_engine
+        for language in languages:
+            self.assertEqual(translated[language], self.translate({language: f'single_{language}.tex'})[language])
+
+    def test_interrupt(self):
+        # Ctrl-C stops the translation of all the languages, the requests which are not sent yet are dropped
+        config.mock_latency = 0.05
+        config.max_in_flight = 2
+        with open('main.tex', 'w', encoding='utf-8') as f:
+            f.write(document.replace('\\end{document}', ''.join(f'Another paragraph {i} of the model.\n\n' for i in range(100)) + '\\end{document}'))
+        write = translate.StreamWriter.write
+        create_engine = engines.create_engine
+        created = []
+        interrupted = []
+
+        def interrupted_write(writer, text):
+            write(writer, text)
+            if writer.chunks == 3:
+                interrupted.append(created[0].requests)
+                raise KeyboardInterrupt
+
+        def saved_create_engine(*args, **kwargs):
+            created.append(create_engine(*args, **kwargs))
+            return created[-1]
+
+        translate.StreamWriter.write = interrupted_write
+        engines.create_engine = saved_create_engine
+        try:
+            start = time.perf_counter()
+            with self.assertRaises(KeyboardInterrupt):
+                self.translate({language: f'{language}.tex' for language in languages}, True, False)
+            elapsed = time.perf_counter() - start
+        finally:
+            translate.StreamWriter.write = write
+            engines.create_engine = create_engine
+        requests = created[0].requests
+        time.sleep(0.3)
+        self.assertEqual(created[0].requests, requests)
+        # the requests waiting for a free slot when Ctrl-C is pressed may take the slots freed before the engine is closed
+        self.assertLessEqual(requests, interrupted[0] + config.max_in_flight)
+        self.assertLess(elapsed, 2)
+        # the next run resumes the languages from their checkpoints
+        config.mock_latency = 0
+        config.max_in_flight = self.saved[2]
+        resumed = self.translate({language: f'{language}.tex' for language in languages}, True, False)
+        self.assertEqual(resumed, self.translate({language: f'{language}.tex' for language in languages}))
+        self.assertEqual(os.listdir(config.stream_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+'''
+Macros which use themselves, or grow at each level, are expanded a bounded number of times.
+
+python -m pytest tests
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import process_latex
+
+
+class TestMacros(unittest.TestCase):
+    def test_expanded(self):
+        latex = '\\newcommand{\\be}{\\begin{equation}}\n\\be x = 1 \\end{equation}'
+        self.assertEqual(process_latex.process_newcommands(latex).count('\\begin{equation}'), 2)
+
+    def test_recursive(self):
+        latex = '\\newcommand{\\x}{\\begin{equation}\\x}\n\\x'
+        expansions = {}
+        result = process_latex.process_newcommands(latex, expansions)
+        self.assertEqual(result, '\\newcommand{\\x}{\\begin{equation}\\x}\n\\begin{equation}\\x')
+        self.assertEqual(expansions, {'x': 1})
+
+    def test_mutual_recursion(self):
+        latex = '\\newcommand{\\a}{\\begin{equation}\\b\\b}\\newcommand{\\b}{\\begin{equation}\\a\\a}\n\\a'
+        result = process_latex.process_newcommands(latex)
+        self.assertEqual(result.count('\\begin{equation}'), 2 + 3)
+
+    def test_budget(self):
+        # each level doubles the text, 2^10 copies of the innermost one
+        definitions = ''.join(f'\\newcommand{{\\m{chr(97 + i)}}}{{\\begin{{equation}}\\m{chr(98 + i)}\\m{chr(98 + i)}}}' for i in range(12))
+        latex = definitions + '\n\\ma'
+        maxMacroOutput = process_latex.maxMacroOutput
+        process_latex.maxMacroOutput = 1000
+        try:
+            result = process_latex.process_newcommands(latex)
+        finally:
+            process_latex.maxMacroOutput = maxMacroOutput
+        self.assertLessEqual(len(result) - len(latex), 1000)
+        self.assertIn('\\m', result[len(definitions):])
+
+
+if __name__ == '__main__':
+    unittest.main()
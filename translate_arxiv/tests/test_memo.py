@@ -0,0 +1,100 @@
+'''
+The translation memo: a text is found again with other spaces, and the threads which ask for the same
+text at the same time share one translation, or its error.
+
+python -m pytest tests
+'''
+import os
+import sys
+import time
+import tempfile
+import threading
+import unittest
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import engines
+from engines import mock_translate
+from translate import TextTranslator, TranslationMemo
+
+languages = ('en', 'zh-CN')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.001)
+
+
+class TestMemo(unittest.TestCase):
+    def test_normalized_key(self):
+        memo = TranslationMemo()
+        calls = []
+        memo.translate('the  text\t of \n  a line', languages, lambda text: calls.append(text) or 'TRANSLATION')
+        # the spaces around the text are kept, the ones inside are normalized
+        self.assertEqual(memo.translate(' the text of\na line\n', languages, calls.append), ' TRANSLATION\n')
+        self.assertEqual(memo.get('the text of\na line', languages), 'TRANSLATION')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        # another language is another translation
+        self.assertIsNone(memo.get('the text of\na line', ('en', 'ja')))
+
+    def test_single_flight(self):
+        memo = TranslationMemo()
+        release = threading.Event()
+        calls = []
+
+        def function(text):
+            calls.append(text)
+            release.wait()
+            return text.upper()
+
+        n = 8
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(memo.translate, 'text', languages, function) for i in range(n)]
+            wait_for(lambda: memo.coalesced == n - 1)
+            release.set()
+            results = [future.result() for future in futures]
+        self.assertEqual(results, ['TEXT'] * n)
+        self.assertEqual(calls, ['text'])
+        self.assertEqual((memo.misses, memo.coalesced), (1, n - 1))
+
+    def test_error_reaches_waiters(self):
+        memo = TranslationMemo()
+        release = threading.Event()
+
+        def function(text):
+            release.wait()
+            raise ValueError('engine error')
+
+        n = 4
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(memo.translate, 'text', languages, function) for i in range(n)]
+            wait_for(lambda: memo.coalesced == n - 1)
+            release.set()
+            for future in futures:
+                self.assertRaises(ValueError, future.result)
+        # nothing is kept, the next call translates again
+        self.assertFalse(memo.contains('text', languages))
+        self.assertEqual(memo.translate('text', languages, str.upper), 'TEXT')
+        self.assertEqual(memo.misses, 2)
+
+    def test_one_engine_call(self):
+        engine = engines.MockEngine(latency=0.05, charCost=0, requestsPerSecond=0, charsPerSecond=0)
+        translator = TextTranslator('mock', 'zh-CN', 'en', translator=engine)
+        n = 16
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n) as executor:
+            results = list(executor.map(translator.translate, ['the same text'] * n))
+        translator.close()
+        self.assertEqual(results, [mock_translate('the same text')] * n)
+        self.assertEqual(engine.requests, 1)
+        self.assertEqual(translator.numberOfCalls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
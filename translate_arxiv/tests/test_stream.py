@@ -0,0 +1,126 @@
+'''
+A streamed translation interrupted in translate_dir is resumed by the next run, from another directory.
+
+python -m pytest tests
+'''
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import translate
+from config import config
+from translate_arxiv import translate_dir
+
+
+document = '\\documentclass{article}\n\\begin{document}\n' + ''.join(f'Paragraph {i} of the model with $x_{i}$ in it.\n\n' for i in range(20)) + '\\end{document}\n'
+
+
+def make_source():
+    # a new temporary directory for each run, as translate_arxiv does
+    source = tempfile.mkdtemp()
+    with open(os.path.join(source, 'main.tex'), 'w', encoding='utf-8') as f:
+        f.write(document)
+    return source
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.saved = (config.stream, config.processes, config.checkpoint_interval, config.mock_latency, config.requests_per_second, config.reorder_window)
+        config.stream = True
+        config.processes = 1
+        config.checkpoint_interval = 0
+        config.mock_latency = 0
+        config.requests_per_second = 0
+        self.options = argparse.Namespace(notranslate=False, l_to=['zh-CN'], engine='mock', l_from='en', debug=False,
+                                          nocache=True, threads=0, nobatch=False)
+
+    def tearDown(self):
+        config.stream, config.processes, config.checkpoint_interval, config.mock_latency, config.requests_per_second, config.reorder_window = self.saved
+
+    def translate(self):
+        source = make_source()
+        cwd = os.getcwd()
+        os.chdir(source)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out, contextlib.redirect_stderr(io.StringIO()):
+                translate_dir('.', self.options)
+            with open('main.tex', encoding='utf-8') as f:
+                return f.read(), out.getvalue()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(source)
+
+    def test_resume(self):
+        expected, _ = self.translate()
+        write = translate.StreamWriter.write
+
+        def interrupted_write(writer, text):
+            write(writer, text)
+            if writer.chunks == 8:
+                raise KeyboardInterrupt
+
+        translate.StreamWriter.write = interrupted_write
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.translate()
+        finally:
+            translate.StreamWriter.write = write
+        resumed, out = self.translate()
+        self.assertIn('Resumed after 7 paragraphs', out)
+        self.assertEqual(resumed, expected)
+        self.assertEqual(os.listdir(config.stream_dir), [])
+
+    def test_resume_after_the_end(self):
+        # the run stops after the last chunk is checkpointed, the next one does not write the end again
+        expected, _ = self.translate()
+        finish_document = translate.LatexTranslator.finish_document
+
+        def interrupted_finish_document(latexTranslator):
+            raise KeyboardInterrupt
+
+        translate.LatexTranslator.finish_document = interrupted_finish_document
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.translate()
+        finally:
+            translate.LatexTranslator.finish_document = finish_document
+        resumed, out = self.translate()
+        self.assertIn('Resumed after 21 paragraphs', out)
+        self.assertEqual(resumed, expected)
+        self.assertEqual(os.listdir(config.stream_dir), [])
+
+    def test_resume_batches(self):
+        # the texts are batched a few paragraphs at a time, the paragraphs of the batches sent before an error are kept
+        config.reorder_window = 4
+        expected, _ = self.translate()
+        translate_batch = translate.TextTranslator.translate_batch
+        calls = []
+
+        def failing_translate_batch(textTranslator, texts):
+            calls.append(texts)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            translate_batch(textTranslator, texts)
+
+        translate.TextTranslator.translate_batch = failing_translate_batch
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.translate()
+        finally:
+            translate.TextTranslator.translate_batch = translate_batch
+        resumed, out = self.translate()
+        self.assertIn('Resumed after 8 paragraphs', out)
+        self.assertEqual(resumed, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
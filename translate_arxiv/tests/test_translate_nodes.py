@@ -0,0 +1,58 @@
+'''
+The text inside nested format commands is translated, at any depth and inside the translated objects.
+
+python -m pytest tests
+'''
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config and cache keep their files in the current directory when they are imported
+os.chdir(tempfile.mkdtemp())
+
+import translate
+from engines import mock_translate
+
+
+class MockTranslator:
+    engine = 'mock'
+    languageFrom = 'en'
+    languageTo = 'zh-CN'
+
+    def translate(self, text):
+        return mock_translate(text)
+
+
+def translate_paragraph(latex):
+    latexTranslator = translate.LatexTranslator(MockTranslator())
+    latexTranslator.complete = False
+    latexTranslator.theorems = []
+    latexTranslator.nbad = latexTranslator.ntotal = latexTranslator.num = 0
+    latexTranslator.set_targets()
+    latexTranslated = latexTranslator.translate_paragraph_latex(latex)
+    return re.sub(r'\s+', ' ', latexTranslated).replace('{ ', '{').replace(' }', '}').strip()
+
+
+class TestNestedFormat(unittest.TestCase):
+    def test_textcolor(self):
+        self.assertEqual(translate_paragraph(r'Text \textcolor{blue}{state \textbf{one \textbf{two words}}} tail.'),
+                         r'Text \textcolor{blue}{STATE ONE TWO WORDS} TAIL.')
+
+    def test_footnote(self):
+        self.assertEqual(translate_paragraph(r'Text \footnote{state \emph{one \textbf{two \textit{three words}}} end} tail.'),
+                         r'Text \footnote{STATE ONE TWO THREE WORDS END} TAIL.')
+
+    def test_footnote_in_textcolor(self):
+        self.assertEqual(translate_paragraph(r'Text \textcolor{blue}{state \emph{one \footnote{two \textbf{three \emph{four}}}} end} tail.'),
+                         r'Text \textcolor{blue}{STATE ONE \footnote{TWO THREE FOUR} END} TAIL.')
+
+    def test_item(self):
+        self.assertEqual(translate_paragraph(r'\begin{itemize} \item first \textbf{one \emph{two}} \item second $x$ words \end{itemize}'),
+                         r'\begin{itemize} \item FIRST ONE TWO \item SECOND $x$ WORDS \end{itemize}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,28 @@
 import process_latex
 import process_text
+import parse_latex
 import cache
 from config import config
+from metrics import metrics
 from process_latex import environmentList, commandList, formatList
 from process_text import charLimit
 from encoding import get_file_encoding
-import time
+import os
 import re
+import shutil
+import json
+import collections
+import time
+import queue
 import tqdm.auto
+import threading
+import multiprocessing
 import concurrent.futures
-import mtranslate as translator
+import engines
+
 
+patternHorizontalSpaces = re.compile(r'[ \t]+')
+patternLineBreak = re.compile(r'[ \t]*\n[ \t]*')
 
 defaultBegin = r'''
 \documentclass[UTF8]{article}
@@ -23,40 +35,325 @@ defaultEnd = r'''
 '''
 
 
+def progress_bar(iterable, total, translator):
+    # tqdm, with the live concurrency of the engine
+    with tqdm.auto.tqdm(total=total) as progress:
+        for item in iterable:
+            concurrency = translator.concurrency()
+            if concurrency is not None:
+                progress.set_postfix(concurrency=concurrency, refresh=False)
+            progress.update()
+            yield item
+
+
+def ordered_map(executor, function, items, window):
+    # executor.map, with at most window items submitted ahead of the result returned
+    futures = collections.deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class StreamWriter:
+    '''
+    Writes the translated document chunk by chunk to key + '.part' in config.stream_dir, which is moved to path by close().
+    A checkpoint (key + '.checkpoint') records the chunks written and their size, at most every
+    config.checkpoint_interval seconds, after they are flushed to the disk. A later run of the same document
+    (same key) finds it and continues the file after the last chunk of the checkpoint, even if its output is
+    somewhere else, e.g. in another temporary directory.
+    '''
+    def __init__(self, path, key):
+        os.makedirs(config.stream_dir, exist_ok=True)
+        self.path = path
+        self.partPath = os.path.join(config.stream_dir, key + '.part')
+        self.checkpointPath = os.path.join(config.stream_dir, key + '.checkpoint')
+        self.key = key
+        self.chunks = 0
+        self.size = 0
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None and checkpoint['key'] == key and os.path.exists(self.partPath) and os.path.getsize(self.partPath) >= checkpoint['size']:
+            self.chunks = checkpoint['chunks']
+            self.size = checkpoint['size']
+        self.file = open(self.partPath, 'r+b' if self.chunks else 'wb')
+        # the part written after the checkpoint is written again
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+        self.savedAt = time.monotonic()
+
+    def load_checkpoint(self):
+        try:
+            return json.load(open(self.checkpointPath, encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.chunks += 1
+        self.size += len(data)
+        if time.monotonic() - self.savedAt >= config.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        temporaryPath = self.checkpointPath + '.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as f:
+            json.dump({'key': self.key, 'chunks': self.chunks, 'size': self.size}, f)
+        os.replace(temporaryPath, self.checkpointPath)
+        self.savedAt = time.monotonic()
+
+    def close(self):
+        # the document is complete
+        self.file.close()
+        # the output may be on another file system
+        shutil.move(self.partPath, self.path)
+        if os.path.exists(self.checkpointPath):
+            os.remove(self.checkpointPath)
+
+    def abort(self):
+        # the chunks written so far are kept for the next run
+        self.checkpoint()
+        self.file.close()
+
+
+class TranslationStopped(Exception):
+    # raised in the threads which find the translation stopped, e.g. by Ctrl-C
+    pass
+
+
+class TranslationMemo:
+    '''
+    The translations of a run, keyed by the normalized text and the language pair, shared by all threads.
+    It is single-flight: a text requested while another thread is translating it waits for that translation
+    instead of being sent again.
+    Counts: hits (found), misses (translated), coalesced (waited for another thread).
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}  # key: (text, translation)
+        self.pending = {}  # key: future of (text, translation)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(text, languages):
+        # the spaces around the text and inside the lines do not change the translation
+        return patternHorizontalSpaces.sub(' ', patternLineBreak.sub('\n', text.strip())), languages
+
+    @staticmethod
+    def adapt(text, entry):
+        # the translation of entry for text, with the spaces around text
+        source, translation = entry
+        if text == source:
+            return translation
+        before, after = process_text.patternSpacesAround.match(text).groups()
+        return before + translation.strip() + after
+
+    def contains(self, text, languages):
+        return self.key(text, languages) in self.results
+
+    def get(self, text, languages):
+        # the translation of text, or None if it is not translated yet
+        entry = self.results.get(self.key(text, languages))
+        return None if entry is None else self.adapt(text, entry)
+
+    def put(self, text, languages, translation):
+        with self.lock:
+            self.results[self.key(text, languages)] = (text, translation)
+
+    def translate(self, text, languages, function):
+        # the translation of text, function(text) is called only if no thread has translated or is translating it
+        key = self.key(text, languages)
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is not None:
+                self.hits += 1
+                return self.adapt(text, entry)
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = concurrent.futures.Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return self.adapt(text, future.result())
+        try:
+            translation = function(text)
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise e
+        with self.lock:
+            self.results[key] = (text, translation)
+            del self.pending[key]
+        future.set_result((text, translation))
+        return translation
+
+    def report(self):
+        return f'{self.hits} hits, {self.misses} misses, {self.coalesced} coalesced'
+
+
 class TextTranslator:
-    def __init__(self, engine, languageTo, languageFrom):
+    def __init__(self, engine, languageTo, languageFrom, memo=None, translator=None):
+        # translator: an engine shared with the TextTranslators of other languages
         self.engine = engine
-        self.translator = translator
+        self.translator = engines.create_engine(engine) if translator is None else translator
         self.languageTo = languageTo
         self.languageFrom = languageFrom
+        self.languages = (languageFrom, languageTo)
+        self.memo = TranslationMemo() if memo is None else memo
+        self.lock = threading.Lock()
         self.numberOfCalls = 0
         self.totChar = 0
+        self.numberOfBatches = 0
+        self.batchFallbacks = 0
+        self.stop = threading.Event()  # the stop of the DocumentTranslation, no more requests are sent once it is set
+
+    def close(self):
+        if hasattr(self.translator, 'close'):
+            self.translator.close()
+
+    @staticmethod
+    def has_words(text):
+        return re.match(re.compile(r'.*[a-zA-Z].*', re.DOTALL), text) is not None
+
+    def concurrency(self):
+        # the requests the engine allows in flight now
+        limit = getattr(self.translator, 'limit', None)
+        return None if limit is None else limit.current()
 
     def try_translate(self, text):
         return self.translator.translate(text, self.languageTo, self.languageFrom)
 
+    def count(self, text):
+        with self.lock:
+            self.numberOfCalls += 1
+            self.totChar += len(text)
+
+    def request(self, text):
+        # the engine waits and retries when the provider asks to slow down
+        if self.stop.is_set():
+            raise TranslationStopped()
+        with metrics.stage('translation'):
+            result = self.try_translate(text)
+        self.count(text)
+        return result
+
     def translate(self, text):
-        if not re.match(re.compile(r'.*[a-zA-Z].*', re.DOTALL), text):
+        if not self.has_words(text):
             # no meaningful word inside
             return text
-        while True:
-            try:
-                result = self.try_translate(text)
-                break
-            except BaseException as e:
-                if hasattr(self.translator, "is_error_request_frequency") and self.translator.is_error_request_frequency(e):
-                    time.sleep(0.5)
-                else:
-                    raise e
-        self.numberOfCalls += 1
-        self.totChar += len(text)
-        return result
+        return self.memo.translate(text, self.languages, self.request)
+
+    def pack(self, texts):
+        '''
+        Groups the texts that are not translated yet into batches, each one is sent in a request of at most charLimit characters.
+        '''
+        batches = []
+        batch = Batch()
+        for text in dict.fromkeys(texts):
+            if self.memo.contains(text, self.languages) or not self.has_words(text):
+                continue
+            if not batch.add(text):
+                batches.append(batch.texts)
+                batch = Batch()
+                batch.add(text)
+        if batch.texts:
+            batches.append(batch.texts)
+        return batches
+
+    def translate_batch(self, texts):
+        '''
+        Translates texts in one request, separated by delimiter lines, and keeps the translations in the memo.
+        If the delimiters are not found in the translation as they were sent, the texts are translated one by one.
+        '''
+        if len(texts) == 1:
+            self.translate(texts[0])
+            return
+        if self.stop.is_set():
+            raise TranslationStopped()
+        with metrics.stage('translation'):
+            translations = self.translator.translate_batch(texts, self.languageTo, self.languageFrom)
+        self.count(''.join(texts))
+        with self.lock:
+            self.numberOfBatches += 1
+            if translations is None:
+                self.batchFallbacks += 1
+        if translations is None:
+            for text in texts:
+                self.translate(text)
+            return
+        for text, translation in zip(texts, translations):
+            self.memo.put(text, self.languages, translation)
+
+
+class Batch:
+    # texts sent in one request of at most charLimit characters, future is done when their translations are in the memo
+    def __init__(self):
+        self.texts = []
+        self.size = 0
+        self.future = concurrent.futures.Future()
+
+    def add(self, text):
+        # False if the text does not fit
+        length = len(text) + len(process_text.batch_code(len(self.texts))) + 2
+        if self.texts and self.size + length >= charLimit - 10:
+            return False
+        self.texts.append(text)
+        self.size += length
+        return True
+
+
+class TextCollector:
+    # used in place of a TextTranslator, records the texts to translate and returns them as they are
+    def __init__(self):
+        self.texts = []
+
+    def translate(self, text):
+        self.texts.append(text)
+        return text
+
+
+class TextReplayer:
+    # used in place of a TextTranslator in the processes of the pipeline, answers with the translations found beforehand
+    def __init__(self, translations):
+        self.translations = translations
+
+    def translate(self, text):
+        if not TextTranslator.has_words(text):
+            return text
+        return self.translations[text]
+
+
+class ParsedDocument:
+    # the result of LatexTranslator.prepare, shared by the translations into different languages
+    def __init__(self, source):
+        self.source = source  # the original latex, for the cache key
+        self.complete = False
+        self.theorems = []
+        self.texBegin = ''
+        self.texEnd = ''
+        self.paragraphs = []
+        self.texts = []  # the texts of each paragraph, None until they are collected, the same in every language
 
 
 class LatexTranslator:
-    def __init__(self, translator: TextTranslator, debug=False, threads=0):
+    def __init__(self, translator: TextTranslator, debug=False, threads=0, batch=True, processes=1):
         self.translator = translator
         self.debug = debug
+        self.batch = batch
+        self.processes = processes if processes > 0 else os.cpu_count()
         if self.debug:
             self.fOld = open("text_old", "w", encoding='utf-8')
             self.fNew = open("text_new", "w", encoding='utf-8')
@@ -66,6 +363,12 @@ class LatexTranslator:
         else:
             self.threads = threads
 
+    def workers(self):
+        # auto threads can keep the most requests of the engine in flight, the engine adapts the concurrency below
+        if self.threads is not None:
+            return self.threads
+        return max(config.max_in_flight, min(32, (os.cpu_count() or 1) + 4))
+
     def close(self):
         if self.debug:
             self.fOld.close()
@@ -95,24 +398,21 @@ class LatexTranslator:
         textTranslated = '\n'.join(partsTranslated)
         return textTranslated.replace("\u200b", "")
 
-    def _translate_text_in_paragraph_latex(self, latexOriginalParagraph):
+    def _translate_text_in_paragraph_latex(self, textOriginalParagraph, objs):
         '''
-        Translate a latex paragraph, which means that it could contain latex objects
+        Translate the text of a latex paragraph, where the latex objects are replaced by the variable codes of objs
         '''
 
-        # remove format about textbf, emph and textit
-        for formatName in formatList:
-            latexOriginalParagraph = process_latex.delete_specific_format(latexOriginalParagraph, formatName)
-
-        textOriginalParagraph, objs = process_latex.replace_latex_objects(latexOriginalParagraph)
-        # Since \n is equivalent to space in latex, we change \n back to space
-        # otherwise the translators view them as separate sentences
-        textOriginalParagraph = process_latex.combine_split_to_sentences(textOriginalParagraph)
-        textOriginalParagraph = process_text.split_too_long_paragraphs(textOriginalParagraph)
-        if not self.complete:
-            textOriginalParagraph = process_text.split_titles(textOriginalParagraph)
-        # Remove additional space
-        textOriginalParagraph = re.sub(r'  +', ' ', textOriginalParagraph)
+        with metrics.stage('placeholders'):
+            textOriginalParagraph = process_latex.modify_text(textOriginalParagraph, process_latex.modify_before)
+            # Since \n is equivalent to space in latex, we change \n back to space
+            # otherwise the translators view them as separate sentences
+            textOriginalParagraph = process_latex.combine_split_to_sentences(textOriginalParagraph)
+            textOriginalParagraph = process_text.split_too_long_paragraphs(textOriginalParagraph)
+            if not self.complete:
+                textOriginalParagraph = process_text.split_titles(textOriginalParagraph)
+            # Remove additional space
+            textOriginalParagraph = re.sub(r'  +', ' ', textOriginalParagraph)
         if self.debug:
             print(f'\n\nParagraph {self.num}\n\n', file=self.fOld)
             print(textOriginalParagraph, file=self.fOld)
@@ -124,48 +424,94 @@ class LatexTranslator:
             for i, obj in enumerate(objs):
                 print(f'obj {i}', file=self.fObj)
                 print(obj, file=self.fObj)
-        latexTranslatedParagraph, nbad, ntotal = process_latex.recover_latex_objects(textTranslatedParagraph, objs, tolerateError=True)
+        with metrics.stage('recovery'):
+            latexTranslatedParagraph, nbad, ntotal = process_latex.recover_latex_objects(textTranslatedParagraph, objs, tolerateError=True)
         self.nbad += nbad
         self.ntotal += ntotal
         return latexTranslatedParagraph
 
-    def translate_text_in_paragraph_latex(self, paragraph):
-        splitedParagraphs, seps = process_latex.split_by_command(paragraph)
-        result = ''
-        for split, sep in zip(splitedParagraphs, seps):
-            result += self._translate_text_in_paragraph_latex(split) + ' ' + sep + ' '
-        return result
-
-    def translate_latex_all_objects(self, latex):
+    def set_targets(self):
         '''
         Terminology:
         env: '\\begin{xxx} \\end{xxx}'
         command: '\\command[options]{text}
         object: env or command
+        The objects whose text is translated, and the arguments of the commands with several arguments
         '''
-        translateFunction = self.translate_text_in_paragraph_latex_and_leading_brace
+        self.envTargets = set()
         for envName in environmentList + self.theorems:
-            latex = process_latex.process_specific_env(latex, translateFunction, envName)
-            latex = process_latex.process_specific_env(latex, translateFunction, envName + r'\*')
+            self.envTargets.update([envName, envName + '*'])
+        self.commandTargets = {}
         for commandName in commandList:
-            latex = process_latex.process_specific_command(latex, translateFunction, commandName)
-            latex = process_latex.process_specific_command(latex, translateFunction, commandName + r'\*')
-        for commandGroup in config.mularg_command_list:
-            latex = process_latex.process_mularg_command(latex, translateFunction, commandGroup)
-        return latex
+            self.commandTargets[commandName] = (1, (0, ))
+            self.commandTargets[commandName + '*'] = (1, (0, ))
+        self.commandArgs = {}
+        for commandName, nargs, argsToTranslate in config.mularg_command_list:
+            self.commandTargets[commandName] = (nargs, tuple(argsToTranslate))
+            self.commandArgs[commandName] = nargs
+
+    def render_node(self, latex, node, leading):
+        '''
+        Returns the latex of a parsed node with the text of the objects inside translated.
+        leading means that the node is not inside other objects, so braces {xxx} are translated as well.
+        '''
+        if node.kind == 'brace' and leading:
+            return f'{{ {self.translate_nodes(latex, node.children)} }}'
+        if node.kind == 'env' and node.name in self.envTargets:
+            return latex[node.start:node.contentStart] + self.translate_nodes(latex, node.children) + latex[node.contentEnd:node.end]
+        if node.kind == 'command':
+            nargs, argsToTranslate = self.commandTargets.get(node.name, (None, ()))
+            if len(node.children) == nargs:
+                rendered = []
+                for i, arg in enumerate(node.children):
+                    if i in argsToTranslate:
+                        rendered.append(f'{{{self.translate_nodes(latex, arg.children)}}}')
+                    else:
+                        rendered.append(self.render_node(latex, arg, False))
+                return parse_latex.stitch(latex, node, rendered)
+        if not node.children:
+            return latex[node.start:node.end]
+        return parse_latex.stitch(latex, node, [self.render_node(latex, child, False) for child in node.children])
+
+    def collect_units(self, latex, nodes, units):
+        '''
+        Adds the nodes to the units of translation, [(pieces of text, objects)], the last one is being filled.
+        The format commands are removed and their content is part of the text, at any depth, \\item starts a new unit,
+        and the other nodes are rendered, i.e. the objects and leading level braces are translated first,
+        then they are kept as latex objects in the text around them.
+        '''
+        for node in nodes:
+            pieces, objs = units[-1]
+            if node.kind == 'text':
+                pieces.append(latex[node.start:node.end])
+            elif node.kind == 'command' and node.name == 'item' and not node.children:
+                units.append(([], []))
+            elif node.kind == 'command' and node.name in formatList and len(node.children) == 1:
+                pieces.append(' ')
+                self.collect_units(latex, node.children[0].children, units)
+                units[-1][0].append(' ')
+            else:
+                pieces.append(' ' + process_latex.variable_code(len(objs)) + ' ')
+                objs.append(' ' + self.render_node(latex, node, True) + ' ')
+
+    def translate_nodes(self, latex, nodes):
+        units = [([], [])]
+        with metrics.stage('placeholders'):
+            self.collect_units(latex, nodes, units)
+        return ' \\item '.join(self._translate_text_in_paragraph_latex(''.join(pieces), objs) for pieces, objs in units)
 
     def translate_text_in_paragraph_latex_and_leading_brace(self, latexOriginalParagraph):
-        # it acts recursively, i.e. it also translates braces inside braces
-        latexTranslatedParagraph = self.translate_text_in_paragraph_latex(latexOriginalParagraph)
-        latexTranslatedParagraph = process_latex.process_leading_level_brace(latexTranslatedParagraph, self.translate_text_in_paragraph_latex_and_leading_brace)
-        return latexTranslatedParagraph
+        # it acts recursively, i.e. it also translates braces inside braces and the objects inside
+        # the paragraph is parsed only once
+        with metrics.stage('parsing'):
+            root = parse_latex.parse_latex(latexOriginalParagraph, self.commandArgs)
+        return self.translate_nodes(latexOriginalParagraph, root.children)
 
     def translate_paragraph_latex(self, latexOriginalParagraph):
-        latexTranslatedParagraph = self.translate_text_in_paragraph_latex_and_leading_brace(latexOriginalParagraph)
-        latexTranslatedParagraph = self.translate_latex_all_objects(latexTranslatedParagraph)
-        return latexTranslatedParagraph
+        return self.translate_text_in_paragraph_latex_and_leading_brace(latexOriginalParagraph)
 
-    def split_latex_to_paragraphs(self, latex):
+    @staticmethod
+    def split_latex_to_paragraphs(latex):
         '''
         1. convert latex to text and objects
         2. split text
@@ -176,14 +522,61 @@ class LatexTranslator:
         paragraphsLatex = [process_latex.recover_latex_objects(paragraphText, objs)[0] for paragraphText in paragraphsText]
         return paragraphsLatex
 
+    @staticmethod
+    def for_document(translator, theorems, complete):
+        # a LatexTranslator for the paragraphs of a document, e.g. with another translator or in another process
+        latexTranslator = LatexTranslator(translator)
+        latexTranslator.theorems = theorems
+        latexTranslator.complete = complete
+        latexTranslator.set_targets()
+        latexTranslator.nbad = 0
+        latexTranslator.ntotal = 0
+        latexTranslator.num = 0
+        return latexTranslator
+
+    def collect_texts(self, latexOriginalParagraph):
+        '''
+        Returns the texts that are sent to the translator when the paragraph is translated.
+        The paragraph goes through the whole process with a TextCollector, the objects are replaced by codes
+        before the texts are sent, so the translation of the objects does not change the texts.
+        It does not depend on the language, nor change self, which may be translating in other threads.
+        '''
+        collector = TextCollector()
+        LatexTranslator.for_document(collector, self.theorems, self.complete).translate_paragraph_latex(latexOriginalParagraph)
+        return collector.texts
+
+    def global_key(self, latexOriginalParagraph):
+        # the key of the paragraph in the cache shared by all documents, with everything its translation depends on
+        return cache.deterministic_hash((latexOriginalParagraph, self.contextKey))
+
+    def load_cached(self, latexOriginalParagraph, peek=False):
+        '''
+        The translation of the paragraph in the cache of the document, or else in the global cache,
+        where an unchanged paragraph of another version of the document or of another document is found. None if not cached.
+        With peek, nothing is counted or copied to the cache of the document.
+        '''
+        hashKeyParagraph = cache.deterministic_hash(latexOriginalParagraph)
+        latexTranslatedParagraph = cache.load_paragraph(self.hashKey, hashKeyParagraph)
+        if latexTranslatedParagraph is None:
+            latexTranslatedParagraph = cache.load_global_paragraph(self.global_key(latexOriginalParagraph))
+            if latexTranslatedParagraph is not None and not peek:
+                cache.write_paragraph(self.hashKey, hashKeyParagraph, latexTranslatedParagraph)
+                metrics.count('global cache hits')
+        if not peek:
+            metrics.count('paragraph cache misses' if latexTranslatedParagraph is None else 'paragraph cache hits')
+        return latexTranslatedParagraph
+
+    def save_cached(self, latexOriginalParagraph, latexTranslatedParagraph):
+        cache.write_paragraph(self.hashKey, cache.deterministic_hash(latexOriginalParagraph), latexTranslatedParagraph)
+        cache.write_global_paragraph(self.global_key(latexOriginalParagraph), latexTranslatedParagraph)
+
     def worker(self, latexOriginalParagraph):
         try:
             if self.addCache:
-                hashKeyParagraph = cache.deterministic_hash(latexOriginalParagraph)
-                latexTranslatedParagraph = cache.load_paragraph(self.hashKey, hashKeyParagraph)
+                latexTranslatedParagraph = self.load_cached(latexOriginalParagraph)
                 if latexTranslatedParagraph is None:
                     latexTranslatedParagraph = self.translate_paragraph_latex(latexOriginalParagraph)
-                    cache.write_paragraph(self.hashKey, hashKeyParagraph, latexTranslatedParagraph)
+                    self.save_cached(latexOriginalParagraph, latexTranslatedParagraph)
             else:
                 latexTranslatedParagraph = self.translate_paragraph_latex(latexOriginalParagraph)
             self.num += 1
@@ -194,31 +587,43 @@ class LatexTranslator:
             print(latexOriginalParagraph)
             raise e
 
-    def translate_full_latex(self, latexOriginal, makeComplete=True, noCache=False):
-        self.addCache = (not noCache)
-        if self.addCache:
-            cache.remove_extra()
-            # self.hashKey = cache.deterministic_hash((latexOriginal, __version__, self.translator.engine, self.translator.languageFrom, self.translator.languageTo, config.mularg_command_list))
-            self.hashKey = cache.deterministic_hash((latexOriginal, self.translator.engine, self.translator.languageFrom, self.translator.languageTo, config.mularg_command_list))
-            if cache.is_cached(self.hashKey):
-                print('Cache is found')
-            cache.create_cache(self.hashKey)
+    def postprocess(self, latexTranslated):
+        # it only changes the text locally, so it can run on the whole document or on each paragraph
+        with metrics.stage('title'):
+            latexTranslated = process_latex.process_specific_command(latexTranslated, self.translate_text_in_paragraph_latex_and_leading_brace, 'title')
 
-        self.nbad = 0
-        self.ntotal = 0
+        latexTranslated = latexTranslated.replace('%', '\\%')
+        latexTranslated = process_latex.recover_special(latexTranslated)
+        latexTranslated = process_latex.recover_accent(latexTranslated)
+        return latexTranslated
 
-        latexOriginal = process_latex.remove_tex_comments(latexOriginal)
+    @staticmethod
+    def prepare(latexOriginal, makeComplete=True):
+        '''
+        Everything before the translation, which does not depend on the languages, so that a document
+        translated into several languages is parsed once.
+        '''
+        document = ParsedDocument(latexOriginal)
+        process_latex.patternRegistry.start_document()
+        start = time.perf_counter()
+
+        with metrics.stage('comment removal'):
+            latexOriginal = process_latex.remove_tex_comments(latexOriginal)
         latexOriginal = latexOriginal.replace(r'\mathbf', r'\boldsymbol')
         # \bibinfo {note} is not working in xelatex
         latexOriginal = process_latex.remove_bibnote(latexOriginal)
-        latexOriginal = process_latex.process_newcommands(latexOriginal)
+        macroExpansions = {}
+        with metrics.stage('newcommand expansion'):
+            latexOriginal = process_latex.process_newcommands(latexOriginal, macroExpansions)
+        if macroExpansions:
+            print('Macros expanded:', ', '.join(f'\\{name} x{n}' for name, n in sorted(macroExpansions.items())))
 
         latexOriginal = process_latex.replace_accent(latexOriginal)
         latexOriginal = process_latex.replace_special(latexOriginal)
 
-        self.complete = process_latex.is_complete(latexOriginal)
-        self.theorems = process_latex.get_theorems(latexOriginal)
-        if self.complete:
+        document.complete = process_latex.is_complete(latexOriginal)
+        document.theorems = process_latex.get_theorems(latexOriginal)
+        if document.complete:
             print('It is a full latex document')
             latexOriginal, texBegin, texEnd = process_latex.split_latex_document(latexOriginal, r'\begin{document}', r'\end{document}')
             texBegin = process_latex.remove_blank_lines(texBegin)
@@ -232,42 +637,565 @@ class LatexTranslator:
             else:
                 texBegin = ''
                 texEnd = ''
+        document.texBegin = texBegin
+        document.texEnd = texEnd
 
-        latexOriginalParagraphs = self.split_latex_to_paragraphs(latexOriginal)
-        latexTranslatedParagraphs = []
-        self.num = 0
-        # tqdm with concurrent.futures.ThreadPoolExecutor()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-            latexTranslatedParagraphs = list(tqdm.auto.tqdm(executor.map(self.worker, latexOriginalParagraphs), total=len(latexOriginalParagraphs)))
+        with metrics.stage('paragraph splitting'):
+            document.paragraphs = LatexTranslator.split_latex_to_paragraphs(latexOriginal)
+        document.texts = [None] * len(document.paragraphs)
+        metrics.set('paragraphs', len(document.paragraphs))
+        metrics.set('preprocess elapsed', time.perf_counter() - start)
+        return document
 
-        latexTranslated = '\n\n'.join(latexTranslatedParagraphs)
+    def translate_full_latex(self, latexOriginal, makeComplete=True, noCache=False, output=None):
+        '''
+        Returns the translated document, or writes it to output, a StreamWriter, as the paragraphs are translated
+        and returns None.
+        '''
+        return self.translate_document(self.prepare(latexOriginal, makeComplete), noCache, output)
 
-        latexTranslated = texBegin + '\n' + latexTranslated + '\n' + texEnd
+    def document_key(self, document):
+        # self.hashKey = cache.deterministic_hash((latexOriginal, __version__, self.translator.engine, self.translator.languageFrom, self.translator.languageTo, config.mularg_command_list))
+        return cache.deterministic_hash((document.source, self.translator.engine, self.translator.languageFrom, self.translator.languageTo, config.mularg_command_list))
 
-        # Title is probably outside the body part
-        self.num = 'title'
-        latexTranslated = process_latex.process_specific_command(latexTranslated, self.translate_text_in_paragraph_latex, 'title')
+    def start_document(self, document, noCache=False):
+        # the state of the translation of a prepared document
+        self.addCache = (not noCache)
+        if self.addCache:
+            self.hashKey = self.document_key(document)
+            if cache.is_cached(self.hashKey):
+                print('Cache is found')
+            cache.create_cache(self.hashKey)
+            cache.inUse.add(self.hashKey)
+            cache.remove_extra()
 
-        latexTranslated = latexTranslated.replace('%', '\\%')
-        latexTranslated = process_latex.recover_special(latexTranslated)
-        latexTranslated = process_latex.recover_accent(latexTranslated)
+        self.nbad = 0
+        self.ntotal = 0
+        self.complete = document.complete
+        self.theorems = document.theorems
+        self.set_targets()
+        # what the translation of a paragraph depends on, besides the paragraph
+        self.contextKey = (self.translator.engine, self.translator.languageFrom, self.translator.languageTo, config.mularg_command_list, self.complete, sorted(self.theorems))
+        self.num = 0
 
+    def finish_document(self):
         self.close()
+        if self.addCache:
+            cache.flush()
+            cache.inUse.discard(self.hashKey)
 
         print(self.ntotal - self.nbad, '/',  self.ntotal, 'latex object are correctly translated')
+        regexFallbacks = process_latex.patternRegistry.fallback_report()
+        if regexFallbacks:
+            print('Regex timeouts, linear fallback used:', regexFallbacks)
+        if self.debug:
+            print(process_latex.patternRegistry.report())
+
+    def translate_document(self, document, noCache=False, output=None):
+        # translate_full_latex on a prepared document
+        language = self.translator.languageTo
+        outputs = None if output is None else {language: output}
+        return DocumentTranslation({language: self}, document).translate(noCache, outputs)[language]
+
+
+class DocumentTranslation:
+    '''
+    The translation of a prepared document into several languages at the same time, with a LatexTranslator for each.
+    The texts of each paragraph are collected once, in document.texts, and the requests of all the languages
+    go through one pool of I/O threads and one batcher; with the pipeline, the parsing and the recovery
+    of all the languages run in one process pool.
+    '''
+    def __init__(self, latexTranslators, document):
+        self.latexTranslators = latexTranslators  # {language: LatexTranslator}
+        self.document = document
+        first = next(iter(latexTranslators.values()))
+        self.translator = first.translator  # for the progress bar, the engine is shared
+        self.batch = first.batch
+        self.debug = first.debug
+        self.processes = first.processes
+        self.workers = first.workers()
+        self.ioPool = None
+        self.processPool = None
+        self.stop = threading.Event()  # set on an error or an interrupt, the paragraphs which are not translated yet are not requested
+        self.prefetched = set()  # (language, text) of the texts in the batches sent
+        for latexTranslator in latexTranslators.values():
+            latexTranslator.translator.stop = self.stop
+
+    def translate(self, noCache=False, outputs=None):
+        '''
+        Returns {language: translated document}, or writes each document to its StreamWriter in outputs
+        {language: StreamWriter} as the paragraphs are translated and returns {language: None}.
+        '''
+        document = self.document
+        prefix = len(self.latexTranslators) > 1
+        for latexTranslator in self.latexTranslators.values():
+            latexTranslator.start_document(document, noCache)
+        starts = {}
+        latexTranslatedParagraphs = {language: [] for language in self.latexTranslators}
+        for language, latexTranslator in self.latexTranslators.items():
+            if outputs is None:
+                starts[language] = 0
+                continue
+            # the paragraphs written before a restart are not translated again
+            output = outputs[language]
+            if output.chunks == 0:
+                output.write(latexTranslator.postprocess(document.texBegin + '\n'))
+            # the chunks are texBegin, one per paragraph and texEnd, which is there if the run stopped after it
+            starts[language] = min(output.chunks - 1, len(document.paragraphs))
+            if starts[language] > 0:
+                print(f'[{language}] ' * prefix + f'Resumed after {starts[language]} paragraphs')
+        start = time.perf_counter()
+        # with outputs, the first paragraphs are written, and checkpointed, before the whole document is translated
+        paragraphs = self.translate_paragraphs(starts, None if outputs is None else config.reorder_window)
+        try:
+            for index, latexTranslated in paragraphs:
+                for language, latexTranslatedParagraph in latexTranslated.items():
+                    if outputs is None:
+                        latexTranslatedParagraphs[language].append(latexTranslatedParagraph)
+                    else:
+                        output = outputs[language]
+                        output.write(self.latexTranslators[language].postprocess(('\n\n' if output.chunks > 1 else '') + latexTranslatedParagraph))
+        except BaseException:
+            # e.g. KeyboardInterrupt, the requests which are not sent yet are cancelled instead of waited for
+            self.stop.set()
+            raise
+        finally:
+            self.close()
+            paragraphs.close()
+        metrics.set('paragraphs elapsed', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        results = {}
+        for language, latexTranslator in self.latexTranslators.items():
+            if outputs is None:
+                latexTranslated = '\n\n'.join(latexTranslatedParagraphs[language])
+                latexTranslated = document.texBegin + '\n' + latexTranslated + '\n' + document.texEnd
+                # Title is probably outside the body part
+                latexTranslator.num = 'title'
+                results[language] = latexTranslator.postprocess(latexTranslated)
+            else:
+                if outputs[language].chunks == len(document.paragraphs) + 1:
+                    outputs[language].write(latexTranslator.postprocess('\n' + document.texEnd) + '\n')
+                results[language] = None
+            latexTranslator.finish_document()
+        if outputs is None:
+            metrics.set('postprocess elapsed', time.perf_counter() - start)
+        return results
+
+    def close(self):
+        for pool in (self.processPool, self.ioPool):
+            if pool is not None:
+                pool.shutdown(wait=not self.stop.is_set(), cancel_futures=True)
+
+    def texts(self, index):
+        # the texts of a paragraph, collected once for all the languages
+        document = self.document
+        if document.texts[index] is None:
+            document.texts[index] = next(iter(self.latexTranslators.values())).collect_texts(document.paragraphs[index])
+        return document.texts[index]
+
+    def translate_paragraphs(self, starts, window=None):
+        '''
+        Yields (index, {language: translated paragraph}) in order, from the first paragraph one of the languages needs,
+        with the languages whose start is at most index; at most config.reorder_window of them wait for the ones before.
+        With window, the texts are batched window paragraphs at a time instead of all at once.
+        '''
+        indices = range(min(starts.values(), default=0), len(self.document.paragraphs))
+        self.ioPool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        if self.batch and not self.debug and self.processes > 1:
+            document = self.document
+            initargs = (cache.cache_dir(), config.mularg_command_list, config.regex_timeout, document.theorems, document.complete)
+            self.processPool = concurrent.futures.ProcessPoolExecutor(self.processes, multiprocessing.get_context('spawn'), init_process, initargs)
+            yield from ParagraphPipeline(self).run(indices, starts)
+            return
+        translate = lambda index: (index, self.translate_paragraph(index, starts))
+        if self.batch and window is not None:
+            yield from progress_bar(self.translate_windows(indices, starts, window, translate), len(indices), self.translator)
+            return
+        futures = self.prefetch(indices, starts) if self.batch else []
+        if futures:
+            list(progress_bar(concurrent.futures.as_completed(futures), len(futures), self.translator))
+            for future in futures:
+                future.result()
+        yield from progress_bar(ordered_map(self.ioPool, translate, indices, config.reorder_window), len(indices), self.translator)
+
+    def translate_windows(self, indices, starts, window, translate):
+        # the batches of the next window are translated while the paragraphs of a window are translated
+        windows = [indices[i:i + window] for i in range(0, len(indices), window)]
+        futures = self.prefetch(windows[0], starts, False) if windows else []
+        for i, paragraphs in enumerate(windows):
+            nextFutures = self.prefetch(windows[i + 1], starts, False) if i + 1 < len(windows) else []
+            for future in futures:
+                future.result()
+            yield from ordered_map(self.ioPool, translate, paragraphs, config.reorder_window)
+            futures = nextFutures
+
+    def prefetch(self, indices, starts, verbose=True):
+        '''
+        The short texts of many paragraphs are translated together, the paragraphs then find their translations in the memo.
+        Returns the futures of the batches, which are sent to the I/O pool.
+        '''
+        batches = []
+        for language, latexTranslator in self.latexTranslators.items():
+            paragraphs = [index for index in indices if index >= starts[language]]
+            if latexTranslator.addCache:
+                paragraphs = [index for index in paragraphs if latexTranslator.load_cached(self.document.paragraphs[index], peek=True) is None]
+            textTranslator = latexTranslator.translator
+            texts = [text for index in paragraphs for text in self.texts(index) if (language, text) not in self.prefetched]
+            batches += [(textTranslator, batch) for batch in textTranslator.pack(texts)]
+            self.prefetched.update((language, text) for text in texts)
+        if verbose and batches:
+            print(f'{sum(len(batch) for textTranslator, batch in batches)} texts are translated in {len(batches)} batches')
+        return [self.ioPool.submit(textTranslator.translate_batch, batch) for textTranslator, batch in batches]
+
+    def translate_paragraph(self, index, starts):
+        # {language: translated paragraph} for the languages which need it, in a thread of the I/O pool
+        latexOriginalParagraph = self.document.paragraphs[index]
+        latexTranslated = {}
+        for language, latexTranslator in self.latexTranslators.items():
+            if self.stop.is_set():
+                raise TranslationStopped()
+            if index >= starts[language]:
+                latexTranslated[language] = latexTranslator.worker(latexOriginalParagraph)
+        return latexTranslated
+
+
+processTranslator = None  # the LatexTranslator of a process of the pipeline
+
+
+def init_process(cacheDir, mularg_command_list, regex_timeout, theorems, complete):
+    # the processes are spawned, so the state they need is set again
+    global processTranslator
+    cache.set_cache_dir(cacheDir)
+    config.mularg_command_list = mularg_command_list
+    config.regex_timeout = regex_timeout
+    processTranslator = LatexTranslator.for_document(None, theorems, complete)
+
+
+def collect_paragraph(latexOriginalParagraph):
+    # the texts, with the metrics of the process, which are merged in the main process
+    return processTranslator.collect_texts(latexOriginalParagraph), metrics.take()
+
+
+def render_paragraph(latexOriginalParagraph, translations):
+    # the translated paragraph, with the number of bad and total objects and the metrics of the process
+    processTranslator.translator = TextReplayer(translations)
+    processTranslator.nbad = 0
+    processTranslator.ntotal = 0
+    latexTranslatedParagraph = processTranslator.translate_paragraph_latex(latexOriginalParagraph)
+    return latexTranslatedParagraph, processTranslator.nbad, processTranslator.ntotal, metrics.take()
+
+
+class ParagraphJob:
+    def __init__(self, index, paragraph, languages):
+        self.index = index
+        self.paragraph = paragraph
+        self.languages = languages  # the languages which need the paragraph
+        self.latex = {}  # language: translation, if it is in the cache
+        self.collectFuture = None
+        self.texts = None
+        self.batches = {}  # language: futures of the batches with the texts of this paragraph
+        self.renderFutures = {}  # language: future of the rendered paragraph
+        self.fallback = False  # translated by LatexTranslator.worker in the main process
+        self.queued = None  # when it was put in the last queue
+
+    def missing(self):
+        # the languages to translate, which are not in the cache
+        return [language for language in self.languages if language not in self.latex]
+
+
+class ParagraphPipeline:
+    '''
+    Translates paragraphs into all the languages of a DocumentTranslation in three stages, each one in a thread,
+    connected by bounded queues:
+    1. collect: the process pool finds the texts of each paragraph, i.e. parsing and placeholders, once for all the languages,
+    2. translate: the texts of consecutive paragraphs are packed into batches of each language and translated by the I/O threads,
+    3. render: the process pool builds each translated paragraph from the translations of its texts, in each language.
+    The regex work runs on all cores while the requests wait for the network, and at most
+    queueSize paragraphs wait between two stages. The paragraphs come out in order.
+    A paragraph which fails in the processes is translated again by LatexTranslator.worker, which reports the error.
+    '''
+    def __init__(self, translation, queueSize=None):
+        self.translation = translation
+        self.latexTranslators = translation.latexTranslators
+        self.queueSize = config.pipeline_queue_size if queueSize is None else queueSize
+        self.stop = threading.Event()
+        self.error = None
+        self.pendingTexts = {}  # (text, languages): future of the batch which translates it
+
+    def get(self, source):
+        while True:
+            try:
+                return self.dequeued(source.get(timeout=0.1))
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise TranslationStopped()
+
+    @staticmethod
+    def dequeued(job):
+        if job is not None:
+            metrics.observe('queue wait', time.perf_counter() - job.queued)
+        return job
+
+    def wait(self, future):
+        # the result of the future, unless the pipeline stops before it is done, e.g. its batch is cancelled
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except concurrent.futures.TimeoutError:
+                if self.stop.is_set():
+                    raise TranslationStopped()
+
+    def put(self, target, item):
+        if item is not None:
+            item.queued = time.perf_counter()
+        while True:
+            try:
+                return target.put(item, timeout=0.1)
+            except queue.Full:
+                if self.stop.is_set():
+                    raise TranslationStopped()
+
+    def guard(self, stage, *args):
+        # an error in a stage stops the others, it is raised again by run
+        try:
+            stage(*args)
+        except TranslationStopped:
+            pass
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+
+    def collect_stage(self, indices, starts, target):
+        document = self.translation.document
+        for index in indices:
+            paragraph = document.paragraphs[index]
+            job = ParagraphJob(index, paragraph, [language for language, start in starts.items() if index >= start])
+            for language in job.languages:
+                latexTranslator = self.latexTranslators[language]
+                if latexTranslator.addCache:
+                    latex = latexTranslator.load_cached(paragraph)
+                    if latex is not None:
+                        job.latex[language] = latex
+            if job.missing() and document.texts[index] is None:
+                job.collectFuture = self.translation.processPool.submit(collect_paragraph, paragraph)
+            self.put(target, job)
+        self.put(target, None)
+
+    def send(self, batches):
+        # the open batches are sent
+        if self.stop.is_set():
+            raise TranslationStopped()
+        for textTranslator, batch in batches.values():
+            def run(textTranslator=textTranslator, batch=batch):
+                try:
+                    textTranslator.translate_batch(batch.texts)
+                    batch.future.set_result(None)
+                except BaseException as e:
+                    batch.future.set_exception(e)
+            self.translation.ioPool.submit(run)
+        batches.clear()
 
+    def translate_stage(self, source, target):
+        document = self.translation.document
+        batches = {}  # language: (TextTranslator, open batch)
+        while True:
+            try:
+                job = self.dequeued(source.get_nowait())
+            except queue.Empty:
+                # nothing else is ready, the open batches do not wait for more texts
+                self.send(batches)
+                job = self.get(source)
+            if job is None:
+                break
+            if job.collectFuture is not None:
+                try:
+                    document.texts[job.index], records = job.collectFuture.result()
+                    metrics.merge(records)
+                except Exception:
+                    job.fallback = True
+            job.texts = document.texts[job.index]
+            for language in ([] if job.fallback else job.missing()):
+                translator = self.latexTranslators[language].translator
+                futures = job.batches[language] = set()
+                for text in dict.fromkeys(job.texts):
+                    if not translator.has_words(text) or translator.memo.contains(text, translator.languages):
+                        continue
+                    future = self.pendingTexts.get((text, translator.languages))
+                    if future is None:
+                        if language not in batches:
+                            batches[language] = (translator, Batch())
+                        batch = batches[language][1]
+                        if not batch.add(text):
+                            self.send({language: batches.pop(language)})
+                            batch = Batch()
+                            batches[language] = (translator, batch)
+                            batch.add(text)
+                        future = self.pendingTexts[(text, translator.languages)] = batch.future
+                    futures.add(future)
+            if target.full():
+                # the render stage may be waiting for the open batches
+                self.send(batches)
+            self.put(target, job)
+        self.send(batches)
+        self.put(target, None)
+
+    def render_stage(self, source, target):
+        while True:
+            job = self.get(source)
+            if job is None:
+                break
+            if not job.fallback:
+                for language, futures in job.batches.items():
+                    for future in futures:
+                        self.wait(future)
+                    translator = self.latexTranslators[language].translator
+                    translations = {text: translator.memo.get(text, translator.languages) for text in job.texts if translator.has_words(text)}
+                    job.renderFutures[language] = self.translation.processPool.submit(render_paragraph, job.paragraph, translations)
+            self.put(target, job)
+        self.put(target, None)
+
+    def finish(self, job):
+        # {language: translated paragraph}, in the main thread
+        latexTranslated = {}
+        for language in job.languages:
+            latexTranslator = self.latexTranslators[language]
+            if language in job.latex:
+                latexTranslated[language] = job.latex[language]
+                continue
+            rendered = not job.fallback
+            if rendered:
+                try:
+                    latexTranslatedParagraph, nbad, ntotal, records = job.renderFutures[language].result()
+                    metrics.merge(records)
+                except Exception:
+                    rendered = False
+            if not rendered:
+                latexTranslated[language] = latexTranslator.worker(job.paragraph)
+                continue
+            latexTranslator.nbad += nbad
+            latexTranslator.ntotal += ntotal
+            if latexTranslator.addCache:
+                latexTranslator.save_cached(job.paragraph, latexTranslatedParagraph)
+            latexTranslator.num += 1
+            latexTranslated[language] = latexTranslatedParagraph
         return latexTranslated
 
+    def jobs(self, source):
+        # the rendered jobs, in order
+        while True:
+            try:
+                job = self.get(source)
+            except TranslationStopped:
+                raise self.error
+            if job is None:
+                return
+            yield job
+
+    def run(self, indices, starts):
+        # (index, {language: translated paragraph}), in order
+        collected = queue.Queue(self.queueSize)
+        translated = queue.Queue(self.queueSize)
+        rendered = queue.Queue(self.queueSize)
+        stages = [
+            threading.Thread(target=self.guard, args=(self.collect_stage, indices, starts, collected), daemon=True),
+            threading.Thread(target=self.guard, args=(self.translate_stage, collected, translated), daemon=True),
+            threading.Thread(target=self.guard, args=(self.render_stage, translated, rendered), daemon=True),
+        ]
+        try:
+            for stage in stages:
+                stage.start()
+            for job in progress_bar(self.jobs(rendered), len(indices), self.translation.translator):
+                yield job.index, self.finish(job)
+        finally:
+            self.stop.set()
+            for stage in stages:
+                stage.join()
+
 
-def translate_single_tex_file(input_path, outputPath, engine, lFrom, lTo, debug, nocache, threads):
-    textTranslator = TextTranslator(engine, lTo, lFrom)
-    latexTranslator = LatexTranslator(textTranslator, debug, threads)
+def translate_single_tex_file(input_path, outputPath, engine, lFrom, lTo, debug, nocache, threads, batch=True, processes=None, stream=None):
+    translate_tex_file_to_languages(input_path, {lTo: outputPath}, engine, lFrom, debug, nocache, threads, batch, processes, stream)
+
+
+def translate_languages(latexTranslators, document, outputPaths, nocache, stream):
+    # the document translated into the languages of latexTranslators at the same time, written to outputPaths
+    if not stream:
+        for language, text_final in DocumentTranslation(latexTranslators, document).translate(nocache).items():
+            with open(outputPaths[language], "w", encoding='utf-8') as file:
+                print(text_final, file=file)
+        return
+    # the outputs grow as the paragraphs are translated, an interrupted run is resumed by the next one
+    outputs = {}
+    try:
+        for language, latexTranslator in latexTranslators.items():
+            outputs[language] = StreamWriter(outputPaths[language], latexTranslator.document_key(document))
+        DocumentTranslation(latexTranslators, document).translate(nocache, outputs)
+    except BaseException:
+        for output in outputs.values():
+            output.abort()
+        raise
+    for output in outputs.values():
+        output.close()
+
+
+def translate_tex_file_to_languages(input_path, outputPaths, engine, lFrom, debug, nocache, threads, batch=True, processes=None, stream=None):
+    '''
+    outputPaths: {language to: output path}
+    The document is prepared once, then its paragraphs are translated into all the languages at the same time,
+    through one engine, so that the requests of all the languages share the rate limits.
+    '''
+    metrics.reset()
+    processes = config.processes if processes is None else processes
+    stream = config.stream if stream is None else stream
+    memo = TranslationMemo()
+    sharedEngine = engines.create_engine(engine)
+    latexTranslators = {lTo: LatexTranslator(TextTranslator(engine, lTo, lFrom, memo, sharedEngine), debug, threads, batch, processes) for lTo in outputPaths}
 
     inputEncoding = get_file_encoding(input_path)
     textOriginal = open(input_path, encoding=inputEncoding).read()
-    text_final = latexTranslator.translate_full_latex(textOriginal, noCache=nocache)
-    with open(outputPath, "w", encoding='utf-8') as file:
-        print(text_final, file=file)
-    print('Number of translation called:', textTranslator.numberOfCalls)
-    print('Total characters translated:', textTranslator.totChar)
-    print('saved to', outputPath)
\ No newline at end of file
+    document = LatexTranslator.prepare(textOriginal)
+    # the cache of a language is not evicted while the other languages are translated
+    documentKeys = {latexTranslator.document_key(document) for latexTranslator in latexTranslators.values()}
+    cache.inUse.update(documentKeys)
+    try:
+        # the debug files of the languages would be mixed
+        for languages in ([[lTo] for lTo in outputPaths] if debug else [list(outputPaths)]):
+            translate_languages({lTo: latexTranslators[lTo] for lTo in languages}, document, {lTo: outputPaths[lTo] for lTo in languages}, nocache, stream)
+    finally:
+        sharedEngine.close()
+        cache.inUse.difference_update(documentKeys)
+        if not nocache:
+            for name in ('paragraph cache hits', 'paragraph cache misses', 'global cache hits'):
+                cache.count(name, metrics.counters.get(name, 0))
+            # the translations of an interrupted run are kept too
+            cache.flush(durable=True)
+
+    languages = {}
+    for lTo, latexTranslator in latexTranslators.items():
+        textTranslator = latexTranslator.translator
+        prefix = f'[{lTo}] ' if len(outputPaths) > 1 else ''
+        print(f'{prefix}Number of translation called:', textTranslator.numberOfCalls)
+        print(f'{prefix}Total characters translated:', textTranslator.totChar)
+        if batch:
+            print(f'{prefix}Batched requests:', textTranslator.numberOfBatches, 'with', textTranslator.batchFallbacks, 'fallbacks to one request per text')
+        languages[lTo] = {'output': outputPaths[lTo], 'calls': textTranslator.numberOfCalls, 'chars': textTranslator.totChar, 'batches': textTranslator.numberOfBatches}
+        metrics.count('calls', textTranslator.numberOfCalls)
+        metrics.count('chars translated', textTranslator.totChar)
+    print('Translation memo:', memo.report())
+    if hasattr(sharedEngine, 'report'):
+        print('Engine:', sharedEngine.report())
+    metrics.count('memo hits', memo.hits)
+    metrics.count('memo misses', memo.misses)
+    metrics.count('memo coalesced', memo.coalesced)
+    metrics.set('languages', languages)
+    limit = getattr(sharedEngine, 'limit', None)
+    if limit is not None:
+        metrics.set('concurrency', {'final': limit.current(), 'lowest': limit.lowest, 'highest': limit.highest,
+                                    'increases': limit.increases, 'decreases': limit.decreases, 'adaptive': limit.adaptive})
+    report = metrics.report(input=input_path, output=list(outputPaths.values()), engine=engine, languageFrom=lFrom, languageTo=list(outputPaths), batch=batch, processes=processes)
+    print(metrics.summary(report))
+    if config.report_file:
+        metrics.save(report, config.report_file)
+        print('report saved to', config.report_file)
+    for outputPath in outputPaths.values():
+        print('saved to', outputPath)
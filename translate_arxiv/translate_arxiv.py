@@ -2,8 +2,7 @@ import requests
 import utils
 import process_latex
 import process_file
-from translate import translate_single_tex_file
-from encoding import get_file_encoding
+from translate import translate_tex_file_to_languages
 import os
 import sys
 import shutil
@@ -34,18 +33,25 @@ def download_arxiv_pdf(arxivId, savePath):
 
 
 def download_source_with_cache(number, path):
+    # the last source is kept under its number, written to a temporary file and renamed, since other processes may read it
     cacheDir = os.path.join(cache_dir(), 'cache_arxiv')
     os.makedirs(cacheDir, exist_ok=True)
-    cachePath = os.path.join(cacheDir, 'last_downloaded_source')
-    cacheNumberPath = os.path.join(cacheDir, 'last_arxiv_number')
-    if os.path.exists(cachePath) and os.path.exists(cacheNumberPath):
-        lastNumber = open(cacheNumberPath).read()
-        if lastNumber == number:
-            shutil.copyfile(cachePath, path)
-            return
+    cachePath = os.path.join(cacheDir, number.replace('/', '-'))
+    try:
+        shutil.copyfile(cachePath, path)
+        return
+    except FileNotFoundError:
+        pass
     download_source(number, path)
-    shutil.copyfile(path, cachePath)
-    open(cacheNumberPath, 'w').write(number)
+    temporaryPath = f'{cachePath}.{os.getpid()}.tmp'
+    shutil.copyfile(path, temporaryPath)
+    os.replace(temporaryPath, cachePath)
+    for fileName in os.listdir(cacheDir):
+        if fileName != os.path.basename(cachePath) and not fileName.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(cacheDir, fileName))
+            except FileNotFoundError:
+                pass
 
 
 def is_pdf(fileName):
@@ -67,7 +73,11 @@ def zipdir(dir, outputPath):
         zipFile.write(file, arcname=relPath)
 
 
-def translate_dir(dir, options):
+def translate_dir(dir, options, outputDirs=None):
+    '''
+    outputDirs: {language: directory} for several languages, the translated tree of each language is written
+    to its directory, otherwise the tex files are translated in place
+    '''
     files = loop_files(dir)
     texs = [f[0:-4] for f in files if f[-4:] == '.tex']
     bibs = [f[0:-4] for f in files if f[-4:] == '.bib']
@@ -77,9 +87,7 @@ def translate_dir(dir, options):
     completeTexs = []
     for tex in texs:
         path = f'{tex}.tex'
-        inputEncoding = get_file_encoding(path)
-        content = open(path, encoding=inputEncoding).read()
-        content = process_latex.remove_tex_comments(content)
+        content = process_file.read_tex(path)
         complete = process_latex.is_complete(content)
         if complete:
             print(path)
@@ -97,13 +105,27 @@ def translate_dir(dir, options):
         os.remove(f'{basename}.bbl')
     if options.notranslate:
         return True
+    if outputDirs:
+        # the files which are not translated are the same in every language
+        for outputDir in outputDirs.values():
+            shutil.copytree(dir, outputDir, dirs_exist_ok=True)
     for filename in completeTexs:
         print(f'Processing {filename}')
         filePath = f'{filename}.tex'
-        translate_single_tex_file(filePath, filePath, options.engine, options.l_from, options.l_to, options.debug, options.nocache, options.threads)
+        if outputDirs:
+            outputPaths = {language: os.path.join(outputDir, os.path.relpath(filePath, dir)) for language, outputDir in outputDirs.items()}
+        else:
+            outputPaths = {options.l_to[0]: filePath}
+        translate_tex_file_to_languages(filePath, outputPaths, options.engine, options.l_from, options.debug, options.nocache, options.threads, not options.nobatch)
     return True
 
 
+def language_output_path(outputPath, language):
+    # xxx.zip -> xxx_ja.zip
+    base, extension = os.path.splitext(outputPath)
+    return f'{base}_{language}{extension}'
+
+
 def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("number", nargs='?', type=str, help='arxiv number')
@@ -129,6 +151,10 @@ def main(args=None):
 
     success = True
     cwd = os.getcwd()
+    # with several languages, the translated trees are written next to the source tree, one zip file each
+    languagesDir = tempfile.TemporaryDirectory() if len(options.l_to) > 1 else None
+    outputDirs = {language: os.path.join(languagesDir.name, language) for language in options.l_to} if languagesDir else None
+    outputPaths = {language: language_output_path(outputPath, language) for language in options.l_to} if languagesDir else None
     with tempfile.TemporaryDirectory() as tempDir:
         print('temporary directory', tempDir)
         if options.from_dir:
@@ -157,18 +183,28 @@ def main(args=None):
                     except tarfile.ReadError:
                         print('This is a pure text file')
                         shutil.move(downloadPath, 'main.tex')
-                    success = translate_dir('.', options)
+                    success = translate_dir('.', options, outputDirs)
             else:
-                success = translate_dir('.', options)
+                success = translate_dir('.', options, outputDirs)
             os.chdir(cwd)
-            if success:
+            if success and outputDirs and not options.notranslate:
+                for language, outputDir in outputDirs.items():
+                    zipdir(outputDir, outputPaths[language])
+            elif success:
                 zipdir(tempDir, outputPath)
         except BaseException as e:
             os.chdir(cwd)
             raise e
+        finally:
+            if languagesDir:
+                languagesDir.cleanup()
 
     if success:
-        print('zip file is saved to', outputPath)
+        if outputDirs and not options.notranslate:
+            for language in outputDirs:
+                print(f'zip file of {language} is saved to', outputPaths[language])
+        else:
+            print('zip file is saved to', outputPath)
         return True
     else:
         print('Source code is not available for arxiv', number)
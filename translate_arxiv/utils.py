@@ -2,6 +2,8 @@ from config import config
 import sys
 import re
 import encoding
+import engines
+import cache
 
 
 languageList = '''
@@ -76,11 +78,24 @@ split = lambda s: re.split(r'\s+', s)
 
 
 def add_arguments(parser):
-    parser.add_argument("-engine", default=config.default_engine, help=f'translation engine, default is {config.default_engine}')
+    parser.add_argument("-engine", default=config.default_engine, help=f'translation engine: {", ".join(engines.engineClasses)}, default is {config.default_engine}')
     parser.add_argument("-from", default=config.default_language_from, dest='l_from', help=f'language from, default is {config.default_language_from}')
-    parser.add_argument("-to", default=config.default_language_to, dest='l_to', help=f'language to, default is {config.default_language_to}')
+    parser.add_argument("-to", default=config.default_language_to, dest='l_to', help=f'languages to, separated by commas, e.g. -to zh-CN,ja,ko, the document is parsed once for all of them, default is {config.default_language_to}')
     parser.add_argument("-threads", default=config.default_threads, type=int, help='threads for tencent translation, default is auto')
     parser.add_argument("-commands", type=str, help='add commands for translation from a file')
+    parser.add_argument("-rate", default=config.requests_per_second, type=float, help=f'translation requests per second, 0 means no limit, default is {config.requests_per_second}')
+    parser.add_argument("-char-rate", default=config.chars_per_second, type=float, help=f'translated characters per second, 0 means no limit, default is {config.chars_per_second}')
+    parser.add_argument("-inflight", default=config.max_in_flight, type=int, help=f'most translation requests in flight at the same time, the concurrency adapts below it, default is {config.max_in_flight}')
+    parser.add_argument("--static-concurrency", action='store_true', help='keep -inflight requests in flight instead of adapting to the latency and the rate limit errors')
+    parser.add_argument("-engine-url", default=config.google_url, help=f'url of the google engine, e.g. a local stub server, default is {config.google_url}')
+    parser.add_argument("-regex-timeout", default=config.regex_timeout, type=float, help=f'time limit in seconds of each regex search before a linear fallback is used, 0 means no limit, default is {config.regex_timeout}')
+    parser.add_argument("-processes", default=config.processes, type=int, help='processes for parsing and recovery while the translations are requested, 0 means auto, 1 means none, default is auto')
+    parser.add_argument("-report", default=config.report_file, help=f'JSON file of the timings and counters of the run, empty means no report, default is {config.report_file}')
+    parser.add_argument("--stream", action='store_true', help='write the paragraphs to the output as they are translated, an interrupted run resumes from the last checkpoint')
+    parser.add_argument("--nobatch", action='store_true', help='send every text in its own request instead of packing short texts together')
+    parser.add_argument("-cache-size", default=cache.maxBytes / 2 ** 20, type=float, help=f'megabytes of the translation cache, the least recently used documents and paragraphs are removed beyond, default is {cache.maxBytes / 2 ** 20:g}')
+    parser.add_argument("-cache-memory", default=cache.memoryBytes / 2 ** 20, type=float, help=f'megabytes of the recently used paragraphs kept in memory in front of the cache on disk, default is {cache.memoryBytes / 2 ** 20:g}')
+    parser.add_argument("--cache-stats", action='store_true', help='print the size, the evictions and the hit ratio of the translation cache')
     parser.add_argument("--force-utf8", action='store_true', help='force reading file by utf8')
     parser.add_argument("--list", action='store_true', help='list codes for languages')
     parser.add_argument("--setdefault", action='store_true', help='set default translation engine and languages')
@@ -91,7 +106,7 @@ def add_arguments(parser):
 def process_options(options):
 
     if options.setdefault:
-        print('Translation engine (google or tencent, default google)')
+        print(f'Translation engine ({" or ".join(engines.engineClasses)}, default google)')
         config.set_variable(config.default_engine_path, config.default_engine_default)
         print('Translation language from (default en)')
         config.set_variable(config.default_language_from_path, config.default_language_from_default)
@@ -109,13 +124,54 @@ def process_options(options):
         print('tencent translator does not support some of them')
         sys.exit()
 
+    if options.cache_stats:
+        for name, value in cache.stats().items():
+            print(f'{name}: {value:.1%}' if name.endswith('ratio') and value is not None else f'{name}: {value}')
+        sys.exit()
+
+    if options.engine not in engines.engineClasses:
+        print(f'unknown engine {options.engine}, the engines are {", ".join(engines.engineClasses)}')
+        sys.exit()
+
+    # -to zh-CN,ja
+    options.l_to = list(dict.fromkeys(language.strip() for language in options.l_to.split(',') if language.strip()))
+
     if options.force_utf8:
         encoding.force_utf8 = True
 
+    if options.regex_timeout < 0:
+        print('regex timeout must be >= 0, set to no limit')
+        options.regex_timeout = 0
+    config.regex_timeout = options.regex_timeout
+
+    if options.inflight <= 0:
+        print('inflight must be a positive integer number, set to', config.max_in_flight)
+        options.inflight = config.max_in_flight
+    config.requests_per_second = options.rate
+    config.chars_per_second = options.char_rate
+    config.max_in_flight = options.inflight
+    config.adaptive_concurrency = not options.static_concurrency
+    config.google_url = options.engine_url
+
     if options.threads < 0:
         print('threads must be a non-zero integer number (>=0 where 0 means auto), set to auto')
         options.threads = 0
 
+    if options.processes < 0:
+        print('processes must be a non-negative integer number (0 means auto), set to auto')
+        options.processes = 0
+    config.processes = options.processes
+    if options.cache_size <= 0:
+        print('cache size must be positive, set to', cache.maxBytes / 2 ** 20)
+        options.cache_size = cache.maxBytes / 2 ** 20
+    cache.maxBytes = int(options.cache_size * 2 ** 20)
+    if options.cache_memory < 0:
+        print('cache memory must be >= 0, set to', cache.memoryBytes / 2 ** 20)
+        options.cache_memory = cache.memoryBytes / 2 ** 20
+    cache.memoryBytes = int(options.cache_memory * 2 ** 20)
+    config.report_file = options.report
+    config.stream = options.stream
+
     additionalCommands = []
     if options.commands:
         content = open(options.commands, 'r').read()
@@ -127,7 +183,9 @@ def process_options(options):
     print("Start")
     print('engine', options.engine)
     print('language from', options.l_from)
-    print('language to', options.l_to)
+    print('language to', ', '.join(options.l_to))
 
     print('threads', options.threads if options.threads > 0 else 'auto')
+    print('processes', options.processes if options.processes > 0 else 'auto')
+    print('rate limit', f'{options.rate:g} requests/s' if options.rate > 0 else 'none', f'{options.char_rate:g} chars/s' if options.char_rate > 0 else '', f'{options.inflight} in flight' if options.static_concurrency else f'adaptive concurrency up to {options.inflight} in flight')
     print()
\ No newline at end of file